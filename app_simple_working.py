@@ -1,4 +1,4 @@
-from flask import Flask, jsonify, send_file, Response, request
+from flask import Flask, jsonify, send_file, Response, request, g
 from flask_restx import Api, Resource, fields, Namespace
 from flask_cors import CORS
 import os
@@ -6,9 +6,10 @@ import pandas as pd
 import requests
 from datetime import datetime, timedelta
 import logging
-import threading
 import time
 
+from metrics import CONTENT_TYPE, HTTP_REQUEST_DURATION, REGISTRY
+
 # Crear app Flask
 app = Flask(__name__)
 CORS(app)
@@ -23,7 +24,11 @@ app.config.update({
     'DB_DATABASE': os.environ.get('DB_DATABASE', 'hnsrqkzfpr'),
     'API_TOKEN': os.environ.get('API_TOKEN', 'bltrck2021_454fd3d'),
     'EXCEL_PATH': os.environ.get('EXCEL_PATH', 'GEOCERCAS_CBN.xlsx'),
-    'HISTORICAL_PATH': os.environ.get('HISTORICAL_PATH', 'DataGrid.xlsx')
+    'HISTORICAL_PATH': os.environ.get('HISTORICAL_PATH', 'DataGrid.xlsx'),
+    'PROCESSING_INTERVAL_SECONDS': int(os.environ.get('PROCESSING_INTERVAL_SECONDS', 300)),
+    # Solo un proceso debe correr el planificador, y debe ser el que atiende los requests (los snapshots
+    # están en memoria): python app_simple_working.py o, con gunicorn, el worker que elige gunicorn.conf.py
+    'PROCESSING_SCHEDULER_ENABLED': os.environ.get('PROCESSING_SCHEDULER_ENABLED', 'false').lower() in ('1', 'true', 'yes')
 })
 
 # Configurar logging
@@ -149,8 +154,13 @@ geocerca_model = api.model('Geocerca', {
 tracking_service_complete = None
 
 
-def init_complete_service():
-    """Inicializa el servicio de tracking completo con manejo de errores"""
+def init_complete_service(start_scheduler=False):
+    """Inicializa el servicio de tracking completo con manejo de errores
+
+    La inicialización perezosa desde los endpoints no arranca el planificador;
+    solo lo hace el arranque explícito con PROCESSING_SCHEDULER_ENABLED
+    (__main__ o el hook post_worker_init de gunicorn.conf.py).
+    """
     global tracking_service_complete
 
     print("Iniciando servicio completo...")
@@ -176,15 +186,22 @@ def init_complete_service():
                 'token': app.config['API_TOKEN']
             },
             'excel_path': app.config['EXCEL_PATH'],
-            'historical_path': app.config['HISTORICAL_PATH']
+            'historical_path': app.config['HISTORICAL_PATH'],
+            'processing_interval_seconds': app.config['PROCESSING_INTERVAL_SECONDS']
         }
 
         # Importar con manejo de errores
         try:
             from truck_tracking_web_complete import TruckTrackingWebServiceComplete
             tracking_service_complete = TruckTrackingWebServiceComplete(config)
+            REGISTRY.set_collector('tracking_service', tracking_service_complete.collect_metrics)
             logger.info("Servicio completo inicializado correctamente")
             print("Servicio completo inicializado correctamente")
+
+            # Los endpoints solo leen snapshots: el procesamiento corre en el planificador
+            # o, si este proceso no lo tiene, en refrescos bajo demanda
+            if start_scheduler:
+                tracking_service_complete.start_processing_scheduler()
         except ImportError as e:
             logger.error(f"Error importando TruckTrackingWebServiceComplete: {e}")
             print(f"Error importando servicio: {e}")
@@ -200,6 +217,40 @@ def init_complete_service():
         tracking_service_complete = None
 
 
+@app.before_request
+def start_request_timer():
+    """Marca el inicio del request para el histograma de latencia"""
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def remember_response_status(response):
+    """Guarda el status para el histograma de latencia"""
+    g.response_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def observe_request_latency(exc=None):
+    """Registra la latencia por ruta (la regla, no la URL, para acotar las etiquetas)
+
+    Se hace en teardown para contar también los requests que terminan en una
+    excepción no manejada (500), donde after_request puede no ejecutarse.
+    """
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        status = 500 if exc is not None else getattr(g, 'response_status', 500)
+        HTTP_REQUEST_DURATION.observe(time.perf_counter() - started, method=request.method,
+                                      route=route, status=status)
+
+
+@app.route('/metrics')
+def metrics():
+    """Métricas en formato de texto de Prometheus (solo estado en memoria, sin BD)"""
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+
 @app.route('/health')
 def health_check():
     """Verificación básica de salud"""
@@ -518,19 +569,19 @@ class DashboardStatsComplete(Resource):
 class ProcessTrucksComplete(Resource):
     @tracking_ns.doc('trigger_complete_processing')
     def post(self):
-        """Inicia procesamiento completo con geocercas y alertas"""
+        """Encola un procesamiento completo con geocercas y alertas"""
         try:
             if not tracking_service_complete:
                 init_complete_service()
 
-            # Ejecutar procesamiento completo en background
-            thread = threading.Thread(target=tracking_service_complete.process_all_trucks_complete)
-            thread.daemon = True
-            thread.start()
+            # Encolar en el planificador: si ya hay uno en cola se reutiliza ese trabajo
+            job, created = tracking_service_complete.enqueue_processing('manual')
 
             return {
-                'message': 'Procesamiento completo iniciado en background',
-                'status': 'started',
+                'message': 'Procesamiento completo encolado' if created else 'Ya había un procesamiento en cola',
+                'status': job['status'],
+                'job_id': job['job_id'],
+                'deduplicated': not created,
                 'includes': [
                     'Geocercas (DOCKS, Track&Trace, CBN, Ciudades)',
                     'Cálculo de porcentajes de entrega',
@@ -543,6 +594,43 @@ class ProcessTrucksComplete(Resource):
             api.abort(500, f"Error: {str(e)}")
 
 
+@tracking_ns.route('/jobs/<string:job_id>')
+class ProcessingJobStatus(Resource):
+    @tracking_ns.doc('get_processing_job')
+    def get(self, job_id):
+        """Obtiene el estado de un procesamiento encolado"""
+        if not tracking_service_complete:
+            init_complete_service()
+
+        job = tracking_service_complete.get_processing_job(job_id)
+        if not job:
+            api.abort(404, f"Trabajo {job_id} no encontrado")
+        return job, 200
+
+
+@tracking_ns.route('/runs')
+class ProcessingRuns(Resource):
+    @tracking_ns.doc('get_processing_runs')
+    def get(self):
+        """Obtiene el historial de corridas de procesamiento con tiempos por etapa"""
+        # ?limit=N, ?source=db para leer la tabla processing_runs en lugar de memoria
+        limit = request.args.get('limit', '50')
+        if not limit.isdigit() or not 1 <= int(limit) <= 1000:
+            api.abort(400, "limit debe ser un entero entre 1 y 1000")
+        limit = int(limit)
+
+        try:
+            if not tracking_service_complete:
+                init_complete_service()
+
+            from_db = request.args.get('source', 'memory') == 'db'
+
+            runs = tracking_service_complete.get_processing_runs(limit, from_db)
+            return {'runs': runs, 'count': len(runs), 'source': 'db' if from_db else 'memory'}, 200
+        except Exception as e:
+            api.abort(500, f"Error: {str(e)}")
+
+
 # ===============================
 # ENDPOINTS DE ALERTAS COMPLETAS
 # ===============================
@@ -657,6 +745,26 @@ class GeocercasDistribution(Resource):
             api.abort(500, f"Error: {str(e)}")
 
 
+@geocercas_ns.route('/benchmark')
+class GeocercasBenchmark(Resource):
+    @geocercas_ns.doc('benchmark_geocerca_engines', params={'samples': 'Puntos aleatorios a clasificar (máx. 200000)'})
+    def get(self):
+        """Compara los motores de geocercas shapely y grid (tiempos y diferencias)"""
+        samples = request.args.get('samples', '20000')
+        if not samples.isdigit() or not 1 <= int(samples) <= 200000:
+            api.abort(400, "samples debe ser un entero entre 1 y 200000")
+
+        try:
+            if not tracking_service_complete:
+                init_complete_service()
+
+            result = tracking_service_complete.benchmark_geocerca_engines(int(samples))
+            result['engine'] = tracking_service_complete.config.get('geocerca_engine', 'shapely')
+            return result, 200
+        except Exception as e:
+            api.abort(500, f"Error: {str(e)}")
+
+
 # ===============================
 # ENDPOINTS DEL MAPA INTERACTIVO
 # ===============================
@@ -3513,7 +3621,8 @@ if __name__ == '__main__':
     print("🚨 Alertas: http://localhost:5000/api/alerts/active")
     print("📈 Excel Completo: http://localhost:5000/api/reports/excel-complete")
 
-    # Inicializar servicio completo
-    init_complete_service()
+    # Inicializar servicio completo (el proceso vigía del reloader no procesa camiones)
+    init_complete_service(start_scheduler=app.config['PROCESSING_SCHEDULER_ENABLED']
+                          and os.environ.get('WERKZEUG_RUN_MAIN') == 'true')
 
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
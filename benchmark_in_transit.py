@@ -0,0 +1,223 @@
+"""
+Benchmark de las variantes de la consulta de camiones en tránsito.
+
+Crea (o reutiliza) una tabla `trucks` sintética en un MySQL local y mide la
+latencia de cada variante de IN_TRANSIT_QUERIES, primero sin índices extra y
+luego con el índice compuesto (patente, fecha_salida, hora_salida). Antes de
+medir se verifica que todas las variantes devuelvan las mismas filas; la
+siembra incluye fechas y horas NULL y viajes empatados para cubrir esos casos.
+
+Uso:
+    python benchmark_in_transit.py --rows 1000000 --patentes 5000
+    python benchmark_in_transit.py --skip-seed --repeat 10
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+from datetime import date, timedelta
+
+import pymysql
+
+from truck_tracking_web_complete import IN_TRANSIT_QUERIES
+
+DEPOSITOS = ['Cerveceria SCZ', 'Cerveceria LPZ', 'Cerveceria CBBA', 'Deposito Oruro', 'Deposito Tarija']
+STATUSES = ['SALIDA', 'LLEGADA', 'ANULADO']
+INDEX_NAME = 'idx_bench_patente_salida'
+
+
+def parse_args():
+    """Argumentos de línea de comandos"""
+    parser = argparse.ArgumentParser(description='Benchmark de la consulta de camiones en tránsito')
+    parser.add_argument('--host', default=os.getenv('BENCH_DB_HOST', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('BENCH_DB_PORT', 3306)))
+    parser.add_argument('--user', default=os.getenv('BENCH_DB_USER', 'root'))
+    parser.add_argument('--password', default=os.getenv('BENCH_DB_PASSWORD', ''))
+    parser.add_argument('--database', default=os.getenv('BENCH_DB_NAME', 'tracking_bench'))
+    parser.add_argument('--rows', type=int, default=1000000, help='Filas sintéticas en trucks')
+    parser.add_argument('--patentes', type=int, default=5000, help='Cantidad de camiones distintos')
+    parser.add_argument('--repeat', type=int, default=5, help='Ejecuciones por variante')
+    parser.add_argument('--batch', type=int, default=5000, help='Filas por INSERT al sembrar')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--null-ratio', type=float, default=0.02,
+                        help='Proporción de filas con fecha_salida u hora_salida NULL')
+    parser.add_argument('--skip-seed', action='store_true', help='Reutilizar la tabla existente')
+    parser.add_argument('--variants', nargs='+', default=list(IN_TRANSIT_QUERIES.keys()),
+                        choices=list(IN_TRANSIT_QUERIES.keys()))
+    return parser.parse_args()
+
+
+def connect(args, database=None):
+    """Abre una conexión al MySQL de benchmark"""
+    return pymysql.connect(
+        host=args.host,
+        port=args.port,
+        user=args.user,
+        password=args.password,
+        database=database,
+        charset='utf8mb4',
+        cursorclass=pymysql.cursors.DictCursor,
+        autocommit=False
+    )
+
+
+def seed_trucks(args):
+    """Crea la base y siembra la tabla trucks con viajes sintéticos"""
+    with connect(args) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{args.database}` CHARACTER SET utf8mb4")
+
+    with connect(args, args.database) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS trucks")
+            # Misma forma que la tabla de origen: sin más índices que la clave primaria
+            cursor.execute("""
+            CREATE TABLE trucks (
+                id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+                cod VARCHAR(255) NULL,
+                deposito_origen VARCHAR(255) NULL,
+                cod_destino VARCHAR(255) NULL,
+                deposito_destino VARCHAR(255) NULL,
+                planilla VARCHAR(255) NULL,
+                patente VARCHAR(255) NOT NULL,
+                fecha_salida DATE NULL,
+                hora_salida TIME NULL,
+                fecha_llegada DATE NULL,
+                hora_llegada TIME NULL,
+                cod_producto VARCHAR(255) NULL,
+                producto VARCHAR(255) NULL,
+                status VARCHAR(50) NULL,
+                salida INT NULL
+            ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+            """)
+
+            insert_query = """
+            INSERT INTO trucks (cod, deposito_origen, cod_destino, deposito_destino, planilla, patente,
+                                fecha_salida, hora_salida, fecha_llegada, hora_llegada, cod_producto,
+                                producto, status, salida)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            """
+
+            rnd = random.Random(args.seed)
+            patentes = [f"{rnd.randint(1000, 9999)}{rnd.choice('ABCDEFGHJKLMNPRSTUVWXYZ')}"
+                        f"{rnd.choice('ABCDEFGHJKLMNPRSTUVWXYZ')}{i}" for i in range(args.patentes)]
+            start_date = date.today() - timedelta(days=730)
+            start_time = time.time()
+            batch = []
+
+            for i in range(args.rows):
+                fecha_salida = start_date + timedelta(days=rnd.randint(0, 730))
+                # Horas en minutos enteros para que haya viajes empatados por patente
+                hora_salida = timedelta(minutes=rnd.randint(0, 1439))
+                if rnd.random() < args.null_ratio:
+                    fecha_salida = None
+                if rnd.random() < args.null_ratio:
+                    hora_salida = None
+                origen, destino = rnd.sample(DEPOSITOS, 2)
+                status = rnd.choices(STATUSES, weights=[2, 7, 1])[0]
+                llegada = (fecha_salida + timedelta(days=rnd.randint(0, 3))
+                           if status == 'LLEGADA' and fecha_salida else None)
+
+                batch.append((
+                    str(rnd.randint(1, 999)), origen, str(rnd.randint(1, 999)), destino,
+                    f"PL{i}", rnd.choice(patentes), fecha_salida, hora_salida,
+                    llegada, hora_salida if llegada else None,
+                    str(rnd.randint(1, 50)), f"Producto {rnd.randint(1, 50)}", status, 1
+                ))
+
+                if len(batch) >= args.batch:
+                    cursor.executemany(insert_query, batch)
+                    connection.commit()
+                    batch = []
+
+            if batch:
+                cursor.executemany(insert_query, batch)
+                connection.commit()
+
+            cursor.execute("ANALYZE TABLE trucks")
+            cursor.fetchall()
+
+    print(f"Sembradas {args.rows} filas para {args.patentes} patentes en {time.time() - start_time:.1f}s")
+
+
+def set_index(args, enabled):
+    """Crea o elimina el índice compuesto candidato"""
+    with connect(args, args.database) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SHOW INDEX FROM trucks WHERE Key_name = %s", (INDEX_NAME,))
+            exists = bool(cursor.fetchall())
+
+            if enabled and not exists:
+                cursor.execute(f"CREATE INDEX {INDEX_NAME} ON trucks (patente, fecha_salida, hora_salida)")
+            elif not enabled and exists:
+                cursor.execute(f"DROP INDEX {INDEX_NAME} ON trucks")
+
+            cursor.execute("ANALYZE TABLE trucks")
+            cursor.fetchall()
+
+
+def check_variants_agree(args):
+    """Verifica que todas las variantes devuelvan las mismas filas antes de medirlas"""
+    results = {}
+    with connect(args, args.database) as connection:
+        for variant in args.variants:
+            with connection.cursor() as cursor:
+                cursor.execute(IN_TRANSIT_QUERIES[variant])
+                results[variant] = sorted(tuple(str(value) for value in row.values())
+                                          for row in cursor.fetchall())
+
+    reference_variant = args.variants[0]
+    reference = results[reference_variant]
+    for variant, rows in results.items():
+        if rows != reference:
+            missing = len(set(reference) - set(rows))
+            extra = len(set(rows) - set(reference))
+            raise SystemExit(f"❌ {variant} no coincide con {reference_variant}: "
+                             f"{len(rows)} vs {len(reference)} filas ({missing} faltan, {extra} sobran)")
+
+    print(f"✅ Las {len(results)} variantes devuelven las mismas {len(reference)} filas")
+
+
+def run_variants(args, label):
+    """Ejecuta cada variante `repeat` veces y reporta latencias"""
+    print(f"\n=== {label} ===")
+    print(f"{'variante':<12} {'filas':>8} {'min ms':>10} {'mediana ms':>12} {'max ms':>10}")
+
+    row_counts = {}
+    with connect(args, args.database) as connection:
+        for variant in args.variants:
+            timings = []
+            rows = 0
+            for _ in range(args.repeat):
+                with connection.cursor() as cursor:
+                    started = time.perf_counter()
+                    cursor.execute(IN_TRANSIT_QUERIES[variant])
+                    rows = len(cursor.fetchall())
+                    timings.append((time.perf_counter() - started) * 1000)
+
+            row_counts[variant] = rows
+            print(f"{variant:<12} {rows:>8} {min(timings):>10.1f} "
+                  f"{statistics.median(timings):>12.1f} {max(timings):>10.1f}")
+
+    if len(set(row_counts.values())) > 1:
+        print(f"⚠️ Las variantes devolvieron cantidades distintas: {row_counts}")
+
+
+def main():
+    args = parse_args()
+
+    if not args.skip_seed:
+        seed_trucks(args)
+
+    check_variants_agree(args)
+
+    set_index(args, False)
+    run_variants(args, 'Sin índice adicional')
+
+    set_index(args, True)
+    run_variants(args, f'Con índice {INDEX_NAME} (patente, fecha_salida, hora_salida)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+"""
+Cliente HTTP compartido para la API de Boltrack.
+
+Reutiliza conexiones (requests.Session con keep-alive), reintenta con backoff
+exponencial y jitter los errores transitorios, y abre un circuit breaker tras
+varios fallos seguidos para no bloquear cada ciclo esperando un timeout.
+"""
+import codecs
+import json
+import logging
+import random
+import re
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import BOLTRACK_REQUEST_DURATION
+
+logger = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def iter_response_text(response, chunk_size=65536):
+    """Devuelve el cuerpo de una respuesta con stream=True como trozos de texto"""
+    decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+def iter_json_array(chunks):
+    """Recorre un arreglo JSON de objetos a medida que llegan los trozos, sin cargarlo entero
+
+    Cada elemento se decodifica con raw_decode apenas está completo en el buffer.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    started = False
+
+    for chunk in chunks:
+        buffer = buffer[position:] + chunk
+        position = 0
+
+        while True:
+            position = _WHITESPACE.match(buffer, position).end()
+            if position >= len(buffer):
+                break
+
+            char = buffer[position]
+            if not started:
+                if char != '[':
+                    raise ValueError("Se esperaba un arreglo JSON")
+                started = True
+                position += 1
+            elif char == ',':
+                position += 1
+            elif char == ']':
+                return
+            else:
+                try:
+                    item, position = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    # Elemento incompleto: esperar el siguiente trozo
+                    break
+                yield item
+
+    raise ValueError("Arreglo JSON incompleto")
+
+
+class CircuitOpenError(Exception):
+    """El circuito está abierto: la llamada no se intenta"""
+
+
+class BoltrackClient:
+    """Cliente de la API de Boltrack con keep-alive, reintentos y circuit breaker"""
+
+    RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, base_url, token, timeout=30, connect_timeout=5, max_retries=2,
+                 backoff_base=0.5, backoff_max=5, failure_threshold=3, reset_timeout=60, pool_maxsize=8,
+                 max_total_time=40):
+        """Inicializa la sesión HTTP y el estado del circuito"""
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (float(connect_timeout), float(timeout))
+        self.max_retries = int(max_retries)
+        # Tope de una llamada con todos sus reintentos (0 = sin tope)
+        self.max_total_time = float(max_total_time or 0)
+        self.backoff_base = float(backoff_base)
+        self.backoff_max = float(backoff_max)
+        self.failure_threshold = int(failure_threshold)
+        self.reset_timeout = float(reset_timeout)
+
+        self.session = requests.Session()
+        self.session.headers.update({
+            'token': token,
+            'Content-Type': 'application/json'
+        })
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=int(pool_maxsize), max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._lock = threading.Lock()
+        self.circuit_state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.latencies_ms = deque(maxlen=200)
+        self.stats = {
+            'requests': 0,
+            'successes': 0,
+            'failures': 0,
+            'retries': 0,
+            'short_circuited': 0,
+            'circuit_opened': 0,
+            'last_error': None,
+            'last_success': None
+        }
+
+    @classmethod
+    def from_config(cls, api_config, **overrides):
+        """Construye el cliente desde config['api']"""
+        return cls(
+            api_config['base_url'],
+            api_config['token'],
+            timeout=api_config.get('timeout', 30),
+            connect_timeout=api_config.get('connect_timeout', 5),
+            max_retries=api_config.get('max_retries', 2),
+            backoff_base=api_config.get('backoff_base', 0.5),
+            backoff_max=api_config.get('backoff_max', 5),
+            failure_threshold=api_config.get('failure_threshold', 3),
+            reset_timeout=api_config.get('reset_timeout', 60),
+            max_total_time=api_config.get('max_total_time', 40),
+            **overrides
+        )
+
+    def _before_call(self):
+        """Verifica el circuito; pasado reset_timeout deja pasar una sola llamada de prueba"""
+        with self._lock:
+            if self.circuit_state == 'half_open':
+                self.stats['short_circuited'] += 1
+                raise CircuitOpenError("Circuito en prueba: otra llamada está verificando la API")
+
+            if self.circuit_state == 'open':
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    self.stats['short_circuited'] += 1
+                    raise CircuitOpenError(
+                        f"Circuito abierto tras {self.consecutive_failures} fallos seguidos")
+                self.circuit_state = 'half_open'
+                logger.info("🔌 Circuito API en half-open, probando una llamada")
+
+    def _record_success(self, latency_ms):
+        """Registra un éxito y cierra el circuito"""
+        with self._lock:
+            self.latencies_ms.append(latency_ms)
+            self.stats['successes'] += 1
+            self.stats['last_success'] = time.time()
+            if self.circuit_state != 'closed':
+                logger.info("✅ Circuito API cerrado nuevamente")
+            self.circuit_state = 'closed'
+            self.consecutive_failures = 0
+
+    def _record_failure(self, error):
+        """Registra un fallo y abre el circuito si se superó el umbral"""
+        with self._lock:
+            self.stats['failures'] += 1
+            self.stats['last_error'] = str(error)
+            self.consecutive_failures += 1
+            if self.circuit_state == 'half_open' or self.consecutive_failures >= self.failure_threshold:
+                if self.circuit_state != 'open':
+                    self.stats['circuit_opened'] += 1
+                    logger.warning(f"⚠️ Circuito API abierto por {self.reset_timeout:.0f}s: {error}")
+                self.circuit_state = 'open'
+                self.opened_at = time.monotonic()
+
+    def _backoff(self, attempt, deadline=None):
+        """Espera con backoff exponencial y jitter completo, sin pasarse del tope total"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if deadline is not None:
+            delay = min(delay, max(0.0, deadline - time.monotonic()))
+        time.sleep(delay)
+
+    def _attempt_timeout(self, timeout, deadline):
+        """Timeout (conexión, lectura) de un intento, recortado a lo que queda del tope total"""
+        if timeout is None:
+            timeout = self.timeout
+        elif not isinstance(timeout, tuple):
+            timeout = (float(timeout), float(timeout))
+        if deadline is None:
+            return timeout
+        remaining = max(0.1, deadline - time.monotonic())
+        return tuple(min(value, remaining) for value in timeout)
+
+    def get(self, path, timeout=None, retries=None, **kwargs):
+        """GET con reintentos acotados; lanza CircuitOpenError si el circuito está abierto
+
+        Devuelve la respuesta (también las 4xx no reintentables); si se agotan
+        los reintentos o el tope `max_total_time` lanza el último error.
+        """
+        self._before_call()
+
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        retries = self.max_retries if retries is None else int(retries)
+        deadline = time.monotonic() + self.max_total_time if self.max_total_time else None
+        last_error = None
+
+        for attempt in range(retries + 1):
+            if attempt:
+                self._backoff(attempt - 1, deadline)
+                if deadline is not None and time.monotonic() >= deadline:
+                    logger.warning(f"⚠️ API {path}: tope de {self.max_total_time:.0f}s agotado, sin más reintentos")
+                    break
+                with self._lock:
+                    self.stats['retries'] += 1
+
+            with self._lock:
+                self.stats['requests'] += 1
+
+            started = time.perf_counter()
+            try:
+                response = self.session.get(url, timeout=self._attempt_timeout(timeout, deadline), **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                BOLTRACK_REQUEST_DURATION.observe(time.perf_counter() - started, path=path,
+                                                  outcome=type(e).__name__)
+                last_error = e
+                logger.warning(f"⚠️ API {path} intento {attempt + 1}/{retries + 1} falló: {e}")
+                continue
+            except Exception as e:
+                self._record_failure(e)
+                raise
+
+            latency_ms = (time.perf_counter() - started) * 1000
+            BOLTRACK_REQUEST_DURATION.observe(latency_ms / 1000, path=path, outcome=str(response.status_code))
+            if response.status_code in self.RETRYABLE_STATUS:
+                last_error = requests.HTTPError(f"Status {response.status_code}", response=response)
+                logger.warning(f"⚠️ API {path} intento {attempt + 1}/{retries + 1}: status {response.status_code}")
+                response.close()
+                continue
+
+            self._record_success(latency_ms)
+            return response
+
+        self._record_failure(last_error)
+        raise last_error
+
+    def probe(self, path, timeout=10, **kwargs):
+        """GET único de diagnóstico: no reintenta ni modifica el circuito ni sus contadores"""
+        return self.session.get(f"{self.base_url}/{path.lstrip('/')}", timeout=timeout, **kwargs)
+
+    def get_stats(self):
+        """Contadores de latencia y fallos para health checks"""
+        with self._lock:
+            latencies = sorted(self.latencies_ms)
+            last = self.latencies_ms[-1] if self.latencies_ms else None
+            stats = dict(self.stats)
+            stats['circuit_state'] = self.circuit_state
+            stats['consecutive_failures'] = self.consecutive_failures
+
+        if latencies:
+            stats['latency_ms'] = {
+                'last': round(last, 1),
+                'avg': round(sum(latencies) / len(latencies), 1),
+                'p50': round(latencies[len(latencies) // 2], 1),
+                'p95': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 1),
+                'max': round(latencies[-1], 1)
+            }
+        else:
+            stats['latency_ms'] = None
+        return stats
+
+    def close(self):
+        """Cierra la sesión HTTP"""
+        self.session.close()
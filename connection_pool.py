@@ -0,0 +1,213 @@
+"""
+Pool de conexiones MySQL (pymysql) seguro entre hilos.
+
+Las conexiones pymysql no son thread-safe: cada hilo toma su propia conexión
+del pool, la usa y la devuelve. El pool está acotado, verifica la conexión con
+ping al entregarla, la recrea si se cayó y la descarta al superar su vida máxima.
+"""
+import logging
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+
+import pymysql
+
+from metrics import SQL_QUERY_DURATION
+
+logger = logging.getLogger(__name__)
+
+_SQL_VERB = re.compile(r'^\s*(\w+)')
+_SQL_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?`?(\w+)`?', re.IGNORECASE)
+
+
+@lru_cache(maxsize=512)
+def sql_family(query_prefix: str) -> str:
+    """Familia de una sentencia para métricas: verbo y tabla principal (p. ej. 'SELECT trucks')"""
+    verb = _SQL_VERB.match(query_prefix)
+    if not verb:
+        return 'OTHER'
+    table = _SQL_TABLE.search(query_prefix)
+    return f"{verb.group(1).upper()} {table.group(1)}" if table else verb.group(1).upper()
+
+
+class InstrumentedCursorMixin:
+    """Mide cada execute en el histograma de latencia SQL por familia"""
+
+    def execute(self, query, args=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, args)
+        finally:
+            # El prefijo basta para la familia y mantiene acotado el cache (executemany arma INSERTs enormes
+            # y los pasa como bytes)
+            prefix = query[:200]
+            if isinstance(prefix, bytes):
+                prefix = prefix.decode('utf-8', errors='replace')
+            SQL_QUERY_DURATION.observe(time.perf_counter() - started, family=sql_family(prefix))
+
+
+class InstrumentedDictCursor(InstrumentedCursorMixin, pymysql.cursors.DictCursor):
+    """DictCursor con métricas de latencia"""
+
+
+class InstrumentedSSDictCursor(InstrumentedCursorMixin, pymysql.cursors.SSDictCursor):
+    """SSDictCursor (lectura en streaming) con métricas de latencia"""
+
+
+class PoolTimeoutError(Exception):
+    """No se obtuvo una conexión libre dentro del tiempo de espera"""
+
+
+class MySQLConnectionPool:
+    """Pool acotado de conexiones pymysql con health check y vida máxima"""
+
+    def __init__(self, db_config, name='mysql', max_size=5, max_lifetime=3600, checkout_timeout=30):
+        """Inicializa el pool; las conexiones se crean bajo demanda"""
+        self.db_config = db_config
+        self.name = name
+        self.max_size = max(1, int(max_size))
+        self.max_lifetime = float(max_lifetime)
+        self.checkout_timeout = float(checkout_timeout)
+
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self.stats = {
+            'created': 0,
+            'reconnects': 0,
+            'expired': 0,
+            'checkouts': 0,
+            'waits': 0,
+            'timeouts': 0
+        }
+
+    def _create(self):
+        """Abre una conexión nueva: (conexión, momento de creación)"""
+        connection = pymysql.connect(cursorclass=InstrumentedDictCursor, **self.db_config)
+        with self._condition:
+            self.stats['created'] += 1
+        return connection, time.monotonic()
+
+    @staticmethod
+    def _close_quietly(connection):
+        """Cierra una conexión ignorando errores"""
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _release_slot(self):
+        """Libera un lugar del pool tras descartar una conexión"""
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def acquire(self):
+        """Entrega una conexión sana, esperando como máximo checkout_timeout"""
+        deadline = time.monotonic() + self.checkout_timeout
+        with self._condition:
+            # close_all() despierta a los que esperan: se revisa en cada vuelta, antes de crear nada
+            while not self._closed and not self._idle and self._size >= self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise PoolTimeoutError(
+                        f"Sin conexiones libres en pool {self.name} tras {self.checkout_timeout}s")
+                self.stats['waits'] += 1
+                self._condition.wait(remaining)
+
+            if self._closed:
+                raise PoolTimeoutError(f"Pool {self.name} cerrado")
+
+            self.stats['checkouts'] += 1
+            if self._idle:
+                connection, created_at = self._idle.pop()
+            else:
+                connection, created_at = None, None
+                self._size += 1
+
+        try:
+            if connection is None:
+                return self._create()
+
+            # Vida máxima: evita conexiones cortadas por wait_timeout o balanceadores
+            if time.monotonic() - created_at > self.max_lifetime:
+                self._close_quietly(connection)
+                with self._condition:
+                    self.stats['expired'] += 1
+                return self._create()
+
+            try:
+                connection.ping(reconnect=False)
+                return connection, created_at
+            except Exception as e:
+                logger.warning(f"⚠️ Conexión caída en pool {self.name}, reconectando: {e}")
+                self._close_quietly(connection)
+                with self._condition:
+                    self.stats['reconnects'] += 1
+                return self._create()
+
+        except Exception:
+            self._release_slot()
+            raise
+
+    def release(self, connection, created_at, discard=False):
+        """Devuelve una conexión al pool (o la descarta si quedó inservible)"""
+        if not discard:
+            try:
+                # Cierra cualquier transacción abierta para no arrastrar snapshots viejos
+                connection.rollback()
+            except Exception:
+                discard = True
+
+        if discard or self._closed:
+            self._close_quietly(connection)
+            self._release_slot()
+            return
+
+        with self._condition:
+            self._idle.append((connection, created_at))
+            self._condition.notify()
+
+    @contextmanager
+    def connection(self):
+        """Context manager: toma una conexión y la devuelve al salir (release hace rollback)"""
+        connection, created_at = self.acquire()
+        discard = False
+        try:
+            yield connection
+        except pymysql.err.OperationalError:
+            # Error de red/servidor: la conexión no vuelve al pool
+            discard = True
+            raise
+        finally:
+            self.release(connection, created_at, discard)
+
+    def close_all(self):
+        """Cierra las conexiones libres; las que estén en uso se cierran al devolverse"""
+        with self._condition:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+            self._condition.notify_all()
+
+        for connection, _ in idle:
+            self._close_quietly(connection)
+
+    def get_stats(self):
+        """Estado del pool para health checks"""
+        with self._condition:
+            return {
+                'name': self.name,
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._size - len(self._idle),
+                'closed': self._closed,
+                **self.stats
+            }
@@ -0,0 +1,58 @@
+"""
+Snapshot inmutable del estado de la flota.
+
+Cada ciclo de procesamiento arma un FleetSnapshot nuevo aparte y lo publica
+reemplazando una sola referencia (self.snapshot = nuevo). Los lectores toman
+la referencia una vez y trabajan sobre esa versión: no necesitan locks y nunca
+ven un ciclo a medio construir.
+
+La inmutabilidad es superficial: el dataclass y las tuplas no se pueden
+cambiar, pero cada fila sigue siendo un dict. build() copia las filas, así el
+ciclo que las armó no puede alterar el snapshot ya publicado; los lectores
+reciben esas mismas filas sin copiar (por costo) y deben tratarlas como de
+solo lectura, igual que stats y alerts.
+"""
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+
+def empty_alerts() -> Dict:
+    """Estructura de alertas sin camiones esperando"""
+    return {
+        'critical': [], 'warning': [], 'attention': [],
+        'summary': {'total_waiting': 0, 'critical_count': 0, 'warning_count': 0, 'attention_count': 0}
+    }
+
+
+@dataclass(frozen=True)
+class FleetSnapshot:
+    """Estado publicado de un ciclo: camiones, filas del Excel, estadísticas y alertas"""
+    version: int = 0
+    trucks_data: Tuple[Dict, ...] = ()
+    results_data: Tuple[Dict, ...] = ()
+    stats: Dict = field(default_factory=dict)
+    alerts: Dict = field(default_factory=dict)
+    created_at: Optional[datetime] = None
+
+    @classmethod
+    def build(cls, version: int, trucks_data, results_data, stats: Dict, alerts: Dict) -> 'FleetSnapshot':
+        """Congela las colecciones de un ciclo en un snapshot nuevo (con copia de cada fila)"""
+        return cls(
+            version=version,
+            trucks_data=tuple(dict(row) for row in trucks_data),
+            results_data=tuple(dict(row) for row in results_data),
+            stats=stats,
+            alerts=alerts,
+            created_at=datetime.now()
+        )
+
+    def as_cache(self) -> Dict:
+        """Vista con la forma del antiguo dict de cache del servicio"""
+        return {
+            'trucks_data': list(self.trucks_data),
+            'alerts': self.alerts,
+            'stats': self.stats,
+            'last_update': self.created_at,
+            'version': self.version
+        }
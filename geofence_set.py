@@ -0,0 +1,27 @@
+"""
+Conjunto inmutable de geocercas y sus índices.
+
+Una recarga arma un GeofenceSet nuevo aparte (geocercas, índice STRtree por
+grupo, grafo de jerarquía, mapeo depósito-geocerca y grilla) y lo publica
+reemplazando una sola referencia, igual que FleetSnapshot. Una clasificación
+toma la referencia una vez al empezar y usa esa versión completa, aunque en el
+medio se publique otra. El cache LRU por coordenadas pertenece a cada conjunto,
+así que muere con él.
+"""
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Optional
+
+
+@dataclass(frozen=True)
+class GeofenceSet:
+    """Geocercas de una carga con todos los índices derivados de ellas"""
+    version: int = 0
+    geocercas: Dict = field(default_factory=dict)
+    index: Dict = field(default_factory=dict)
+    tree: Dict = field(default_factory=dict)
+    deposito_index: Dict = field(default_factory=dict)
+    grid: Dict = field(default_factory=dict)
+    lru: OrderedDict = field(default_factory=OrderedDict)
+    loaded_at: Optional[datetime] = None
@@ -0,0 +1,55 @@
+"""
+Configuración de gunicorn para app_simple_working:app.
+
+    gunicorn app_simple_working:app
+
+Los snapshots viven en la memoria de cada proceso, así que el planificador
+debe correr en el mismo worker que atiende los requests. Por defecto se usa un
+solo worker con hilos; con PROCESSING_SCHEDULER_ENABLED el hook post_worker_init
+arranca el planificador en ese worker. Si se configuran más workers, solo el que
+toma el lock de archivo procesa en background (los demás refrescan bajo
+demanda) y, si muere, el worker que lo reemplaza toma el lock.
+"""
+import fcntl
+import os
+import tempfile
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+
+SCHEDULER_LOCK_PATH = os.environ.get('PROCESSING_SCHEDULER_LOCK',
+                                     os.path.join(tempfile.gettempdir(), 'truck_tracking_scheduler.lock'))
+
+
+def post_worker_init(worker):
+    """Arranca el planificador en un único worker si PROCESSING_SCHEDULER_ENABLED está activo"""
+    from app_simple_working import app, init_complete_service
+
+    if not app.config['PROCESSING_SCHEDULER_ENABLED']:
+        return
+
+    lock_file = open(SCHEDULER_LOCK_PATH, 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        worker.log.info(f"Planificador activo en otro worker, este worker (pid {worker.pid}) solo atiende requests")
+        return
+
+    # El lock se libera solo cuando el proceso termina
+    worker.scheduler_lock_file = lock_file
+    worker.log.info(f"Planificador de procesamiento activo en el worker pid {worker.pid}")
+    init_complete_service(start_scheduler=True)
+
+
+def worker_exit(server, worker):
+    """Detiene el planificador del worker que lo tenía"""
+    if getattr(worker, 'scheduler_lock_file', None) is None:
+        return
+
+    import app_simple_working
+    if app_simple_working.tracking_service_complete:
+        app_simple_working.tracking_service_complete.stop_processing_scheduler()
@@ -0,0 +1,209 @@
+"""
+Proveedores de ubicación GPS y consulta concurrente a varios proveedores.
+
+Cada proveedor devuelve {patente: ubicación} con el mismo formato que usa el
+servicio (patente, latitude, longitude, timestamp, speed, direction). El fan-out
+consulta todos los proveedores a la vez, cada uno con su propio timeout, y
+combina los resultados por patente quedándose con el timestamp más reciente.
+"""
+import logging
+import random
+from abc import ABC, abstractmethod
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+TIMESTAMP_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%d/%m/%Y %H:%M:%S', '%d-%m-%Y %H:%M:%S')
+
+
+def parse_location_timestamp(value) -> Optional[datetime]:
+    """Convierte el timestamp de una ubicación a datetime; None si no se reconoce"""
+    if isinstance(value, datetime):
+        return value
+    if not value:
+        return None
+
+    text = str(value).strip()
+    for fmt in TIMESTAMP_FORMATS:
+        try:
+            return datetime.strptime(text[:19], fmt)
+        except ValueError:
+            continue
+    return None
+
+
+class LocationProvider(ABC):
+    """Interfaz de un proveedor de ubicaciones"""
+
+    def __init__(self, name: str, timeout: float = 30):
+        """Inicializa el proveedor con su nombre y timeout propio"""
+        self.name = name
+        self.timeout = float(timeout)
+
+    @abstractmethod
+    def fetch(self, trucks: List[Dict]) -> Dict[str, Dict]:
+        """Devuelve {patente: ubicación} para los camiones que el proveedor conoce"""
+
+
+class CallableLocationProvider(LocationProvider):
+    """Proveedor que delega en una función fetch(trucks) (p. ej. la integración Boltrack del servicio)"""
+
+    def __init__(self, name: str, fetch_function: Callable[[List[Dict]], Dict[str, Dict]], timeout: float = 30):
+        super().__init__(name, timeout)
+        self.fetch_function = fetch_function
+
+    def fetch(self, trucks: List[Dict]) -> Dict[str, Dict]:
+        return self.fetch_function(trucks)
+
+
+class FakeLocationProvider(LocationProvider):
+    """Proveedor local con ubicaciones sintéticas, para pruebas y benchmarks"""
+
+    def __init__(self, name: str = 'fake', timeout: float = 5, delay: float = 0.0, failure_rate: float = 0.0,
+                 coverage: float = 1.0, center=(-17.7833, -63.1821), spread_deg: float = 0.5,
+                 timestamp_offset_seconds: float = 0, seed: Optional[int] = None):
+        """Configura demora, tasa de fallos, cobertura y zona de las ubicaciones generadas"""
+        super().__init__(name, timeout)
+        self.delay = float(delay)
+        self.failure_rate = float(failure_rate)
+        self.coverage = float(coverage)
+        self.center = tuple(center)
+        self.spread_deg = float(spread_deg)
+        self.timestamp_offset_seconds = float(timestamp_offset_seconds)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def fetch(self, trucks: List[Dict]) -> Dict[str, Dict]:
+        if self.delay:
+            time.sleep(self.delay)
+
+        with self.lock:
+            if self.random.random() < self.failure_rate:
+                raise ConnectionError(f"Fallo simulado en proveedor {self.name}")
+
+            timestamp = (datetime.now() - timedelta(seconds=self.timestamp_offset_seconds)).strftime('%Y-%m-%d %H:%M:%S')
+            locations = {}
+            for truck in trucks:
+                if self.random.random() >= self.coverage:
+                    continue
+                patente = truck['patente']
+                locations[patente] = {
+                    'patente': patente,
+                    'latitude': self.center[0] + self.random.uniform(-self.spread_deg, self.spread_deg),
+                    'longitude': self.center[1] + self.random.uniform(-self.spread_deg, self.spread_deg),
+                    'timestamp': timestamp,
+                    'speed': round(self.random.uniform(0, 90), 1),
+                    'direction': self.random.randint(0, 359)
+                }
+            return locations
+
+
+class LocationProviderFanOut:
+    """Consulta varios proveedores en paralelo y combina sus ubicaciones"""
+
+    def __init__(self, providers: List[LocationProvider]):
+        """Inicializa el pool de hilos; un proveedor lento no bloquea a los demás"""
+        self.providers = list(providers)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, 2 * len(self.providers)),
+                                           thread_name_prefix='location-provider')
+        # in_flight y stats se comparten entre ciclos concurrentes (planificador y refrescos)
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.stats = {provider.name: {
+            'calls': 0, 'successes': 0, 'failures': 0, 'timeouts': 0, 'busy': 0,
+            'last_count': 0, 'last_latency_ms': None, 'last_error': None
+        } for provider in self.providers}
+
+    def _timed_fetch(self, provider: LocationProvider, trucks: List[Dict]):
+        """Ejecuta fetch midiendo su latencia"""
+        started = time.perf_counter()
+        locations = provider.fetch(trucks)
+        return locations, (time.perf_counter() - started) * 1000
+
+    def fetch(self, trucks: List[Dict]) -> Dict[str, Dict]:
+        """Consulta todos los proveedores a la vez y devuelve la mezcla por patente"""
+        started = time.monotonic()
+        futures = []
+
+        for provider in self.providers:
+            with self.lock:
+                stats = self.stats[provider.name]
+                previous = self.in_flight.get(provider.name)
+                # Si la llamada anterior sigue colgada no se acumula otra encima
+                if previous is not None and not previous.done():
+                    stats['busy'] += 1
+                    busy = True
+                else:
+                    stats['calls'] += 1
+                    future = self.executor.submit(self._timed_fetch, provider, trucks)
+                    self.in_flight[provider.name] = future
+                    busy = False
+
+            if busy:
+                logger.warning(f"⚠️ Proveedor {provider.name} sigue ocupado con la llamada anterior, se omite")
+                continue
+            futures.append((provider, future))
+
+        results = []
+        for provider, future in futures:
+            stats = self.stats[provider.name]
+            remaining = max(0.0, started + provider.timeout - time.monotonic())
+            try:
+                locations, latency_ms = future.result(timeout=remaining)
+            except FutureTimeoutError:
+                with self.lock:
+                    stats['timeouts'] += 1
+                logger.warning(f"⚠️ Proveedor {provider.name} superó su timeout de {provider.timeout:.0f}s")
+                continue
+            except Exception as e:
+                with self.lock:
+                    stats['failures'] += 1
+                    stats['last_error'] = str(e)
+                logger.error(f"Error en proveedor de ubicaciones {provider.name}: {e}")
+                continue
+
+            with self.lock:
+                stats['successes'] += 1
+                stats['last_count'] = len(locations)
+                stats['last_latency_ms'] = round(latency_ms, 1)
+            results.append((provider, locations))
+
+        merged = self.merge([locations for _, locations in results])
+        logger.info(f"📡 Proveedores: {len(merged)} ubicaciones de "
+                    f"{', '.join(f'{provider.name}={len(locations)}' for provider, locations in results) or 'ninguno'}")
+        return merged
+
+    @staticmethod
+    def merge(location_sets: List[Dict[str, Dict]]) -> Dict[str, Dict]:
+        """Combina por patente: gana el timestamp más reciente; en empate, el primer proveedor"""
+        merged = {}
+        merged_times = {}
+
+        for locations in location_sets:
+            for patente, location in locations.items():
+                timestamp = parse_location_timestamp(location.get('timestamp'))
+                if patente not in merged:
+                    merged[patente] = location
+                    merged_times[patente] = timestamp
+                    continue
+
+                current = merged_times[patente]
+                if timestamp is not None and (current is None or timestamp > current):
+                    merged[patente] = location
+                    merged_times[patente] = timestamp
+
+        return merged
+
+    def get_stats(self) -> Dict[str, Dict]:
+        """Contadores por proveedor"""
+        with self.lock:
+            return {name: dict(stats) for name, stats in self.stats.items()}
+
+    def shutdown(self):
+        """Libera los hilos del pool"""
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,167 @@
+"""
+Registro de métricas en memoria con salida en formato de texto de Prometheus.
+
+Los histogramas se actualizan en el camino caliente con un lock corto; los
+valores que ya viven en el servicio (snapshot, pools, caches) se leen en el
+momento del scrape mediante colectores registrados, sin consultar la base de
+datos.
+"""
+import threading
+from typing import Callable, Dict, Iterable, List, Tuple
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value) -> str:
+    """Escapa un valor de etiqueta según el formato de texto"""
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels: Dict) -> str:
+    """{a="1",b="2"} o cadena vacía"""
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _format_value(value) -> str:
+    """Número en el formato que espera Prometheus"""
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Histograma con etiquetas y buckets acumulativos"""
+
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value: float, **labels):
+        """Registra una observación (en segundos para las latencias)"""
+        key = tuple(str(labels.get(name, '')) for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self) -> List[str]:
+        """Líneas de texto del histograma"""
+        with self._lock:
+            series = {key: {'counts': list(s['counts']), 'sum': s['sum'], 'count': s['count']}
+                      for key, s in self._series.items()}
+
+        lines = []
+        for key, s in sorted(series.items()):
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, s['counts']):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': _format_value(float(bound))})} "
+                             f"{cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': '+Inf'})} {s['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {_format_value(s['sum'])}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {s['count']}")
+        return lines
+
+
+# Familia calculada por un colector: (nombre, tipo, ayuda, [(etiquetas, valor), ...])
+MetricFamily = Tuple[str, str, str, List[Tuple[Dict, float]]]
+
+
+class MetricsRegistry:
+    """Registro de métricas del proceso"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = {}
+
+    def _register(self, metric):
+        """Registra una métrica; si ya existe con ese nombre devuelve la existente"""
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def histogram(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        """Crea (o devuelve) un histograma"""
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def set_collector(self, name: str, collector: Callable[[], Iterable[MetricFamily]]):
+        """Registra (o reemplaza) un colector que calcula familias al momento del scrape"""
+        with self._lock:
+            self._collectors[name] = collector
+
+    def render(self) -> str:
+        """Todas las métricas en formato de texto de Prometheus"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+            collectors = list(self._collectors.values())
+
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            lines.extend(metric.render())
+
+        for collector in collectors:
+            try:
+                families = list(collector())
+            except Exception as e:
+                lines.append(f"# Error en colector: {_escape(e)}")
+                continue
+
+            for name, type_name, documentation, samples in families:
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {type_name}")
+                for labels, value in samples:
+                    if value is None:
+                        continue
+                    lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUEST_DURATION = REGISTRY.histogram(
+    'http_request_duration_seconds', 'Latencia de las rutas Flask/flask-restx',
+    ('method', 'route', 'status'))
+
+BOLTRACK_REQUEST_DURATION = REGISTRY.histogram(
+    'boltrack_api_request_duration_seconds', 'Latencia de cada intento de llamada a la API de Boltrack',
+    ('path', 'outcome'))
+
+SQL_QUERY_DURATION = REGISTRY.histogram(
+    'sql_query_duration_seconds', 'Latencia de las sentencias SQL por familia (verbo y tabla)',
+    ('family',))
+
+PROCESSING_STAGE_DURATION = REGISTRY.histogram(
+    'processing_stage_duration_seconds', 'Duración de cada etapa del ciclo de procesamiento',
+    ('stage',))
+
+PROCESSING_RUN_DURATION = REGISTRY.histogram(
+    'processing_run_duration_seconds', 'Duración total de cada corrida de procesamiento',
+    ('status',), buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1200))
@@ -0,0 +1,220 @@
+"""
+Planificador del procesamiento periódico de la flota.
+
+Un único hilo ejecuta el procesamiento cada `interval_seconds` y atiende los
+disparos manuales a través de una cola de un solo lugar: si ya hay un trabajo
+esperando, los disparos nuevos se suman a ese mismo trabajo en vez de apilar
+hilos. Los ciclos programados que no se pudieron ejecutar (porque el anterior
+seguía corriendo) se cuentan como omitidos, y los que duran más que el
+intervalo como desbordados.
+
+Los procesos que no tienen el ciclo periódico activo pueden ejecutar trabajos
+sueltos con run_once(), que usa la misma cola y el mismo historial.
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessingScheduler:
+    """Ejecuta el procesamiento con cadencia fija y una cola de un lugar para disparos manuales"""
+
+    def __init__(self, process_function: Callable[[], None], interval_seconds: float = 300,
+                 history_size: int = 100):
+        """Inicializa el planificador; el hilo arranca con start()"""
+        self.process_function = process_function
+        self.interval_seconds = max(1.0, float(interval_seconds))
+        self.history_size = int(history_size)
+
+        self._lock = threading.Lock()
+        self._finished = threading.Condition(self._lock)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._draining = False
+        self.pending = None
+        self.running = None
+        self.next_run_at = None
+        self.jobs = OrderedDict()
+        self.stats = {
+            'runs': 0,
+            'scheduled': 0,
+            'manual': 0,
+            'deduplicated': 0,
+            'skipped': 0,
+            'overruns': 0,
+            'failures': 0,
+            'last_duration_s': None
+        }
+
+    def _new_job(self, trigger: str) -> Dict:
+        """Crea un trabajo en cola y lo guarda en el historial acotado"""
+        job = {
+            'job_id': uuid.uuid4().hex[:12],
+            'trigger': trigger,
+            'status': 'queued',
+            'requests': 1,
+            'queued_at': datetime.now().isoformat(),
+            'started_at': None,
+            'finished_at': None,
+            'duration_s': None,
+            'error': None
+        }
+        self.jobs[job['job_id']] = job
+        while len(self.jobs) > self.history_size:
+            self.jobs.popitem(last=False)
+        return job
+
+    def is_running(self) -> bool:
+        """Indica si el hilo del planificador está activo"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> Optional[Dict]:
+        """Inicia el hilo y devuelve el primer trabajo, que corre de inmediato (None si ya estaba activo)"""
+        if self.is_running():
+            return None
+
+        self._stop.clear()
+        # El primer ciclo queda en cola antes de arrancar el hilo
+        job, _ = self.enqueue('scheduled')
+        self._thread = threading.Thread(target=self._loop, name='processing-scheduler', daemon=True)
+        self._thread.start()
+        logger.info(f"🔄 Planificador de procesamiento iniciado (cada {self.interval_seconds:.0f}s)")
+        return job
+
+    def stop(self):
+        """Detiene el hilo al terminar el trabajo en curso"""
+        self._stop.set()
+        self._wakeup.set()
+
+    def enqueue(self, trigger: str = 'manual') -> Tuple[Dict, bool]:
+        """Encola un procesamiento; devuelve (trabajo, creado) y reutiliza el que ya esté en cola"""
+        with self._lock:
+            if self.pending is not None:
+                self.pending['requests'] += 1
+                self.stats['deduplicated'] += 1
+                return dict(self.pending), False
+
+            self.pending = self._new_job(trigger)
+            self.stats[trigger] = self.stats.get(trigger, 0) + 1
+            job = dict(self.pending)
+
+        self._wakeup.set()
+        return job, True
+
+    def run_once(self, trigger: str = 'manual') -> Tuple[Dict, bool]:
+        """Encola un procesamiento y, si el ciclo periódico no está activo, lo ejecuta en un hilo propio"""
+        job, created = self.enqueue(trigger)
+        if self.is_running():
+            return job, created
+
+        with self._lock:
+            if self._draining:
+                return job, created
+            self._draining = True
+
+        threading.Thread(target=self._drain, name='processing-once', daemon=True).start()
+        return job, created
+
+    def _drain(self):
+        """Hilo de run_once: ejecuta la cola hasta vaciarla y termina"""
+        while True:
+            self._run_pending()
+            with self._lock:
+                if self.pending is None:
+                    self._draining = False
+                    return
+
+    def get_job(self, job_id: str) -> Optional[Dict]:
+        """Estado de un trabajo del historial (None si no existe o ya salió del historial)"""
+        with self._lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def wait_for(self, job_id: str, timeout: float = None) -> Optional[Dict]:
+        """Espera a que un trabajo termine y devuelve su estado final (o el actual si vence el timeout)"""
+        with self._finished:
+            self._finished.wait_for(
+                lambda: self.jobs.get(job_id, {}).get('status') not in ('queued', 'running'), timeout)
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def _loop(self):
+        """Bucle del hilo: espera al próximo ciclo o a un disparo manual y ejecuta la cola"""
+        next_tick = time.monotonic() + self.interval_seconds
+        self.next_run_at = time.time() + self.interval_seconds
+        self._run_pending()
+
+        while not self._stop.is_set():
+            self._wakeup.wait(max(0.0, next_tick - time.monotonic()))
+            self._wakeup.clear()
+            if self._stop.is_set():
+                break
+
+            now = time.monotonic()
+            if now >= next_tick:
+                # Ticks que pasaron mientras corría el ciclo anterior: se omiten, no se acumulan
+                missed = int((now - next_tick) // self.interval_seconds)
+                if missed:
+                    with self._lock:
+                        self.stats['skipped'] += missed
+                    logger.warning(f"⚠️ {missed} ciclo(s) programado(s) omitido(s) por procesamiento en curso")
+                next_tick += (missed + 1) * self.interval_seconds
+                self.next_run_at = time.time() + (next_tick - now)
+                self.enqueue('scheduled')
+
+            self._run_pending()
+
+    def _run_pending(self):
+        """Ejecuta el trabajo en cola, si hay uno"""
+        with self._lock:
+            job = self.pending
+            if job is None:
+                return
+            self.pending = None
+            self.running = job
+            job['status'] = 'running'
+            job['started_at'] = datetime.now().isoformat()
+
+        started = time.monotonic()
+        status, error = 'done', None
+        try:
+            self.process_function()
+        except Exception as e:
+            status, error = 'failed', str(e)
+            logger.error(f"Error en procesamiento programado {job['job_id']}: {e}")
+
+        duration = time.monotonic() - started
+        with self._lock:
+            job['status'] = status
+            job['error'] = error
+            job['finished_at'] = datetime.now().isoformat()
+            job['duration_s'] = round(duration, 2)
+            self.running = None
+            self.stats['runs'] += 1
+            self.stats['last_duration_s'] = round(duration, 2)
+            if status == 'failed':
+                self.stats['failures'] += 1
+            if duration > self.interval_seconds:
+                self.stats['overruns'] += 1
+                logger.warning(f"⚠️ Procesamiento {job['job_id']} duró {duration:.1f}s, "
+                               f"más que el intervalo de {self.interval_seconds:.0f}s")
+            self._finished.notify_all()
+
+    def get_stats(self) -> Dict:
+        """Contadores y estado actual para health checks"""
+        with self._lock:
+            return {
+                **self.stats,
+                'interval_seconds': self.interval_seconds,
+                'active': self.is_running(),
+                'pending_job': self.pending['job_id'] if self.pending else None,
+                'running_job': self.running['job_id'] if self.running else None,
+                'next_run_at': datetime.fromtimestamp(self.next_run_at).isoformat() if self.next_run_at else None
+            }
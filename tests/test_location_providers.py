@@ -0,0 +1,78 @@
+"""
+Pruebas del fan-out de proveedores de ubicación con FakeLocationProvider.
+"""
+from datetime import datetime, timedelta
+
+import pytest
+
+from location_providers import (FakeLocationProvider, LocationProvider, LocationProviderFanOut,
+                                parse_location_timestamp)
+
+TRUCKS = [{'patente': f'{1000 + i}ABC'} for i in range(20)]
+
+
+@pytest.fixture
+def fan_out_factory():
+    """Crea fan-outs y libera sus hilos al terminar la prueba"""
+    created = []
+
+    def factory(*providers):
+        fan_out = LocationProviderFanOut(list(providers))
+        created.append(fan_out)
+        return fan_out
+
+    yield factory
+    for fan_out in created:
+        fan_out.shutdown()
+
+
+def test_location_provider_is_abstract():
+    with pytest.raises(TypeError):
+        LocationProvider('incompleto')
+
+
+def test_fan_out_merges_by_most_recent_timestamp(fan_out_factory):
+    old = FakeLocationProvider('antiguo', timestamp_offset_seconds=600, seed=1)
+    new = FakeLocationProvider('reciente', coverage=0.5, seed=2)
+    fan_out = fan_out_factory(old, new)
+
+    locations = fan_out.fetch(TRUCKS)
+    stats = fan_out.get_stats()
+
+    # Todas las patentes llegan; las que cubre el proveedor reciente usan su ubicación
+    assert set(locations) == {truck['patente'] for truck in TRUCKS}
+    assert stats['antiguo']['successes'] == stats['reciente']['successes'] == 1
+    cutoff = datetime.now() - timedelta(seconds=300)
+    recent = [patente for patente, location in locations.items()
+              if parse_location_timestamp(location['timestamp']) > cutoff]
+    assert len(recent) == stats['reciente']['last_count'] > 0
+
+
+def test_fan_out_skips_slow_provider_after_its_timeout(fan_out_factory):
+    fast = FakeLocationProvider('rapido', seed=1)
+    slow = FakeLocationProvider('lento', timeout=0.1, delay=0.5, seed=2)
+    fan_out = fan_out_factory(fast, slow)
+
+    locations = fan_out.fetch(TRUCKS)
+    assert len(locations) == len(TRUCKS)
+    assert fan_out.get_stats()['lento']['timeouts'] == 1
+
+    # La llamada colgada no se apila: el siguiente ciclo omite al proveedor ocupado
+    fan_out.fetch(TRUCKS)
+    stats = fan_out.get_stats()['lento']
+    assert stats['busy'] == 1
+    assert stats['calls'] == 1
+
+
+def test_fan_out_returns_partial_results_when_a_provider_fails(fan_out_factory):
+    healthy = FakeLocationProvider('sano', coverage=0.5, seed=1)
+    broken = FakeLocationProvider('caido', failure_rate=1.0, seed=2)
+    fan_out = fan_out_factory(healthy, broken)
+
+    locations = fan_out.fetch(TRUCKS)
+    stats = fan_out.get_stats()
+
+    assert 0 < len(locations) < len(TRUCKS)
+    assert len(locations) == stats['sano']['last_count']
+    assert stats['caido']['failures'] == 1
+    assert 'Fallo simulado' in stats['caido']['last_error']
@@ -0,0 +1,145 @@
+"""
+Pruebas de la escritura en lote de truck_tracking y latest_trip: cada lote viaja como un solo INSERT multi-fila.
+"""
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+import pymysql
+import pytest
+
+from truck_tracking_web_complete import TruckTrackingWebServiceComplete
+
+
+class RecordingCursor(pymysql.cursors.Cursor):
+    """Cursor real de pymysql que registra las sentencias en vez de enviarlas"""
+
+    def _query(self, q):
+        self.connection.statements.append(bytes(q).decode() if isinstance(q, (bytes, bytearray)) else q)
+        return 1
+
+
+class RecordingConnection(pymysql.connections.Connection):
+    """Conexión sin servidor: solo escapa valores y junta las sentencias enviadas"""
+
+    def __init__(self):
+        super().__init__(defer_connect=True, charset='utf8mb4')
+        self.server_status = 0
+        self.statements = []
+
+    def cursor(self, cursor=None):
+        return RecordingCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class RecordingPool:
+    def __init__(self):
+        self.conn = RecordingConnection()
+
+    @contextmanager
+    def connection(self):
+        yield self.conn
+
+    def close_all(self):
+        pass
+
+
+@pytest.fixture
+def service():
+    service = TruckTrackingWebServiceComplete.__new__(TruckTrackingWebServiceComplete)
+    service.config = {'tracking_unchanged_refresh_seconds': 0, 'tracking_batch_size': 500}
+    service.source_pool = RecordingPool()
+    service.target_pool = RecordingPool()
+    service.written_tracking_rows = {}
+    service.written_tracking_stats = {'written': 0, 'skipped': 0}
+    service.latest_trip_state = {'enabled': True, 'last_error': None}
+    return service
+
+
+def tracking_row(i):
+    return (
+        'C1', 'ORIGEN', 'D1', 'DESTINO', f'PL{i}', f'{1000 + i}ABC',
+        date(2026, 1, 1), timedelta(hours=8), None, None, 'P1', 'PRODUCTO',
+        -17.78, -63.18, 40.0, 'N',
+        None, None, None, None,
+        50.0, 'EN_CAMINO', 'SALIDA', 'SI',
+        0, 'EN_TRANSITO', None, 'NORMAL'
+    )
+
+
+def test_tracking_batch_is_sent_as_one_multi_row_insert(service):
+    rows = [tracking_row(i) for i in range(3)]
+
+    assert service._save_truck_tracking_batch(rows) == 3
+
+    statements = service.target_pool.conn.statements
+    assert len(statements) == 1
+    assert statements[0].lstrip().startswith('INSERT INTO truck_tracking')
+    assert statements[0].count('ON DUPLICATE KEY UPDATE') == 1
+    for row in rows:
+        assert f"'{row[5]}'" in statements[0]
+
+
+def test_latest_trip_batch_is_sent_as_one_multi_row_insert(service):
+    latest = {}
+    for i in range(3):
+        row = dict(zip(TruckTrackingWebServiceComplete.TRIP_COLUMNS, tracking_row(i)[:12] + ('SALIDA', 'SI')))
+        row['source_id'] = i
+        service._keep_latest_trip(latest, row)
+
+    with service.target_pool.conn.cursor() as cursor:
+        assert service._write_latest_trips(cursor, latest, generation=1, full=True) == 3
+
+    statements = service.target_pool.conn.statements
+    assert len(statements) == 1
+    assert statements[0].lstrip().startswith('INSERT INTO latest_trip')
+    assert statements[0].count('ON DUPLICATE KEY UPDATE') == 1
+
+
+class ColumnsCursor:
+    def __init__(self, columns):
+        self.columns = columns
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, query, args=None):
+        pass
+
+    def fetchall(self):
+        return [{'Field': column} for column in self.columns]
+
+
+class ColumnsPool(RecordingPool):
+    def __init__(self, columns):
+        self.columns = columns
+
+    @contextmanager
+    def connection(self):
+        yield self
+
+    def cursor(self, cursor=None):
+        return ColumnsCursor(self.columns)
+
+
+def test_latest_trip_disabled_when_key_column_is_missing(service):
+    service.source_pool = ColumnsPool(['planilla', 'patente', 'fecha_salida', 'hora_salida', 'status'])
+
+    assert service._check_latest_trip_source() is False
+    assert service.latest_trip_state['enabled'] is False
+    assert 'latest_trip_key_column' in service.latest_trip_state['last_error']
+
+
+def test_latest_trip_source_check_accepts_configured_columns(service):
+    service.config['latest_trip_key_column'] = 'planilla'
+    service.source_pool = ColumnsPool(['planilla', 'patente', 'fecha_salida', 'hora_salida', 'status'])
+
+    assert service._check_latest_trip_source() is True
+    assert service.latest_trip_state['enabled'] is True
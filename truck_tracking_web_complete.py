@@ -1,42 +1,180 @@
 # truck_tracking_web_service_complete.py - Servicio completo para web
 import pandas as pd
-from datetime import datetime, timedelta
+import numpy as np
+from datetime import date, datetime, timedelta
 import logging
 import threading
 import os
-import pymysql
-import requests
-from shapely.geometry import Point, Polygon
+import shapely
+from shapely import STRtree
+from shapely.geometry import Polygon
 import json
+import hashlib
+import pickle
+import tempfile
 from typing import List, Dict, Tuple, Optional
 import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import replace
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from boltrack_client import BoltrackClient, CircuitOpenError, iter_json_array, iter_response_text
+from connection_pool import InstrumentedSSDictCursor, MySQLConnectionPool
+from fleet_snapshot import FleetSnapshot, empty_alerts
+from geofence_set import GeofenceSet
+from metrics import PROCESSING_RUN_DURATION, PROCESSING_STAGE_DURATION
+from processing_scheduler import ProcessingScheduler
+from location_providers import (CallableLocationProvider, FakeLocationProvider, LocationProvider,
+                                LocationProviderFanOut)
 
 logger = logging.getLogger(__name__)
 
+# Variantes de la consulta de camiones en tránsito (último viaje por patente con status SALIDA).
+# Se elige con config['in_transit_query']; benchmark_in_transit.py mide las tres.
+# Todas conservan los empates en (fecha_salida, hora_salida) y ordenan NULL como el valor más bajo,
+# igual que ORDER BY ... DESC en MySQL: un viaje sin fecha u hora solo es el último si no hay otro con ella.
+IN_TRANSIT_COLUMNS = """cod, deposito_origen, cod_destino, deposito_destino,
+                       planilla, patente, fecha_salida, hora_salida,
+                       fecha_llegada, hora_llegada, cod_producto, producto,
+                       status, salida"""
+
+IN_TRANSIT_QUERIES = {
+    # Original: antijoin correlacionado contra toda la tabla
+    'not_exists': """
+    SELECT t1.cod, t1.deposito_origen, t1.cod_destino, t1.deposito_destino, 
+           t1.planilla, t1.patente, t1.fecha_salida, t1.hora_salida, 
+           t1.fecha_llegada, t1.hora_llegada, t1.cod_producto, t1.producto,
+           t1.status, t1.salida
+    FROM trucks t1
+    WHERE t1.status = 'SALIDA'
+      AND NOT EXISTS (
+        SELECT 1 
+        FROM trucks t2 
+        WHERE t2.patente = t1.patente 
+          AND (
+            t2.fecha_salida > t1.fecha_salida
+            OR (t2.fecha_salida IS NOT NULL AND t1.fecha_salida IS NULL)
+            OR (t2.fecha_salida <=> t1.fecha_salida
+                AND (t2.hora_salida > t1.hora_salida
+                     OR (t2.hora_salida IS NOT NULL AND t1.hora_salida IS NULL)))
+          )
+      )
+    ORDER BY t1.fecha_salida DESC, t1.hora_salida DESC
+    """,
+
+    # Función de ventana (MySQL 8+); RANK en lugar de ROW_NUMBER para conservar empates
+    'window': f"""
+    SELECT {IN_TRANSIT_COLUMNS}
+    FROM (
+        SELECT {IN_TRANSIT_COLUMNS},
+               RANK() OVER (PARTITION BY patente ORDER BY fecha_salida DESC, hora_salida DESC) AS rn
+        FROM trucks
+    ) ranked
+    WHERE ranked.rn = 1 AND ranked.status = 'SALIDA'
+    ORDER BY fecha_salida DESC, hora_salida DESC
+    """,
+
+    # Máximo agrupado en dos pasos: última fecha por patente y última hora dentro de esa fecha.
+    # MAX ignora NULL y devuelve NULL solo si no hay otro valor; los joins usan <=> para casar esos NULL.
+    'grouped_max': """
+    SELECT t1.cod, t1.deposito_origen, t1.cod_destino, t1.deposito_destino,
+           t1.planilla, t1.patente, t1.fecha_salida, t1.hora_salida,
+           t1.fecha_llegada, t1.hora_llegada, t1.cod_producto, t1.producto,
+           t1.status, t1.salida
+    FROM trucks t1
+    JOIN (
+        SELECT f.patente, f.fecha_salida, MAX(h.hora_salida) AS hora_salida
+        FROM (
+            SELECT patente, MAX(fecha_salida) AS fecha_salida
+            FROM trucks
+            GROUP BY patente
+        ) f
+        JOIN trucks h ON h.patente = f.patente AND h.fecha_salida <=> f.fecha_salida
+        GROUP BY f.patente, f.fecha_salida
+    ) latest ON latest.patente = t1.patente
+            AND latest.fecha_salida <=> t1.fecha_salida
+            AND latest.hora_salida <=> t1.hora_salida
+    WHERE t1.status = 'SALIDA'
+    ORDER BY t1.fecha_salida DESC, t1.hora_salida DESC
+    """
+}
+
 
 class TruckTrackingWebServiceComplete:
     """
     Servicio web completo que integra TODA la funcionalidad del sistema original
     """
 
+    # Versión del formato del cache compilado de geocercas
+    GEOCERCAS_CACHE_FORMAT = 1
+
+    # Columnas del viaje que se copian de la tabla trucks de origen
+    TRIP_COLUMNS = ('cod', 'deposito_origen', 'cod_destino', 'deposito_destino', 'planilla', 'patente',
+                    'fecha_salida', 'hora_salida', 'fecha_llegada', 'hora_llegada', 'cod_producto',
+                    'producto', 'status', 'salida')
+
+    # Etapas de un ciclo de procesamiento cuyo tiempo se registra por corrida
+    RUN_STAGES = ('source_query', 'location_fetch', 'historical_update', 'geofence', 'waiting_time',
+                  'db_write', 'alerts')
+
     def __init__(self, config):
         """Inicializa el servicio web completo"""
         self.config = config
-        self.source_connection = None
-        self.target_connection = None
+        self.source_pool = None
+        self.target_pool = None
+        self.api_client = BoltrackClient.from_config(config['api'])
+        # Cliente y circuito propios para las llamadas por vehículo: sus fallos no abren el de la flota
+        self.vehicle_api_client = BoltrackClient.from_config(
+            config['api'], pool_maxsize=max(8, int(config.get('api_max_in_flight', 8))))
+        self.last_good_locations = {}
+        self.last_good_locations_at = None
+        self.location_fetch_state = {
+            'etag': None,
+            'last_modified': None,
+            'payload_hash': None,
+            'wanted': None,
+            'not_modified': 0,
+            'unchanged_payload': 0,
+            'changed_vehicles': 0,
+            'unchanged_vehicles': 0
+        }
+        self.location_timestamps = {}
+        self.location_providers = self._build_location_providers()
+        self.written_tracking_rows = {}
+        self.written_tracking_stats = {'written': 0, 'skipped': 0}
         self.last_processing_time = None
         self.processing_lock = threading.Lock()
+        self.scheduler = ProcessingScheduler(self.process_all_trucks_complete,
+                                             config.get('processing_interval_seconds', 300))
+        self.processing_runs = deque(maxlen=int(config.get('processing_runs_history', 200)))
+        self.refresh_lock = threading.Lock()
+        self.refresh_event = None
+        self.refresh_last_attempt = None
+        self.refresh_stats = {'refreshes': 0, 'coalesced': 0, 'stale_served': 0, 'wait_timeouts': 0}
 
         # DATOS Y CACHE
-        self.geocercas = {}
+        # Geocercas publicadas: una recarga arma otro GeofenceSet y reemplaza la referencia
+        self.geofences = GeofenceSet()
+        self.geofences_lock = threading.Lock()
+        self.geocerca_memo = {}
+        self.geocerca_memo_stats = {'reused': 0, 'evaluated': 0}
+        self.geocerca_lru_lock = threading.Lock()
+        self.geocerca_lru_stats = {'hits': 0, 'misses': 0, 'edge': 0}
+        self.geocerca_grid_stats = {'resolved': 0, 'boundary': 0}
         self.historical_data = {}
-        self.results_data = []
-        self.cache = {
-            'trucks_data': [],
-            'alerts': {},
-            'stats': {},
-            'last_update': None
+        self.latest_trip_state = {
+            'enabled': bool(config.get('latest_trip_enabled', False)),
+            'watermark': None,
+            'last_sync': None,
+            'last_full_sync': None,
+            'last_rows': 0,
+            'last_duration_ms': None,
+            'last_error': None
         }
+        # Estado publicado: se reemplaza entero en cada ciclo, nunca se modifica
+        self.snapshot = FleetSnapshot()
 
         # Configuración igual que original
         self.geocerca_hierarchy = ['DOCKS', 'TRACK AND TRACE', 'CBN', 'CIUDADES']
@@ -71,6 +209,46 @@ class TruckTrackingWebServiceComplete:
         # Inicializar sistema
         self._init_system()
 
+    @property
+    def cache(self) -> Dict:
+        """Vista de solo lectura del snapshot actual con la forma del antiguo cache"""
+        return self.snapshot.as_cache()
+
+    @property
+    def results_data(self) -> List[Dict]:
+        """Filas del Excel del último snapshot publicado"""
+        return list(self.snapshot.results_data)
+
+    @property
+    def geocercas(self) -> Dict:
+        """Geocercas por grupo del conjunto publicado"""
+        return self.geofences.geocercas
+
+    @property
+    def geocerca_index(self) -> Dict:
+        """Índice STRtree por grupo del conjunto publicado"""
+        return self.geofences.index
+
+    @property
+    def geocerca_tree(self) -> Dict:
+        """Grafo de jerarquía del conjunto publicado"""
+        return self.geofences.tree
+
+    @property
+    def deposito_geocerca_index(self) -> Dict:
+        """Mapeo (depósito, grupo) -> ids del conjunto publicado"""
+        return self.geofences.deposito_index
+
+    @property
+    def geocerca_grid(self) -> Dict:
+        """Grilla del motor 'grid' del conjunto publicado (vacía si no se usa)"""
+        return self.geofences.grid
+
+    @property
+    def geocerca_lru(self):
+        """Cache LRU por coordenadas del conjunto publicado"""
+        return self.geofences.lru
+
     def _init_system(self):
         """Inicializa el sistema completo"""
         try:
@@ -99,26 +277,33 @@ class TruckTrackingWebServiceComplete:
     def connect_databases(self):
         """Conecta a ambas bases de datos"""
         try:
-            # Conexión a BD de origen
-            self.source_connection = pymysql.connect(
-                cursorclass=pymysql.cursors.DictCursor,
-                **self.config['source_db']
-            )
-            logger.info("Conexión exitosa a BD de origen")
+            pool_options = {
+                'max_size': self.config.get('db_pool_size', 5),
+                'max_lifetime': self.config.get('db_pool_max_lifetime', 3600),
+                'checkout_timeout': self.config.get('db_pool_timeout', 30)
+            }
 
-            # Conexión a BD de destino
-            self.target_connection = pymysql.connect(
-                cursorclass=pymysql.cursors.DictCursor,
-                **self.config['target_db']
-            )
-            logger.info("Conexión exitosa a BD de destino")
+            # Pool de BD de origen (verifica con una primera conexión)
+            self.source_pool = MySQLConnectionPool(self.config['source_db'], name='origen', **pool_options)
+            with self.source_pool.connection():
+                logger.info("Conexión exitosa a BD de origen")
+
+            # Pool de BD de destino
+            self.target_pool = MySQLConnectionPool(self.config['target_db'], name='destino', **pool_options)
+            with self.target_pool.connection():
+                logger.info("Conexión exitosa a BD de destino")
 
             # Crear tabla de tracking si no existe
             self._create_tracking_table()
+            self._create_processing_runs_table()
 
             # AGREGAR ESTA LÍNEA:
             self._update_table_structure()
 
+            # Espejo incremental del último viaje por camión
+            if self.latest_trip_state['enabled'] and self._check_latest_trip_source():
+                self._create_latest_trip_tables()
+
             return True
 
         except Exception as e:
@@ -128,7 +313,7 @@ class TruckTrackingWebServiceComplete:
     def _create_tracking_table(self):
         """Crea tabla básica (simplificada para que funcione)"""
         try:
-            with self.target_connection.cursor() as cursor:
+            with self.target_pool.connection() as connection, connection.cursor() as cursor:
                 create_table_query = """
                 CREATE TABLE IF NOT EXISTS truck_tracking (
                     id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
@@ -148,7 +333,7 @@ class TruckTrackingWebServiceComplete:
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
                 """
                 cursor.execute(create_table_query)
-                self.target_connection.commit()
+                connection.commit()
                 logger.info("Tabla truck_tracking verificada/creada")
         except Exception as e:
             logger.error(f"Error creando tabla: {e}")
@@ -156,7 +341,7 @@ class TruckTrackingWebServiceComplete:
     def get_last_update_from_db(self):
         """Obtiene último update de BD"""
         try:
-            with self.source_connection.cursor() as cursor:
+            with self.source_pool.connection() as connection, connection.cursor() as cursor:
                 query = "SELECT MAX(created_at) as ultimo_update FROM trucks WHERE status = 'SALIDA'"
                 cursor.execute(query)
                 result = cursor.fetchone()
@@ -275,27 +460,25 @@ class TruckTrackingWebServiceComplete:
         return True
 
     def get_trucks_in_transit(self) -> List[Dict]:
-        """Obtiene camiones en tránsito con validación de último viaje"""
+        """Obtiene camiones en tránsito con validación de último viaje
+
+        Si el origen falla lanza la excepción: una lista vacía significa que
+        realmente no hay camiones en tránsito.
+        """
+        if self.latest_trip_state['enabled']:
+            trucks = self._get_trucks_in_transit_from_mirror()
+            if trucks is not None:
+                return trucks
+            logger.warning("⚠️ Espejo latest_trip no disponible, consultando origen directamente")
+
+        variant = self.config.get('in_transit_query', 'not_exists')
+        if variant not in IN_TRANSIT_QUERIES:
+            logger.warning(f"⚠️ Variante de consulta en tránsito desconocida: {variant}, usando not_exists")
+            variant = 'not_exists'
+
         try:
-            with self.source_connection.cursor() as cursor:
-                query = """
-                SELECT t1.cod, t1.deposito_origen, t1.cod_destino, t1.deposito_destino, 
-                       t1.planilla, t1.patente, t1.fecha_salida, t1.hora_salida, 
-                       t1.fecha_llegada, t1.hora_llegada, t1.cod_producto, t1.producto,
-                       t1.status, t1.salida
-                FROM trucks t1
-                WHERE t1.status = 'SALIDA'
-                  AND NOT EXISTS (
-                    SELECT 1 
-                    FROM trucks t2 
-                    WHERE t2.patente = t1.patente 
-                      AND (
-                        t2.fecha_salida > t1.fecha_salida 
-                        OR (t2.fecha_salida = t1.fecha_salida AND t2.hora_salida > t1.hora_salida)
-                      )
-                  )
-                ORDER BY t1.fecha_salida DESC, t1.hora_salida DESC
-                """
+            with self.source_pool.connection() as connection, connection.cursor() as cursor:
+                query = IN_TRANSIT_QUERIES[variant]
 
                 cursor.execute(query)
                 trucks = cursor.fetchall()
@@ -304,51 +487,595 @@ class TruckTrackingWebServiceComplete:
 
         except Exception as e:
             logger.error(f"Error obteniendo camiones: {e}")
-            return []
+            raise
+
+    def _create_processing_runs_table(self):
+        """Crea la tabla con el historial de corridas y sus tiempos por etapa"""
+        try:
+            with self.target_pool.connection() as connection, connection.cursor() as cursor:
+                stage_columns = ''.join(f"{stage}_ms DECIMAL(12, 1) DEFAULT 0,\n"
+                                        for stage in self.RUN_STAGES)
+                cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS processing_runs (
+                    id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+                    run_id VARCHAR(32) NOT NULL,
+                    started_at DATETIME NOT NULL,
+                    finished_at DATETIME NULL,
+                    duration_ms DECIMAL(12, 1) NULL,
+                    status VARCHAR(20) NOT NULL,
+                    error TEXT NULL,
+                    trucks INT DEFAULT 0,
+                    processed INT DEFAULT 0,
+                    errors INT DEFAULT 0,
+                    skipped INT DEFAULT 0,
+                    rows_written INT DEFAULT 0,
+                    rows_skipped INT DEFAULT 0,
+                    snapshot_version INT NULL,
+                    {stage_columns}
+                    UNIQUE KEY unique_run_id (run_id),
+                    INDEX idx_started_at (started_at)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+                """)
+                connection.commit()
+                logger.info("Tabla processing_runs verificada/creada")
+
+        except Exception as e:
+            logger.error(f"Error creando tabla processing_runs: {e}")
+
+    def _create_latest_trip_tables(self):
+        """Crea el espejo latest_trip (último viaje de cada patente, con empates) y su estado de sincronización"""
+        try:
+            with self.target_pool.connection() as connection, connection.cursor() as cursor:
+                cursor.execute("""
+                CREATE TABLE IF NOT EXISTS latest_trip (
+                    source_id BIGINT NOT NULL PRIMARY KEY,
+                    patente VARCHAR(255) NOT NULL,
+                    cod VARCHAR(255) NULL,
+                    deposito_origen VARCHAR(255) NULL,
+                    cod_destino VARCHAR(255) NULL,
+                    deposito_destino VARCHAR(255) NULL,
+                    planilla VARCHAR(255) NULL,
+                    fecha_salida DATE NULL,
+                    hora_salida TIME NULL,
+                    fecha_llegada DATE NULL,
+                    hora_llegada TIME NULL,
+                    cod_producto VARCHAR(255) NULL,
+                    producto VARCHAR(255) NULL,
+                    status VARCHAR(50) NULL,
+                    salida INT NULL,
+                    sync_generation INT NOT NULL DEFAULT 0,
+                    sincronizado DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+
+                    INDEX idx_latest_trip_patente (patente),
+                    INDEX idx_latest_trip_status (status, fecha_salida, hora_salida)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+                """)
+
+                cursor.execute("""
+                CREATE TABLE IF NOT EXISTS latest_trip_sync (
+                    id TINYINT UNSIGNED NOT NULL PRIMARY KEY,
+                    watermark VARCHAR(64) NULL,
+                    generation INT NOT NULL DEFAULT 0,
+                    last_sync DATETIME NULL,
+                    last_full_sync DATETIME NULL,
+                    last_rows INT DEFAULT 0,
+                    last_duration_ms INT NULL
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+                """)
+
+                connection.commit()
+                logger.info("Tablas latest_trip verificadas/creadas")
+
+        except Exception as e:
+            logger.error(f"Error creando tablas latest_trip: {e}")
+
+    def _check_latest_trip_source(self) -> bool:
+        """Verifica que trucks tenga las columnas de clave y de cambios del espejo
+
+        La tabla trucks no tiene una clave fija: `latest_trip_key_column` (por
+        defecto id) y `latest_trip_change_column` deben existir en el origen.
+        Si falta alguna se desactiva el espejo y se consulta el origen directamente.
+        """
+        key_column = self.config.get('latest_trip_key_column', 'id')
+        change_column = self.config.get('latest_trip_change_column', key_column)
+
+        try:
+            with self.source_pool.connection() as connection, connection.cursor() as cursor:
+                cursor.execute("SHOW COLUMNS FROM trucks")
+                columns = {row['Field'] for row in cursor.fetchall()}
+
+            missing = [column for column in (key_column, change_column) if column not in columns]
+            if missing:
+                error = (f"trucks no tiene las columnas {', '.join(sorted(set(missing)))}: configure "
+                         f"latest_trip_key_column y latest_trip_change_column")
+                logger.error(f"❌ Espejo latest_trip desactivado: {error}")
+                self.latest_trip_state.update({'enabled': False, 'last_error': error})
+                return False
+            return True
+
+        except Exception as e:
+            logger.error(f"Error verificando columnas de trucks para latest_trip: {e}")
+            self.latest_trip_state.update({'enabled': False, 'last_error': str(e)})
+            return False
+
+    @staticmethod
+    def _trip_order_key(row: Dict) -> Tuple:
+        """Clave de orden de un viaje por (fecha_salida, hora_salida); NULL es el valor más bajo"""
+        fecha, hora = row['fecha_salida'], row['hora_salida']
+        return (fecha is not None, fecha or date.min, hora is not None, hora or timedelta(0))
+
+    def _keep_latest_trip(self, latest: Dict, row: Dict):
+        """Acumula en latest {patente: (clave, {source_id: fila})} solo los viajes más recientes, con empates"""
+        if not row['patente']:
+            return
+
+        key = self._trip_order_key(row)
+        current = latest.get(row['patente'])
+        if current is None or key > current[0]:
+            latest[row['patente']] = (key, {row['source_id']: row})
+        elif key == current[0]:
+            current[1][row['source_id']] = row
+
+    def _write_latest_trips(self, cursor, latest: Dict, generation: int, full: bool) -> int:
+        """Escribe en el espejo los viajes acumulados; devuelve las filas escritas
+
+        En una resincronización completa se escribe todo (lo que no llegó se borra
+        después por generación). En una incremental se compara con lo que ya tiene
+        el espejo para cada patente: un viaje más reciente reemplaza a los
+        anteriores, uno empatado se suma y uno más antiguo se descarta.
+        """
+        write_columns = ('source_id',) + self.TRIP_COLUMNS + ('sync_generation',)
+        upsert_query = f"""
+        INSERT INTO latest_trip ({', '.join(write_columns)})
+        VALUES ({', '.join(['%s'] * len(write_columns))})
+        ON DUPLICATE KEY UPDATE
+            {', '.join(f'{c} = VALUES({c})' for c in write_columns if c != 'source_id')}
+        """
+        batch_size = int(self.config.get('latest_trip_batch_size', 1000))
+
+        rows_to_write = []
+        ids_to_delete = []
+        patentes = list(latest.keys())
+
+        if full:
+            for _, trips in latest.values():
+                rows_to_write.extend(trips.values())
+        else:
+            mirror = {}
+            for i in range(0, len(patentes), batch_size):
+                chunk = patentes[i:i + batch_size]
+                cursor.execute(f"""
+                SELECT source_id, patente, fecha_salida, hora_salida
+                FROM latest_trip
+                WHERE patente IN ({', '.join(['%s'] * len(chunk))})
+                """, chunk)
+                for row in cursor.fetchall():
+                    mirror.setdefault(row['patente'], []).append(row)
+
+            for patente, (key, trips) in latest.items():
+                # Las filas que vuelven a llegar se comparan con su versión nueva, no con la guardada
+                others = [row for row in mirror.get(patente, []) if row['source_id'] not in trips]
+                mirror_key = max((self._trip_order_key(row) for row in others), default=None)
+
+                if mirror_key is None or key >= mirror_key:
+                    if mirror_key is not None and key > mirror_key:
+                        ids_to_delete.extend(row['source_id'] for row in others)
+                    rows_to_write.extend(trips.values())
+                else:
+                    # Viaje que dejó de ser el último (p. ej. se corrigió su fecha)
+                    ids_to_delete.extend(row['source_id'] for row in mirror.get(patente, [])
+                                         if row['source_id'] in trips)
+
+        for i in range(0, len(ids_to_delete), batch_size):
+            chunk = ids_to_delete[i:i + batch_size]
+            cursor.execute(f"DELETE FROM latest_trip WHERE source_id IN ({', '.join(['%s'] * len(chunk))})",
+                           chunk)
+
+        for i in range(0, len(rows_to_write), batch_size):
+            cursor.executemany(upsert_query, [
+                (row['source_id'],) + tuple(row[c] for c in self.TRIP_COLUMNS) + (generation,)
+                for row in rows_to_write[i:i + batch_size]
+            ])
+
+        return len(rows_to_write)
+
+    def sync_latest_trip(self, full: bool = False) -> bool:
+        """Sincroniza el espejo latest_trip con la tabla trucks de origen
+
+        La lectura incremental usa una columna de cambios del origen
+        (`latest_trip_change_column`, por defecto la clave `latest_trip_key_column`,
+        que a su vez es id; ambas se verifican al conectar) y además relee por clave los viajes en tránsito del espejo, para ver
+        cambios de status y filas borradas. Cada `latest_trip_full_sync_hours`
+        se relee la tabla completa y se borra del espejo lo que ya no existe.
+        """
+        start_time = time.time()
+        full_sync_hours = float(self.config.get('latest_trip_full_sync_hours', 24))
+        batch_size = int(self.config.get('latest_trip_batch_size', 1000))
+        key_column = self.config.get('latest_trip_key_column', 'id')
+        change_column = self.config.get('latest_trip_change_column', key_column)
+
+        try:
+            with self.target_pool.connection() as connection, connection.cursor() as cursor:
+                cursor.execute("SELECT * FROM latest_trip_sync WHERE id = 1")
+                state = cursor.fetchone()
+
+                in_transit_ids = []
+                if state:
+                    cursor.execute("SELECT source_id FROM latest_trip WHERE status = 'SALIDA'")
+                    in_transit_ids = [row['source_id'] for row in cursor.fetchall()]
+
+            if not state or state['watermark'] is None or state['last_full_sync'] is None:
+                full = True
+            elif datetime.now() - state['last_full_sync'] >= timedelta(hours=full_sync_hours):
+                full = True
+
+            select = (f"SELECT {key_column} AS source_id, {change_column} AS change_value, "
+                      f"{', '.join(self.TRIP_COLUMNS)} FROM trucks")
+            latest = {}
+            max_change = None
+            rows_pulled = 0
+            deleted_ids = []
+
+            with self.source_pool.connection() as source_connection:
+                # Cursor sin buffer: una resincronización completa no carga toda la tabla en memoria
+                with source_connection.cursor(InstrumentedSSDictCursor) as source_cursor:
+                    if full:
+                        source_cursor.execute(select)
+                    else:
+                        source_cursor.execute(f"{select} WHERE {change_column} > %s", (state['watermark'],))
+
+                    while True:
+                        rows = source_cursor.fetchmany(batch_size)
+                        if not rows:
+                            break
+
+                        for row in rows:
+                            rows_pulled += 1
+                            if row['change_value'] is not None and (max_change is None
+                                                                    or row['change_value'] > max_change):
+                                max_change = row['change_value']
+                            self._keep_latest_trip(latest, row)
+
+                if not full and in_transit_ids:
+                    found = set()
+                    with source_connection.cursor() as source_cursor:
+                        for i in range(0, len(in_transit_ids), batch_size):
+                            chunk = in_transit_ids[i:i + batch_size]
+                            source_cursor.execute(
+                                f"{select} WHERE {key_column} IN ({', '.join(['%s'] * len(chunk))})", chunk)
+                            for row in source_cursor.fetchall():
+                                found.add(row['source_id'])
+                                self._keep_latest_trip(latest, row)
+                    deleted_ids = [source_id for source_id in in_transit_ids if source_id not in found]
+
+            generation = (state['generation'] if state else 0) + (1 if full else 0)
+            watermark = str(max_change) if max_change is not None else (state['watermark'] if state else None)
+
+            with self.target_pool.connection() as connection, connection.cursor() as cursor:
+                for i in range(0, len(deleted_ids), batch_size):
+                    chunk = deleted_ids[i:i + batch_size]
+                    cursor.execute(
+                        f"DELETE FROM latest_trip WHERE source_id IN ({', '.join(['%s'] * len(chunk))})", chunk)
+
+                rows_written = self._write_latest_trips(cursor, latest, generation, full)
+
+                if full:
+                    # Lo que la resincronización no devolvió ya no existe en el origen
+                    cursor.execute("DELETE FROM latest_trip WHERE sync_generation <> %s", (generation,))
+
+                now = datetime.now()
+                last_full_sync = now if full else state['last_full_sync']
+                duration_ms = int((time.time() - start_time) * 1000)
+
+                cursor.execute("""
+                REPLACE INTO latest_trip_sync
+                    (id, watermark, generation, last_sync, last_full_sync, last_rows, last_duration_ms)
+                VALUES (1, %s, %s, %s, %s, %s, %s)
+                """, (watermark, generation, now, last_full_sync, rows_pulled, duration_ms))
+
+                connection.commit()
+
+            self.latest_trip_state.update({
+                'watermark': watermark,
+                'last_sync': now.isoformat(),
+                'last_full_sync': last_full_sync.isoformat() if last_full_sync else None,
+                'last_rows': rows_pulled,
+                'last_duration_ms': duration_ms,
+                'last_error': None
+            })
+            logger.info(f"🔁 latest_trip sincronizado ({'completo' if full else 'incremental'}): "
+                        f"{rows_pulled} filas leídas, {rows_written} escritas, "
+                        f"{len(deleted_ids)} borradas en {duration_ms} ms")
+            return True
+
+        except Exception as e:
+            logger.error(f"Error sincronizando latest_trip: {e}")
+            self.latest_trip_state['last_error'] = str(e)
+            return False
+
+    def _get_trucks_in_transit_from_mirror(self) -> Optional[List[Dict]]:
+        """Obtiene camiones en tránsito desde el espejo latest_trip; None si no está disponible"""
+        if not self.sync_latest_trip():
+            return None
+
+        try:
+            with self.target_pool.connection() as connection, connection.cursor() as cursor:
+                query = f"""
+                SELECT {', '.join(self.TRIP_COLUMNS)}
+                FROM latest_trip
+                WHERE status = 'SALIDA'
+                ORDER BY fecha_salida DESC, hora_salida DESC
+                """
+
+                cursor.execute(query)
+                trucks = cursor.fetchall()
+                logger.info(f"Encontrados {len(trucks)} camiones en tránsito (latest_trip)")
+                return trucks
+
+        except Exception as e:
+            logger.error(f"Error leyendo latest_trip: {e}")
+            return None
+
+    def _build_location_providers(self) -> Optional[LocationProviderFanOut]:
+        """Arma el fan-out de proveedores desde config['location_providers']; None usa solo Boltrack
+
+        Cada elemento es una instancia de LocationProvider o un dict con 'type'
+        ('boltrack' o 'fake'), 'name', 'timeout' y opciones propias del proveedor.
+        """
+        specs = self.config.get('location_providers')
+        if not specs:
+            return None
+
+        providers = []
+        for spec in specs:
+            if isinstance(spec, LocationProvider):
+                providers.append(spec)
+                continue
+
+            options = dict(spec)
+            provider_type = options.pop('type', 'boltrack')
+            if provider_type == 'boltrack':
+                providers.append(CallableLocationProvider(options.get('name', 'boltrack'),
+                                                          self._fetch_boltrack_locations,
+                                                          options.get('timeout', 30)))
+            elif provider_type == 'fake':
+                providers.append(FakeLocationProvider(**options))
+            else:
+                logger.warning(f"⚠️ Tipo de proveedor de ubicaciones desconocido: {provider_type}")
+
+        logger.info(f"Proveedores de ubicación: {', '.join(provider.name for provider in providers)}")
+        return LocationProviderFanOut(providers)
 
     def get_all_trucks_locations_parallel(self, trucks: List[Dict]) -> Dict[str, Dict]:
         """Obtiene ubicaciones de múltiples camiones en paralelo desde API"""
-        try:
-            headers = {
-                'token': self.config['api']['token'],
-                'Content-Type': 'application/json'
-            }
+        if self.location_providers is not None:
+            return self.location_providers.fetch(trucks)
 
-            response = requests.get(
-                f"{self.config['api']['base_url']}/ultimaubicaciontodos",
-                headers=headers,
-                timeout=30
-            )
+        return self._fetch_boltrack_locations(trucks)
+
+    def _fetch_boltrack_locations(self, trucks: List[Dict]) -> Dict[str, Dict]:
+        """Obtiene ubicaciones desde Boltrack (llamada masiva o por vehículo según config)"""
+        if self.config.get('api_fetch_mode', 'bulk') == 'per_vehicle':
+            return self.get_trucks_locations_per_vehicle(trucks)
+
+        # En modo streaming solo se conservan los vehículos en tránsito mientras se lee la respuesta
+        streaming = bool(self.config.get('api_streaming_parse', False) and trucks)
+        wanted = {truck['patente'] for truck in trucks} if streaming else None
+        state = self.location_fetch_state
+
+        try:
+            response = self.api_client.get('/ultimaubicaciontodos', stream=streaming,
+                                           headers=self._get_conditional_headers(wanted))
+
+            # Cerrar siempre la respuesta: en streaming libera la conexión aunque el parseo falle
+            with response:
+                if response.status_code == 304:
+                    state['not_modified'] += 1
+                    logger.info("API sin cambios (304), se reutilizan las ubicaciones anteriores")
+                    return self._publish_locations(self.last_good_locations, response, wanted)
+
+                if response.status_code != 200:
+                    logger.error(f"Error API: Status {response.status_code}")
+                    return self._get_last_good_locations()
+
+                payload_hash = None
+                if streaming:
+                    data = iter_json_array(iter_response_text(response))
+                else:
+                    # Sin ETag útil: si el cuerpo es idéntico al anterior no hace falta parsearlo
+                    payload_hash = hashlib.sha256(response.content).hexdigest()
+                    if payload_hash == state['payload_hash'] and state['wanted'] is None and self.last_good_locations_at:
+                        state['unchanged_payload'] += 1
+                        logger.info("API devolvió el mismo contenido, se reutilizan las ubicaciones anteriores")
+                        return self._publish_locations(self.last_good_locations, response, wanted, payload_hash)
+                    data = response.json()
 
-            if response.status_code == 200:
-                data = response.json()
                 locations = {}
+                received = 0
 
                 for vehicle in data:
+                    received += 1
                     patente = vehicle.get('id_unidad')
+                    if wanted is not None and patente not in wanted:
+                        continue
                     if patente:
-                        locations[patente] = {
-                            'patente': patente,
-                            'latitude': vehicle.get('latitud'),
-                            'longitude': vehicle.get('longitud'),
-                            'timestamp': vehicle.get('tiempoMovimientoFormatted'),
-                            'speed': vehicle.get('velocidad_kmh', 0),
-                            'direction': vehicle.get('direccion', 0)
-                        }
+                        locations[patente] = self._location_from_vehicle(vehicle)
 
-                logger.info(f"API devolvió ubicaciones para {len(locations)} vehículos")
-                return locations
+            if streaming:
+                logger.info(f"API devolvió ubicaciones para {len(locations)} vehículos en tránsito "
+                            f"(de {received} recibidos)")
             else:
-                logger.error(f"Error API: Status {response.status_code}")
-                return {}
+                logger.info(f"API devolvió ubicaciones para {len(locations)} vehículos")
+
+            return self._publish_locations(locations, response, wanted, payload_hash)
+
+        except CircuitOpenError as e:
+            logger.warning(f"⚠️ API omitida: {e}")
+            return self._get_last_good_locations()
 
         except Exception as e:
             logger.error(f"Error obteniendo ubicaciones: {e}")
+            return self._get_last_good_locations()
+
+    def get_trucks_locations_per_vehicle(self, trucks: List[Dict]) -> Dict[str, Dict]:
+        """Obtiene la ubicación de cada camión en tránsito con llamadas concurrentes
+
+        Como máximo `api_max_in_flight` llamadas simultáneas y `api_cycle_budget_seconds`
+        por ciclo; los camiones que no respondan a tiempo conservan su última ubicación.
+        """
+        patentes = list(dict.fromkeys(truck['patente'] for truck in trucks))
+        if not patentes:
             return {}
 
-    def load_geocercas(self):
-        """Carga las geocercas desde el archivo Excel"""
+        max_in_flight = max(1, int(self.config.get('api_max_in_flight', 8)))
+        budget = float(self.config.get('api_cycle_budget_seconds', 20))
+        start_time = time.time()
+
+        executor = ThreadPoolExecutor(max_workers=max_in_flight, thread_name_prefix='boltrack')
+        futures = {executor.submit(self._fetch_vehicle_location, patente): patente for patente in patentes}
+        done, pending = wait(futures, timeout=budget)
+        # Lo que no alcanzó a empezar se cancela; las llamadas en curso terminan solas
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        locations = {}
+        failed = []
+        for future in done:
+            try:
+                location = future.result()
+            except CircuitOpenError:
+                failed.append(futures[future])
+                continue
+            except Exception as e:
+                failed.append(futures[future])
+                logger.warning(f"⚠️ Ubicación de {futures[future]} no disponible: {e}")
+                continue
+            if location:
+                locations[location['patente']] = location
+
+        # Los que fallaron o no alcanzaron a responder conservan su última ubicación conocida
+        stale = 0
+        for patente in failed + [futures[future] for future in pending]:
+            if patente in self.last_good_locations:
+                locations[patente] = self.last_good_locations[patente]
+                stale += 1
+
+        logger.info(f"API por vehículo: {len(locations) - stale}/{len(patentes)} ubicaciones en "
+                    f"{time.time() - start_time:.1f}s ({len(pending)} fuera de presupuesto, "
+                    f"{stale} con ubicación anterior, {len(failed)} con error)")
+
+        if not locations:
+            return self._get_last_good_locations()
+
+        return self._publish_locations(locations)
+
+    def _fetch_vehicle_location(self, patente: str) -> Optional[Dict]:
+        """Consulta la última ubicación de un vehículo (endpoint y parámetro configurables)"""
+        response = self.vehicle_api_client.get(
+            self.config.get('api_vehicle_path', '/ultimaubicacion'),
+            params={self.config.get('api_vehicle_param', 'id_unidad'): patente},
+            timeout=float(self.config.get('api_vehicle_timeout', 10)),
+            retries=self.config.get('api_vehicle_retries', 0)
+        )
+
+        with response:
+            if response.status_code != 200:
+                raise ValueError(f"Status {response.status_code}")
+            data = response.json()
+
+        # El endpoint puede devolver el objeto o una lista con un elemento
+        if isinstance(data, list):
+            data = next((vehicle for vehicle in data if vehicle.get('id_unidad') == patente), None)
+        if not data:
+            return None
+
+        location = self._location_from_vehicle(data)
+        location['patente'] = patente
+        return location
+
+    def _location_from_vehicle(self, vehicle: Dict) -> Dict:
+        """Convierte un vehículo de la API de Boltrack al formato de ubicación interno"""
+        return {
+            'patente': vehicle.get('id_unidad'),
+            'latitude': vehicle.get('latitud'),
+            'longitude': vehicle.get('longitud'),
+            'timestamp': vehicle.get('tiempoMovimientoFormatted'),
+            'speed': vehicle.get('velocidad_kmh', 0),
+            'direction': vehicle.get('direccion', 0)
+        }
+
+    def _get_conditional_headers(self, wanted: Optional[set]) -> Dict[str, str]:
+        """Cabeceras If-None-Match / If-Modified-Since de la última respuesta válida
+
+        Solo se envían si las ubicaciones guardadas cubren todos los vehículos
+        pedidos (en streaming se guardó un subconjunto filtrado).
+        """
+        state = self.location_fetch_state
+        if not self.config.get('api_conditional_fetch', True) or not self.last_good_locations_at:
+            return {}
+        if state['wanted'] is not None and (wanted is None or not wanted <= state['wanted']):
+            return {}
+
+        headers = {}
+        if state['etag']:
+            headers['If-None-Match'] = state['etag']
+        if state['last_modified']:
+            headers['If-Modified-Since'] = state['last_modified']
+        return headers
+
+    def _publish_locations(self, locations: Dict[str, Dict], response=None, wanted: Optional[set] = None,
+                           payload_hash: Optional[str] = None) -> Dict[str, Dict]:
+        """Guarda el set de ubicaciones como último válido y cuenta los vehículos que cambiaron"""
+        state = self.location_fetch_state
+        if response is not None and response.status_code == 200:
+            state['etag'] = response.headers.get('ETag')
+            state['last_modified'] = response.headers.get('Last-Modified')
+            state['payload_hash'] = payload_hash
+            state['wanted'] = wanted
+
+        # Un vehículo cambió si su tiempoMovimientoFormatted es distinto al del ciclo anterior
+        previous = self.location_timestamps
+        changed = sum(1 for patente, location in locations.items()
+                      if previous.get(patente) != location['timestamp'] or patente not in previous)
+        state['changed_vehicles'] = changed
+        state['unchanged_vehicles'] = len(locations) - changed
+        self.location_timestamps = {patente: location['timestamp'] for patente, location in locations.items()}
+
+        logger.info(f"📍 Ubicaciones: {changed} vehículos con movimiento nuevo, "
+                    f"{len(locations) - changed} sin cambios")
+
+        self.last_good_locations = locations
+        self.last_good_locations_at = datetime.now()
+        return locations
+
+    def _get_last_good_locations(self) -> Dict[str, Dict]:
+        """Devuelve el último set de ubicaciones válido si no es más viejo que api_stale_max_seconds"""
+        if not self.last_good_locations_at:
+            return {}
+
+        age_seconds = (datetime.now() - self.last_good_locations_at).total_seconds()
+        if age_seconds > float(self.config.get('api_stale_max_seconds', 900)):
+            logger.warning(f"⚠️ Últimas ubicaciones válidas demasiado viejas ({age_seconds:.0f}s), se descartan")
+            return {}
+
+        logger.warning(f"⚠️ Usando últimas ubicaciones válidas de hace {age_seconds:.0f}s "
+                       f"({len(self.last_good_locations)} vehículos)")
+        return self.last_good_locations
+
+    def load_geocercas(self, use_compiled: bool = True):
+        """Carga las geocercas desde el archivo Excel
+
+        Las geocercas nuevas y sus índices se arman aparte en un GeofenceSet que
+        reemplaza al anterior al final; si la carga falla, el vigente no se toca.
+        No toma processing_lock: un ciclo en curso termina con el conjunto que tomó.
+        """
         try:
+            # Si el Excel no cambió, usar la versión compilada sin pasar por openpyxl
+            if use_compiled:
+                geofences = self._load_compiled_geocercas()
+                if geofences is not None:
+                    self._publish_geofences(geofences)
+                    return True
+
             df = pd.read_excel(self.config['excel_path'])
             logger.info(f"Excel de geocercas cargado: {len(df)} filas")
 
@@ -373,6 +1100,7 @@ class TruckTrackingWebServiceComplete:
                 return False
 
             # Procesar geocercas
+            geocercas = {}
             procesadas = 0
             errores = 0
 
@@ -385,10 +1113,10 @@ class TruckTrackingWebServiceComplete:
                     if all([grupo != 'nan', nombre_geocerca != 'nan', puntos_str != 'nan']):
                         puntos = self._parse_geocerca_points(puntos_str)
 
-                        if grupo not in self.geocercas:
-                            self.geocercas[grupo] = []
+                        if grupo not in geocercas:
+                            geocercas[grupo] = []
 
-                        self.geocercas[grupo].append({
+                        geocercas[grupo].append({
                             'nombre': nombre_geocerca,
                             'puntos': puntos,
                             'polygon': Polygon(puntos) if len(puntos) >= 3 else None
@@ -400,16 +1128,679 @@ class TruckTrackingWebServiceComplete:
                     errores += 1
 
             logger.info(f"Geocercas procesadas: {procesadas}, errores: {errores}")
-            for grupo, geocercas_lista in self.geocercas.items():
+            for grupo, geocercas_lista in geocercas.items():
                 validas = sum(1 for g in geocercas_lista if g['polygon'] is not None)
                 logger.info(f"  {grupo}: {len(geocercas_lista)} geocercas ({validas} válidas)")
 
+            geofences = self._build_geofence_set(geocercas)
+            self._publish_geofences(geofences)
+            self._save_compiled_geocercas(geofences)
+
             return True
 
         except Exception as e:
             logger.error(f"Error cargando geocercas: {e}")
             return False
 
+    def _get_geocercas_cache_path(self) -> Optional[str]:
+        """Ruta del cache compilado de geocercas ('' en la config lo desactiva)"""
+        return self.config.get('geocercas_cache_path', f"{self.config['excel_path']}.cache")
+
+    def _hash_file(self, path: str) -> str:
+        """SHA-256 del contenido de un archivo"""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _load_compiled_geocercas(self) -> Optional[GeofenceSet]:
+        """Arma geocercas, índices y mapeo desde el cache compilado si sigue vigente (None si no)"""
+        cache_path = self._get_geocercas_cache_path()
+        if not cache_path or not os.path.exists(cache_path):
+            return None
+
+        try:
+            with open(cache_path, 'rb') as f:
+                compiled = pickle.load(f)
+
+            if compiled.get('format') != self.GEOCERCAS_CACHE_FORMAT:
+                return None
+            if compiled['deposito_mapping'] != self.deposito_geocerca_mapping:
+                return None
+
+            # mtime/tamaño iguales evitan recalcular el hash; si difieren, decide el hash
+            stat = os.stat(self.config['excel_path'])
+            if (compiled['source_mtime_ns'], compiled['source_size']) != (stat.st_mtime_ns, stat.st_size):
+                if compiled['source_sha256'] != self._hash_file(self.config['excel_path']):
+                    logger.info("Cache de geocercas desactualizado, se recompila desde Excel")
+                    return None
+
+            geocercas = {}
+            for grupo, geocercas_lista in compiled['geocercas'].items():
+                polygons = shapely.from_wkb([g['wkb'] for g in geocercas_lista])
+                geocercas[grupo] = [{
+                    'nombre': geocerca['nombre'],
+                    'puntos': geocerca['puntos'],
+                    'polygon': polygon
+                } for geocerca, polygon in zip(geocercas_lista, polygons)]
+
+            geofences = self._build_geofence_set(geocercas, compiled)
+
+            logger.info(f"Geocercas cargadas desde cache compilado: {cache_path}")
+            return geofences
+
+        except Exception as e:
+            logger.warning(f"No se pudo usar el cache de geocercas {cache_path}: {e}")
+            return None
+
+    def _save_compiled_geocercas(self, geofences: GeofenceSet):
+        """Guarda geometrías (WKB), grafo de jerarquía y mapeo en el cache compilado"""
+        cache_path = self._get_geocercas_cache_path()
+        if not cache_path:
+            return
+
+        try:
+            stat = os.stat(self.config['excel_path'])
+            tree = geofences.tree
+            compiled = {
+                'format': self.GEOCERCAS_CACHE_FORMAT,
+                'source_sha256': self._hash_file(self.config['excel_path']),
+                'source_mtime_ns': stat.st_mtime_ns,
+                'source_size': stat.st_size,
+                'deposito_mapping': self.deposito_geocerca_mapping,
+                'geocercas': {
+                    grupo: [{
+                        'nombre': geocerca['nombre'],
+                        'puntos': geocerca['puntos'],
+                        'wkb': shapely.to_wkb(geocerca['polygon']) if geocerca['polygon'] is not None else None
+                    } for geocerca in geocercas_lista]
+                    for grupo, geocercas_lista in geofences.geocercas.items()
+                },
+                'geocerca_tree': {
+                    'roots': tree['roots'],
+                    'child_offsets': tree['child_offsets'],
+                    'child_ids': tree['child_ids']
+                },
+                'deposito_geocerca_index': geofences.deposito_index
+            }
+
+            # Escritura atómica: varios workers pueden compilar a la vez
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_path)), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    pickle.dump(compiled, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_path, cache_path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+
+            logger.info(f"Cache compilado de geocercas guardado: {cache_path}")
+
+        except Exception as e:
+            logger.warning(f"No se pudo guardar el cache de geocercas: {e}")
+
+    def _build_geofence_set(self, geocercas: Dict, compiled: Dict = None) -> GeofenceSet:
+        """Arma índice, jerarquía, mapeo de depósitos y grilla de unas geocercas, sin publicarlos"""
+        index = self._build_geocerca_index(geocercas)
+
+        if compiled:
+            tree = self._build_geocerca_tree(index, compiled['geocerca_tree'])
+            deposito_index = compiled['deposito_geocerca_index']
+        else:
+            tree = self._build_geocerca_tree(index)
+            deposito_index = self._build_deposito_geocerca_index(geocercas)
+
+        grid = {}
+        if self.config.get('geocerca_engine', 'shapely') == 'grid':
+            grid = self._build_geocerca_grid(tree)
+
+        return GeofenceSet(geocercas=geocercas, index=index, tree=tree, deposito_index=deposito_index, grid=grid)
+
+    def _publish_geofences(self, geofences: GeofenceSet):
+        """Publica un conjunto de geocercas con un único cambio de referencia"""
+        with self.geofences_lock:
+            self.geofences = replace(geofences, version=self.geofences.version + 1, loaded_at=datetime.now())
+        logger.info(f"🗺️ Geocercas v{self.geofences.version} publicadas: "
+                    f"{sum(len(lista) for lista in geofences.geocercas.values())} en {len(geofences.geocercas)} grupos")
+
+    def _build_geocerca_index(self, geocercas: Dict) -> Dict:
+        """Construye un índice espacial (STRtree) por grupo con polígonos preparados"""
+        index = {}
+        for grupo, geocercas_lista in geocercas.items():
+            ids = [i for i, geocerca in enumerate(geocercas_lista) if geocerca['polygon'] is not None]
+            polygons = np.array([geocercas_lista[i]['polygon'] for i in ids], dtype=object)
+
+            # Los polígonos preparados aceleran los contains repetidos
+            shapely.prepare(polygons)
+
+            index[grupo] = {
+                'tree': STRtree(polygons),
+                'polygons': polygons,
+                'ids': np.array(ids, dtype=np.int64)
+            }
+
+        logger.info(f"Índice espacial de geocercas construido para {len(index)} grupos")
+        return index
+
+    def _build_geocerca_grid(self, tree: Dict, cell_deg: float = None) -> Dict:
+        """Precalcula una grilla sobre el área de las geocercas para el motor 'grid'
+
+        Cada celda queda como fuera de todas (-1), borde a evaluar exacto (-2) o
+        dentro de un conjunto fijo de geocercas (índice >= 0 en inside_sets).
+        """
+        if not tree or len(tree['polygons']) == 0:
+            return {}
+
+        cell = float(cell_deg or self.config.get('geocerca_grid_cell_deg', 0.01))
+        polygons = tree['polygons']
+        min_x, min_y, max_x, max_y = shapely.total_bounds(polygons)
+        nx = int(np.ceil((max_x - min_x) / cell)) + 1
+        ny = int(np.ceil((max_y - min_y) / cell)) + 1
+
+        if nx * ny > self.config.get('geocerca_grid_max_cells', 20000000):
+            logger.error(f"Grilla de geocercas demasiado grande ({nx}x{ny} celdas), se usa el motor shapely")
+            return {}
+
+        start = time.time()
+        boundary = np.zeros(ny * nx, dtype=bool)
+        inside = {}
+
+        for global_id, polygon in enumerate(polygons):
+            p_min_x, p_min_y, p_max_x, p_max_y = polygon.bounds
+            ix = np.arange(int((p_min_x - min_x) // cell), int((p_max_x - min_x) // cell) + 1)
+            iy = np.arange(int((p_min_y - min_y) // cell), int((p_max_y - min_y) // cell) + 1)
+            grid_x, grid_y = np.meshgrid(ix, iy)
+            grid_x = grid_x.ravel()
+            grid_y = grid_y.ravel()
+
+            x0 = min_x + grid_x * cell
+            y0 = min_y + grid_y * cell
+            crosses = shapely.intersects(polygon.boundary, shapely.box(x0, y0, x0 + cell, y0 + cell))
+            flat = grid_y * nx + grid_x
+            boundary[flat[crosses]] = True
+
+            # Celdas sin borde: el centro decide para toda la celda
+            interior = ~crosses
+            contains = shapely.contains_xy(polygon, x0[interior] + cell / 2, y0[interior] + cell / 2)
+            for cell_id in flat[interior][contains].tolist():
+                inside.setdefault(cell_id, []).append(global_id)
+
+        cells = np.full(ny * nx, -1, dtype=np.int32)
+        cells[boundary] = -2
+
+        set_codes = {}
+        for cell_id, global_ids in inside.items():
+            if not boundary[cell_id]:
+                cells[cell_id] = set_codes.setdefault(tuple(global_ids), len(set_codes))
+
+        sets = list(set_codes.keys())
+        set_offsets = np.zeros(len(sets) + 1, dtype=np.int64)
+        set_offsets[1:] = np.cumsum([len(ids) for ids in sets])
+
+        grid = {
+            'min_x': min_x,
+            'min_y': min_y,
+            'cell': cell,
+            'nx': nx,
+            'ny': ny,
+            'cells': cells,
+            'set_offsets': set_offsets,
+            'set_ids': np.array([g for ids in sets for g in ids], dtype=np.int64)
+        }
+        logger.info(f"Grilla de geocercas {nx}x{ny} (celda {cell}°) construida en {time.time() - start:.2f}s: "
+                    f"{int(boundary.sum())} celdas de borde, {len(sets)} combinaciones interiores")
+        return grid
+
+    def _match_geocercas_grid(self, geofences: GeofenceSet, lats: np.ndarray,
+                              lngs: np.ndarray) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """Pares (punto, geocerca) por grupo usando la grilla; las celdas de borde van al motor exacto"""
+        grid = geofences.grid
+        tree = geofences.tree
+
+        ix = np.floor((lngs - grid['min_x']) / grid['cell']).astype(np.int64)
+        iy = np.floor((lats - grid['min_y']) / grid['cell']).astype(np.int64)
+        in_grid = (ix >= 0) & (ix < grid['nx']) & (iy >= 0) & (iy < grid['ny'])
+
+        codes = np.full(len(lats), -1, dtype=np.int64)
+        codes[in_grid] = grid['cells'][iy[in_grid] * grid['nx'] + ix[in_grid]]
+
+        # Celdas interiores: expandir el conjunto de geocercas de cada celda
+        resolved = np.flatnonzero(codes >= 0)
+        starts = grid['set_offsets'][codes[resolved]]
+        counts = grid['set_offsets'][codes[resolved] + 1] - starts
+        point_idx = np.repeat(resolved, counts)
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        global_ids = grid['set_ids'][positions]
+
+        local_codes = tree['group_codes'][global_ids]
+        matches = {}
+        for code, grupo in enumerate(tree['niveles']):
+            mask = local_codes == code
+            matches[grupo] = (point_idx[mask], tree['local_ids'][global_ids[mask]])
+        for grupo in self.geocerca_hierarchy:
+            matches.setdefault(grupo, (np.array([], dtype=np.int64), np.array([], dtype=np.int64)))
+
+        # Celdas de borde: prueba exacta con polígonos
+        boundary = np.flatnonzero(codes == -2)
+        if len(boundary):
+            exact = self._match_geocercas(geofences, lats[boundary], lngs[boundary])
+            for grupo, (exact_points, exact_ids) in exact.items():
+                point_idx, geocerca_ids = matches[grupo]
+                matches[grupo] = (np.concatenate([point_idx, boundary[exact_points]]),
+                                  np.concatenate([geocerca_ids, exact_ids]))
+
+        self.geocerca_grid_stats['resolved'] += len(lats) - len(boundary)
+        self.geocerca_grid_stats['boundary'] += len(boundary)
+        return matches
+
+    def benchmark_geocerca_engines(self, samples: int = 20000, seed: int = 0) -> Dict:
+        """Compara los motores shapely y grid sobre puntos aleatorios del área de geocercas
+
+        Se expone en GET /api/geocercas/benchmark.
+        """
+        geofences = self.geofences
+        if not geofences.tree:
+            return {'error': 'Geocercas no cargadas'}
+        if not geofences.grid:
+            # Con el motor shapely la grilla se arma solo para esta comparación
+            geofences = replace(geofences, grid=self._build_geocerca_grid(geofences.tree))
+        if not geofences.grid:
+            return {'error': 'Grilla no disponible'}
+
+        rng = np.random.default_rng(seed)
+        min_x, min_y, max_x, max_y = shapely.total_bounds(geofences.tree['polygons'])
+        lats = rng.uniform(min_y, max_y, samples)
+        lngs = rng.uniform(min_x, max_x, samples)
+
+        timings = {}
+        results = {}
+        for engine, match in (('shapely', self._match_geocercas), ('grid', self._match_geocercas_grid)):
+            start = time.time()
+            matches = match(geofences, lats, lngs)
+            timings[engine] = round((time.time() - start) * 1000, 2)
+            results[engine] = {grupo: set(zip(*(a.tolist() for a in pair))) for grupo, pair in matches.items()}
+
+        return {
+            'samples': samples,
+            'cell_deg': geofences.grid['cell'],
+            'shapely_ms': timings['shapely'],
+            'grid_ms': timings['grid'],
+            'mismatches': sum(len(results['shapely'][g] ^ results['grid'][g]) for g in self.geocerca_hierarchy)
+        }
+
+    def _build_geocerca_tree(self, index: Dict, links: Dict = None) -> Dict:
+        """Precalcula el grafo de contención CIUDADES → CBN → TRACK AND TRACE → DOCKS
+
+        Cada geocerca se cuelga de las geocercas del nivel superior más cercano que
+        la cubren por completo. Las que no están cubiertas por ninguna (o tienen
+        geometría inválida) quedan como raíces y se evalúan siempre.
+        """
+        niveles = [grupo for grupo in reversed(self.geocerca_hierarchy) if grupo in index]
+
+        # Numeración global de todas las geocercas de la jerarquía
+        group_codes = []
+        local_ids = []
+        polygons = []
+        offsets = {}
+        for code, grupo in enumerate(niveles):
+            group_index = index[grupo]
+            offsets[grupo] = len(polygons)
+            group_codes.extend([code] * len(group_index['ids']))
+            local_ids.extend(group_index['ids'].tolist())
+            polygons.extend(group_index['polygons'].tolist())
+
+        polygons = np.array(polygons, dtype=object)
+
+        if links is None:
+            links = self._compute_geocerca_tree_links(index, niveles, offsets, polygons)
+
+        roots = links['roots']
+        tree = {
+            'niveles': niveles,
+            'group_codes': np.array(group_codes, dtype=np.int64),
+            'local_ids': np.array(local_ids, dtype=np.int64),
+            'polygons': polygons,
+            'roots': roots,
+            'roots_tree': STRtree(polygons[roots]),
+            'boundaries_tree': STRtree(shapely.boundary(polygons)),
+            'child_offsets': links['child_offsets'],
+            'child_ids': links['child_ids']
+        }
+        logger.info(f"Jerarquía de geocercas: {len(roots)} raíces, {len(links['child_ids'])} relaciones padre-hijo")
+        return tree
+
+    def _compute_geocerca_tree_links(self, index: Dict, niveles: List[str], offsets: Dict[str, int],
+                                     polygons: np.ndarray) -> Dict:
+        """Calcula raíces e hijos (CSR) del grafo de contención con ids globales"""
+        valid = shapely.is_valid(polygons) if len(polygons) else np.array([], dtype=bool)
+
+        roots = []
+        children = [[] for _ in range(len(polygons))]
+        for nivel, grupo in enumerate(niveles):
+            start = offsets[grupo]
+            for local in range(len(index[grupo]['ids'])):
+                global_id = start + local
+                parents = []
+
+                if valid[global_id]:
+                    # Buscar hacia arriba el nivel más cercano que cubra la geocerca
+                    for grupo_padre in reversed(niveles[:nivel]):
+                        parent_index = index[grupo_padre]
+                        candidatos = parent_index['tree'].query(polygons[global_id], predicate='covered_by')
+                        parents = [offsets[grupo_padre] + int(c) for c in candidatos
+                                   if valid[offsets[grupo_padre] + int(c)]]
+                        if parents:
+                            break
+
+                if parents:
+                    for parent in parents:
+                        children[parent].append(global_id)
+                else:
+                    roots.append(global_id)
+
+        # Hijos en formato compacto (CSR) para expandirlos de forma vectorizada
+        child_offsets = np.zeros(len(polygons) + 1, dtype=np.int64)
+        child_offsets[1:] = np.cumsum([len(c) for c in children])
+        child_ids = np.array([c for lista in children for c in lista], dtype=np.int64)
+
+        return {
+            'roots': np.array(roots, dtype=np.int64),
+            'child_offsets': child_offsets,
+            'child_ids': child_ids
+        }
+
+    def _match_geocercas(self, geofences: GeofenceSet, lats: np.ndarray,
+                         lngs: np.ndarray) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """Pares (punto, geocerca) de contención por grupo, descendiendo la jerarquía
+
+        Solo se evalúan las raíces cuyo bounding box contiene el punto y, después,
+        los hijos de las geocercas que efectivamente contienen el punto.
+        """
+        tree = geofences.tree
+        matches = {grupo: (np.array([], dtype=np.int64), np.array([], dtype=np.int64))
+                   for grupo in self.geocerca_hierarchy}
+        if not tree or len(tree['polygons']) == 0:
+            return matches
+
+        total_polygons = len(tree['polygons'])
+
+        point_idx, tree_idx = tree['roots_tree'].query(shapely.points(lngs, lats))
+        global_ids = tree['roots'][tree_idx]
+
+        found_points = []
+        found_ids = []
+        while len(point_idx):
+            inside = shapely.contains_xy(tree['polygons'][global_ids], lngs[point_idx], lats[point_idx])
+            point_idx = point_idx[inside]
+            global_ids = global_ids[inside]
+            found_points.append(point_idx)
+            found_ids.append(global_ids)
+
+            # Descender a los hijos de las geocercas que contienen el punto
+            starts = tree['child_offsets'][global_ids]
+            counts = tree['child_offsets'][global_ids + 1] - starts
+            if counts.sum() == 0:
+                break
+
+            point_idx = np.repeat(point_idx, counts)
+            positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            global_ids = tree['child_ids'][positions]
+
+            # Un hijo con varios padres coincidentes se evalúa una sola vez
+            keys = np.unique(point_idx * total_polygons + global_ids)
+            point_idx, global_ids = np.divmod(keys, total_polygons)
+
+        if not found_points:
+            return matches
+
+        keys = np.unique(np.concatenate(found_points) * total_polygons + np.concatenate(found_ids))
+        point_idx, global_ids = np.divmod(keys, total_polygons)
+        codes = tree['group_codes'][global_ids]
+        for code, grupo in enumerate(tree['niveles']):
+            mask = codes == code
+            matches[grupo] = (point_idx[mask], tree['local_ids'][global_ids[mask]])
+
+        return matches
+
+    def _build_deposito_geocerca_index(self, geocercas: Dict) -> Dict:
+        """Resuelve deposito_geocerca_mapping contra las geocercas cargadas: (deposito, grupo) -> ids"""
+        mapping_keys = {
+            'CIUDADES': 'ciudad',
+            'CBN': 'cbn',
+            'TRACK AND TRACE': 'track_trace',
+            'DOCKS': 'docks'
+        }
+
+        index = {}
+        for deposito, mapping in self.deposito_geocerca_mapping.items():
+            for grupo, key in mapping_keys.items():
+                target_name = mapping.get(key)
+                if not target_name or grupo not in geocercas:
+                    continue
+
+                ids = [i for i, geocerca in enumerate(geocercas[grupo])
+                       if (target_name.upper() in geocerca['nombre'].upper() or
+                           geocerca['nombre'].upper() in target_name.upper())]
+
+                if ids:
+                    index[(deposito, grupo)] = np.array(ids, dtype=np.int64)
+                else:
+                    logger.warning(f"Depósito {deposito}: sin geocerca {grupo} que coincida con '{target_name}'")
+
+        logger.info(f"Mapeo depósito-geocerca compilado: {len(index)} combinaciones")
+        return index
+
+    def clear_geocerca_lru(self):
+        """Vacía el cache LRU de clasificación por coordenadas"""
+        with self.geocerca_lru_lock:
+            self.geofences.lru.clear()
+
+    def classify_geocercas_batch(self, lats, lngs, depositos=None,
+                                 geofences: GeofenceSet = None) -> Dict[str, List[str]]:
+        """Clasifica en bloque un conjunto de puntos contra todas las geocercas
+
+        Devuelve una columna por grupo (DOCKS, TRACK AND TRACE, CBN, CIUDADES) con
+        'NO' o 'SI en <geocerca>' para cada punto, con la misma prioridad que la
+        verificación individual: primero la geocerca mapeada al depósito destino y
+        si no, la primera geocerca del Excel que contenga el punto.
+
+        Delante del cálculo exacto hay un cache LRU por coordenadas redondeadas a
+        geocerca_cache_precision decimales y depósito. Solo se guardan celdas que no
+        tocan el borde de ninguna geocerca (resultado idéntico en toda la celda); las
+        celdas de borde siempre se calculan de forma exacta.
+        """
+        geofences = geofences or self.geofences
+        lru = geofences.lru
+        lats = np.asarray(lats, dtype=float)
+        lngs = np.asarray(lngs, dtype=float)
+        total = len(lats)
+        if depositos is None:
+            depositos = [None] * total
+
+        capacity = int(self.config.get('geocerca_cache_size', 50000))
+        if capacity <= 0 or total == 0 or not geofences.tree:
+            return self._classify_geocercas_exact(geofences, lats, lngs, depositos)
+
+        precision = int(self.config.get('geocerca_cache_precision', 4))
+        keys = [(round(lat, precision), round(lng, precision), deposito)
+                for lat, lng, deposito in zip(lats.tolist(), lngs.tolist(), depositos)]
+
+        result = {grupo: ['NO'] * total for grupo in self.geocerca_hierarchy}
+        pending = []
+        unknown = []
+        with self.geocerca_lru_lock:
+            for i, key in enumerate(keys):
+                cached = lru.get(key)
+                if cached is None:
+                    unknown.append(i)
+                    pending.append(i)
+                    continue
+
+                lru.move_to_end(key)
+                if cached == 'EDGE':
+                    self.geocerca_lru_stats['edge'] += 1
+                    pending.append(i)
+                else:
+                    self.geocerca_lru_stats['hits'] += 1
+                    for grupo in self.geocerca_hierarchy:
+                        result[grupo][i] = cached[grupo]
+            self.geocerca_lru_stats['misses'] += len(unknown)
+
+        if not pending:
+            return result
+
+        exact = self._classify_geocercas_exact(geofences, lats[pending], lngs[pending],
+                                               [depositos[i] for i in pending])
+        for j, i in enumerate(pending):
+            for grupo in self.geocerca_hierarchy:
+                result[grupo][i] = exact[grupo][j]
+
+        if unknown:
+            # Celdas nuevas: las que cruzan el borde de alguna geocerca quedan marcadas como EDGE
+            half = 0.5 * 10 ** -precision
+            cell_lats = np.array([keys[i][0] for i in unknown])
+            cell_lngs = np.array([keys[i][1] for i in unknown])
+            cells = shapely.box(cell_lngs - half, cell_lats - half, cell_lngs + half, cell_lats + half)
+            edge_idx, _ = geofences.tree['boundaries_tree'].query(cells, predicate='intersects')
+            edge = np.zeros(len(unknown), dtype=bool)
+            edge[edge_idx] = True
+
+            with self.geocerca_lru_lock:
+                for j, i in enumerate(unknown):
+                    lru[keys[i]] = 'EDGE' if edge[j] else {
+                        grupo: result[grupo][i] for grupo in self.geocerca_hierarchy}
+                    lru.move_to_end(keys[i])
+                while len(lru) > capacity:
+                    lru.popitem(last=False)
+
+        return result
+
+    def _classify_geocercas_exact(self, geofences: GeofenceSet, lats: np.ndarray, lngs: np.ndarray,
+                                  depositos: List[str]) -> Dict[str, List[str]]:
+        """Clasificación exacta contra los polígonos (sin cache)"""
+        total = len(lats)
+        result = {grupo: ['NO'] * total for grupo in self.geocerca_hierarchy}
+        if total == 0:
+            return result
+
+        # Códigos de depósito para resolver la geocerca preferida de cada punto
+        deposito_codes = {}
+        point_deposito = np.array([deposito_codes.setdefault(d, len(deposito_codes)) for d in depositos])
+
+        if geofences.grid and self.config.get('geocerca_engine', 'shapely') == 'grid':
+            matches = self._match_geocercas_grid(geofences, lats, lngs)
+        else:
+            matches = self._match_geocercas(geofences, lats, lngs)
+
+        for grupo in self.geocerca_hierarchy:
+            point_idx, geocerca_ids = matches[grupo]
+            if len(point_idx) == 0:
+                continue
+
+            # Las geocercas del depósito destino tienen prioridad sobre el orden del Excel
+            targeted = np.zeros(len(point_idx), dtype=bool)
+            for deposito, code in deposito_codes.items():
+                target_ids = geofences.deposito_index.get((deposito, grupo))
+                if target_ids is not None:
+                    mask = point_deposito[point_idx] == code
+                    targeted[mask] = np.isin(geocerca_ids[mask], target_ids)
+
+            rank = geocerca_ids + np.where(targeted, 0, len(geofences.geocercas[grupo]))
+            order = np.lexsort((rank, point_idx))
+            winners, first = np.unique(point_idx[order], return_index=True)
+
+            geocercas_lista = geofences.geocercas[grupo]
+            columna = result[grupo]
+            for point, geocerca_id in zip(winners.tolist(), geocerca_ids[order][first].tolist()):
+                columna[point] = f"SI en {geocercas_lista[geocerca_id]['nombre']}"
+
+        return result
+
+    def classify_trucks_geocercas(self, entries: List[Tuple[Dict, Dict]]) -> List[Dict[str, str]]:
+        """Etapa de geocercas de un ciclo: clasifica todos los pares (camión, ubicación) de una vez
+
+        Los camiones que no se movieron desde la última clasificación (mismo timestamp
+        de la API o desplazamiento menor a geocerca_reuse_distance_m) reutilizan el
+        resultado anterior sin volver a evaluar polígonos.
+        """
+        max_distance_m = float(self.config.get('geocerca_reuse_distance_m', 25))
+        # Todo el ciclo usa el mismo conjunto de geocercas aunque se publique otro en el medio
+        geofences = self.geofences
+        memo = self.geocerca_memo
+
+        lats = np.array([float(location['latitude']) for _, location in entries], dtype=float)
+        lngs = np.array([float(location['longitude']) for _, location in entries], dtype=float)
+        depositos = [truck.get('deposito_destino', '') for truck, _ in entries]
+        # Las clasificaciones memorizadas con otra versión de geocercas no se reutilizan
+        previous = [memo.get(truck['patente']) for truck, _ in entries]
+        previous = [p if p and p['version'] == geofences.version else None for p in previous]
+
+        # Distancia aproximada (equirectangular) a la posición con la que se clasificó antes
+        prev_lats = np.array([p['lat'] if p else np.nan for p in previous], dtype=float)
+        prev_lngs = np.array([p['lng'] if p else np.nan for p in previous], dtype=float)
+        dx = np.radians(lngs - prev_lngs) * np.cos(np.radians((lats + prev_lats) / 2))
+        dy = np.radians(lats - prev_lats)
+        distances_m = 6371000 * np.hypot(dx, dy)
+
+        statuses = [None] * len(entries)
+        pending = []
+        for i, ((truck, location), prev) in enumerate(zip(entries, previous)):
+            if prev and prev['deposito'] == depositos[i] and (
+                    (location.get('timestamp') and location.get('timestamp') == prev['timestamp']) or
+                    distances_m[i] <= max_distance_m):
+                statuses[i] = dict(prev['status'])
+            else:
+                pending.append(i)
+
+        if pending:
+            columns = self.classify_geocercas_batch(lats[pending], lngs[pending],
+                                                    [depositos[i] for i in pending], geofences)
+            for j, i in enumerate(pending):
+                statuses[i] = {grupo: columns[grupo][j] for grupo in self.geocerca_hierarchy}
+
+        # Memo nuevo con los camiones de este ciclo; los reutilizados conservan su posición de referencia
+        evaluated = set(pending)
+        new_memo = {}
+        for i, ((truck, location), prev) in enumerate(zip(entries, previous)):
+            anchor = prev if i not in evaluated else {'lat': lats[i], 'lng': lngs[i]}
+            new_memo[truck['patente']] = {
+                'lat': anchor['lat'],
+                'lng': anchor['lng'],
+                'timestamp': location.get('timestamp'),
+                'deposito': depositos[i],
+                'status': statuses[i],
+                'version': geofences.version
+            }
+        self.geocerca_memo = new_memo
+
+        self.geocerca_memo_stats['reused'] += len(entries) - len(pending)
+        self.geocerca_memo_stats['evaluated'] += len(pending)
+        logger.info(f"Geocercas: {len(pending)} camiones evaluados, {len(entries) - len(pending)} sin movimiento reutilizados")
+
+        return statuses
+
+    def _get_located_trucks(self, trucks: List[Dict], locations: Dict[str, Dict]) -> Tuple[List[Tuple[Dict, Dict]], List[Dict]]:
+        """Separa los camiones con ubicación válida de los que no la tienen"""
+        located = []
+        missing = []
+
+        for truck in trucks:
+            location = locations.get(truck['patente'])
+
+            if location and location['latitude'] and location['longitude']:
+                try:
+                    float(location['latitude'])
+                    float(location['longitude'])
+                    located.append((truck, location))
+                    continue
+                except (TypeError, ValueError):
+                    logger.warning(f"⚠️ {truck['patente']}: Coordenadas inválidas {location['latitude']}, {location['longitude']}")
+
+            missing.append(truck)
+
+        return located, missing
+
     def _parse_geocerca_points(self, puntos_str: str) -> List[Tuple[float, float]]:
         """Parsea los puntos de coordenadas de una geocerca"""
         try:
@@ -435,47 +1826,8 @@ class TruckTrackingWebServiceComplete:
 
     def check_point_in_geocercas(self, lat: float, lng: float, deposito_destino: str = None) -> Dict[str, str]:
         """Verifica en qué geocercas se encuentra un punto con mapeo correlativo"""
-        point = Point(lng, lat)
-        result = {
-            'DOCKS': 'NO',
-            'TRACK AND TRACE': 'NO',
-            'CBN': 'NO',
-            'CIUDADES': 'NO'
-        }
-
-        # Mapeo específico para el depósito
-        target_geocercas = {}
-        if deposito_destino and deposito_destino in self.deposito_geocerca_mapping:
-            mapping = self.deposito_geocerca_mapping[deposito_destino]
-            target_geocercas = {
-                'CIUDADES': mapping.get('ciudad'),
-                'CBN': mapping.get('cbn'),
-                'TRACK AND TRACE': mapping.get('track_trace'),
-                'DOCKS': mapping.get('docks')
-            }
-
-        # Verificar en orden jerárquico
-        for grupo in self.geocerca_hierarchy:
-            if grupo in self.geocercas:
-                target_name = target_geocercas.get(grupo)
-
-                if target_name:
-                    # Buscar geocerca específica
-                    for geocerca in self.geocercas[grupo]:
-                        if (target_name.upper() in geocerca['nombre'].upper() or
-                                geocerca['nombre'].upper() in target_name.upper()):
-                            if geocerca['polygon'] and geocerca['polygon'].contains(point):
-                                result[grupo] = f"SI en {geocerca['nombre']}"
-                                break
-
-                # Si no encontramos la específica, buscar cualquiera
-                if result[grupo] == 'NO':
-                    for geocerca in self.geocercas[grupo]:
-                        if geocerca['polygon'] and geocerca['polygon'].contains(point):
-                            result[grupo] = f"SI en {geocerca['nombre']}"
-                            break
-
-        return result
+        columns = self.classify_geocercas_batch([lat], [lng], [deposito_destino])
+        return {grupo: columns[grupo][0] for grupo in self.geocerca_hierarchy}
 
     def calculate_delivery_progress(self, geocerca_status: Dict[str, str], deposito_destino: str = None) -> Tuple[float, str]:
         """Calcula porcentaje de progreso de entrega basado en geocercas"""
@@ -507,7 +1859,50 @@ class TruckTrackingWebServiceComplete:
 
         return min(porcentaje, 100.0), estado
 
-    def calculate_waiting_time_for_discharge(self, truck_data: Dict, geocerca_status: Dict[str, str], current_estado_entrega: str) -> Tuple[int, str, str, str]:
+    def _prefetch_waiting_starts(self, trucks: List[Dict]) -> Optional[Dict[Tuple[str, str], datetime]]:
+        """Carga en una consulta la primera detección en zona de descarga de los camiones del ciclo
+
+        Devuelve {(patente, planilla): primera_deteccion}; un par ausente significa
+        que no hay registro previo. Devuelve None si la consulta falla, para que el
+        cálculo vuelva a consultar camión por camión.
+        """
+        wanted = {(truck['patente'], str(truck['planilla'])) for truck in trucks
+                  if truck.get('planilla') is not None}
+        if not wanted:
+            return {}
+
+        try:
+            patentes = sorted({patente for patente, _ in wanted})
+            chunk_size = 1000
+            waiting_starts = {}
+
+            with self.target_pool.connection() as connection, connection.cursor() as cursor:
+                for offset in range(0, len(patentes), chunk_size):
+                    chunk = patentes[offset:offset + chunk_size]
+                    prefetch_query = f"""
+                    SELECT patente, planilla, MIN(primera_deteccion) AS primera_deteccion
+                    FROM truck_tracking
+                    WHERE patente IN ({', '.join(['%s'] * len(chunk))})
+                    AND planilla IS NOT NULL
+                    AND (estado_entrega IN ('EN_ZONA_DESCARGA', 'DESCARGANDO', 'DESCARGANDO_CONFIRMADO'))
+                    GROUP BY patente, planilla
+                    """
+                    cursor.execute(prefetch_query, chunk)
+
+                    for row in cursor.fetchall():
+                        key = (row['patente'], str(row['planilla']))
+                        if key in wanted and row['primera_deteccion'] is not None:
+                            waiting_starts[key] = row['primera_deteccion']
+
+            logger.info(f"Inicio de espera precargado para {len(waiting_starts)} de {len(wanted)} camiones")
+            return waiting_starts
+
+        except Exception as e:
+            logger.error(f"Error precargando inicios de espera: {e}")
+            return None
+
+    def calculate_waiting_time_for_discharge(self, truck_data: Dict, geocerca_status: Dict[str, str], current_estado_entrega: str,
+                                             waiting_starts: Optional[Dict[Tuple[str, str], datetime]] = None) -> Tuple[int, str, str, str]:
         """Calcula tiempo de espera para descarga con datos históricos"""
         try:
             patente = truck_data['patente']
@@ -546,9 +1941,13 @@ class TruckTrackingWebServiceComplete:
             if patente in self.historical_data:
                 inicio_espera = self.historical_data[patente]['primera_entrada_descarga']
 
-            # Si no hay datos históricos, buscar en BD
-            if inicio_espera is None:
-                with self.target_connection.cursor() as cursor:
+            # Si no hay datos históricos, usar la precarga del ciclo
+            if inicio_espera is None and waiting_starts is not None:
+                inicio_espera = waiting_starts.get((patente, str(planilla)))
+
+            # Sin precarga, buscar en BD
+            elif inicio_espera is None:
+                with self.target_pool.connection() as connection, connection.cursor() as cursor:
                     history_query = """
                     SELECT primera_deteccion
                     FROM truck_tracking 
@@ -697,170 +2096,253 @@ class TruckTrackingWebServiceComplete:
             return True
 
     def get_all_trucks_status_complete(self):
-        """Obtiene estado completo de todos los camiones con TODAS las funcionalidades"""
-        try:
-            # Si tenemos cache reciente (< 5 minutos), usarlo
-            if (self.cache['last_update'] and
-                    (datetime.now() - self.cache['last_update']).seconds < 300):
-                return self.cache['trucks_data']
-
-            # Obtener datos frescos
-            trucks = self.get_trucks_in_transit()
-            if not trucks:
-                return []
+        """Obtiene estado completo de todos los camiones con TODAS las funcionalidades
 
-            # Obtener ubicaciones
-            locations = self.get_all_trucks_locations_parallel(trucks)
+        Solo lee el último snapshot publicado por process_all_trucks_complete;
+        nunca consulta la API ni escribe en BD desde el request.
+        """
+        return list(self._get_fresh_snapshot().trucks_data)
 
-            # Procesar datos completos
-            trucks_data = []
-            for truck in trucks:
-                patente = truck['patente']
-                location = locations.get(patente)
-
-                if location and location['latitude'] and location['longitude']:
-                    # Verificar geocercas con mapeo correlativo
-                    geocerca_status = self.check_point_in_geocercas(
-                        location['latitude'],
-                        location['longitude'],
-                        truck.get('deposito_destino', '')
-                    )
-
-                    # Calcular progreso de entrega
-                    porcentaje_entrega, estado_entrega = self.calculate_delivery_progress(
-                        geocerca_status, truck.get('deposito_destino', '')
-                    )
-
-                    # Calcular tiempo de espera
-                    tiempo_espera_minutos, inicio_espera_str, estado_descarga, alert_level = \
-                        self.calculate_waiting_time_for_discharge(
-                            truck, geocerca_status, estado_entrega
-                        )
-
-                    truck_data = {
-                        'patente': patente,
-                        'planilla': truck.get('planilla', ''),
-                        'status': truck.get('status', ''),
-                        'deposito_origen': truck.get('deposito_origen', ''),
-                        'deposito_destino': truck.get('deposito_destino', ''),
-                        'producto': truck.get('producto', ''),
-                        'cod_producto': truck.get('cod_producto', ''),
-                        'salida': truck.get('salida', 0),
-                        'fecha_salida': str(truck.get('fecha_salida', '')),
-                        'hora_salida': self._adjust_time_utc_minus_4(truck.get('hora_salida', '')),
-                        'fecha_llegada': str(truck.get('fecha_llegada', '')),
-                        'hora_llegada': self._adjust_time_utc_minus_4(truck.get('hora_llegada', '')),
-                        'latitude': location.get('latitude'),
-                        'longitude': location.get('longitude'),
-                        'velocidad_kmh': location.get('speed', 0),
-                        'direccion': location.get('direction', 0),
-                        'timestamp': location.get('timestamp', ''),
-                        'en_docks': geocerca_status['DOCKS'],
-                        'en_track_trace': geocerca_status['TRACK AND TRACE'],
-                        'en_cbn': geocerca_status['CBN'],
-                        'en_ciudades': geocerca_status['CIUDADES'],
-                        'porcentaje_entrega': porcentaje_entrega,
-                        'estado_entrega': estado_entrega,
-                        'tiempo_espera_minutos': tiempo_espera_minutos,
-                        'tiempo_espera_horas': round(tiempo_espera_minutos / 60, 2) if tiempo_espera_minutos > 0 else 0,
-                        'estado_descarga': estado_descarga,
-                        'alert_level': alert_level,
-                        'inicio_espera': inicio_espera_str,
-                        'fecha_proceso': datetime.now().isoformat()
-                    }
-
-                    trucks_data.append(truck_data)
-
-                    # Guardar en BD de destino
-                    self._save_truck_tracking_complete(truck, location, geocerca_status,
-                                                       porcentaje_entrega, estado_entrega,
-                                                       tiempo_espera_minutos, estado_descarga, inicio_espera_str)
-
-            # Actualizar cache
-            self.cache['trucks_data'] = trucks_data
-            self.cache['last_update'] = datetime.now()
-
-            return trucks_data
+    def _build_truck_status(self, truck: Dict, location: Dict, geocerca_status: Dict[str, str],
+                            porcentaje_entrega: float, estado_entrega: str, tiempo_espera_minutos: int,
+                            inicio_espera_str: str, estado_descarga: str, alert_level: str) -> Dict:
+        """Arma el registro de estado de un camión que se publica en el snapshot"""
+        return {
+            'patente': truck['patente'],
+            'planilla': truck.get('planilla', ''),
+            'status': truck.get('status', ''),
+            'deposito_origen': truck.get('deposito_origen', ''),
+            'deposito_destino': truck.get('deposito_destino', ''),
+            'producto': truck.get('producto', ''),
+            'cod_producto': truck.get('cod_producto', ''),
+            'salida': truck.get('salida', 0),
+            'fecha_salida': str(truck.get('fecha_salida', '')),
+            'hora_salida': self._adjust_time_utc_minus_4(truck.get('hora_salida', '')),
+            'fecha_llegada': str(truck.get('fecha_llegada', '')),
+            'hora_llegada': self._adjust_time_utc_minus_4(truck.get('hora_llegada', '')),
+            'latitude': location.get('latitude'),
+            'longitude': location.get('longitude'),
+            'velocidad_kmh': location.get('speed', 0),
+            'direccion': location.get('direction', 0),
+            'timestamp': location.get('timestamp', ''),
+            'en_docks': geocerca_status['DOCKS'],
+            'en_track_trace': geocerca_status['TRACK AND TRACE'],
+            'en_cbn': geocerca_status['CBN'],
+            'en_ciudades': geocerca_status['CIUDADES'],
+            'porcentaje_entrega': porcentaje_entrega,
+            'estado_entrega': estado_entrega,
+            'tiempo_espera_minutos': tiempo_espera_minutos,
+            'tiempo_espera_horas': round(tiempo_espera_minutos / 60, 2) if tiempo_espera_minutos > 0 else 0,
+            'estado_descarga': estado_descarga,
+            'alert_level': alert_level,
+            'inicio_espera': inicio_espera_str,
+            'fecha_proceso': datetime.now().isoformat()
+        }
 
+    def _publish_snapshot(self, trucks_data: List[Dict], alerts: Dict, results_data: List[Dict] = ()):
+        """Arma el snapshot del ciclo aparte y lo publica con un único cambio de referencia"""
+        snapshot = FleetSnapshot.build(
+            self.snapshot.version + 1, trucks_data, results_data,
+            self._compute_dashboard_stats(trucks_data), alerts
+        )
+        self.snapshot = snapshot
+        logger.info(f"📸 Snapshot v{snapshot.version} publicado: {len(snapshot.trucks_data)} camiones")
+
+    def start_processing_scheduler(self) -> bool:
+        """Inicia el procesamiento periódico que publica los snapshots"""
+        return self.scheduler.start() is not None
+
+    def stop_processing_scheduler(self):
+        """Detiene el procesamiento periódico"""
+        self.scheduler.stop()
+
+    def enqueue_processing(self, trigger: str = 'manual') -> Tuple[Dict, bool]:
+        """Encola un procesamiento; si ya hay uno en cola se devuelve ese mismo trabajo"""
+        # Sin planificador activo en este proceso se ejecuta una sola vez, sin iniciar el ciclo periódico
+        return self.scheduler.run_once(trigger)
+
+    def get_processing_job(self, job_id: str) -> Optional[Dict]:
+        """Estado de un trabajo de procesamiento encolado"""
+        return self.scheduler.get_job(job_id)
+
+    def _get_fresh_snapshot(self) -> FleetSnapshot:
+        """Snapshot para un request; si venció dispara un único refresco (stale-while-revalidate)
+
+        Con un snapshot vencido se devuelve el anterior sin esperar. Si todavía no
+        hay ninguno, todos los llamadores esperan al mismo refresco.
+        """
+        snapshot = self.snapshot
+        if snapshot.created_at is None:
+            self._request_snapshot_refresh(snapshot.version,
+                                           wait_seconds=self.config.get('snapshot_wait_seconds', 60))
+            return self.snapshot
+
+        age_seconds = (datetime.now() - snapshot.created_at).total_seconds()
+        if age_seconds > self.config.get('snapshot_max_age_seconds', 300):
+            with self.refresh_lock:
+                self.refresh_stats['stale_served'] += 1
+            self._request_snapshot_refresh(snapshot.version)
+        return snapshot
+
+    def _request_snapshot_refresh(self, seen_version: int, wait_seconds: float = 0):
+        """Inicia un refresco si no hay otro en curso; los llamadores concurrentes se suman al mismo"""
+        min_interval = self.config.get('snapshot_refresh_min_interval_seconds', 30)
+
+        with self.refresh_lock:
+            event = self.refresh_event
+            if event is not None:
+                self.refresh_stats['coalesced'] += 1
+            elif (self.refresh_last_attempt is not None
+                  and time.monotonic() - self.refresh_last_attempt < min_interval):
+                # El último intento es reciente (p. ej. BD caída): no reintentar en cada request
+                return
+            else:
+                event = threading.Event()
+                self.refresh_event = event
+                self.refresh_last_attempt = time.monotonic()
+                self.refresh_stats['refreshes'] += 1
+                threading.Thread(target=self._run_snapshot_refresh, args=(event, seen_version),
+                                 name='snapshot-refresh', daemon=True).start()
+
+        if wait_seconds and not event.wait(wait_seconds):
+            with self.refresh_lock:
+                self.refresh_stats['wait_timeouts'] += 1
+            logger.warning(f"⚠️ Refresco de snapshot sin terminar tras {wait_seconds}s, se responde sin datos nuevos")
+
+    def _run_snapshot_refresh(self, event: threading.Event, seen_version: int):
+        """Ejecuta el refresco en background y libera a los llamadores que esperan"""
+        try:
+            # Si ya corre un ciclo basta con esperar su snapshot
+            with self.processing_lock:
+                pass
+            if self.snapshot.version == seen_version:
+                logger.info("🔄 Snapshot vencido, refrescando bajo demanda")
+                job, _ = self.enqueue_processing('refresh')
+                self.scheduler.wait_for(job['job_id'], self.config.get('snapshot_wait_seconds', 60))
         except Exception as e:
-            logger.error(f"Error obteniendo estado completo de camiones: {e}")
-            return []
+            logger.error(f"Error refrescando snapshot: {e}")
+        finally:
+            with self.refresh_lock:
+                self.refresh_event = None
+            event.set()
 
     def _save_truck_tracking_complete(self, truck_data: Dict, location_data: Dict, geocerca_status: Dict[str, str],
                                       porcentaje_entrega: float, estado_entrega: str, tiempo_espera_minutos: int,
                                       estado_descarga: str, inicio_espera_str: str):
         """Guarda tracking completo en BD de destino"""
-        try:
-            with self.target_connection.cursor() as cursor:
-                # Verificar si ya existe
-                check_query = """
-                SELECT id, inicio_espera_descarga FROM truck_tracking 
-                WHERE patente = %s AND planilla = %s
-                """
-                cursor.execute(check_query, (truck_data['patente'], truck_data['planilla']))
-                existing = cursor.fetchone()
-
-                hora_salida_adjusted = self._adjust_time_utc_minus_4(truck_data.get('hora_salida'))
-                hora_llegada_adjusted = self._adjust_time_utc_minus_4(truck_data.get('hora_llegada'))
-
-                if existing:
-                    # Actualizar registro existente
-                    inicio_espera_final = existing['inicio_espera_descarga'] or inicio_espera_str
-
-                    update_query = """
-                    UPDATE truck_tracking SET
-                        latitude = %s, longitude = %s, velocidad_kmh = %s, direccion = %s, 
-                        geocerca_docks = %s, geocerca_track_trace = %s, geocerca_cbn = %s, geocerca_ciudades = %s,
-                        porcentaje_entrega = %s, estado_entrega = %s, tiempo_espera_minutos = %s, estado_descarga = %s,
-                        hora_salida = %s, hora_llegada = %s, status = %s, salida = %s,
-                        inicio_espera_descarga = %s, alert_level = %s, ultima_actualizacion = NOW()
-                    WHERE patente = %s AND planilla = %s
-                    """
+        self._save_truck_tracking_batch([
+            self._build_tracking_row(truck_data, location_data, geocerca_status, porcentaje_entrega,
+                                     estado_entrega, tiempo_espera_minutos, estado_descarga, inicio_espera_str)
+        ])
+
+    def _build_tracking_row(self, truck_data: Dict, location_data: Dict, geocerca_status: Dict[str, str],
+                            porcentaje_entrega: float, estado_entrega: str, tiempo_espera_minutos: int,
+                            estado_descarga: str, inicio_espera_str: str) -> Tuple:
+        """Arma la fila de truck_tracking para la escritura en bloque"""
+        return (
+            truck_data.get('cod'), truck_data.get('deposito_origen'), truck_data.get('cod_destino'),
+            truck_data.get('deposito_destino'), truck_data.get('planilla'), truck_data['patente'],
+            truck_data.get('fecha_salida'), self._adjust_time_utc_minus_4(truck_data.get('hora_salida')),
+            truck_data.get('fecha_llegada'), self._adjust_time_utc_minus_4(truck_data.get('hora_llegada')),
+            truck_data.get('cod_producto'), truck_data.get('producto'),
+            location_data['latitude'], location_data['longitude'], location_data['speed'],
+            location_data['direction'], geocerca_status['DOCKS'], geocerca_status['TRACK AND TRACE'],
+            geocerca_status['CBN'], geocerca_status['CIUDADES'], porcentaje_entrega, estado_entrega,
+            truck_data.get('status'), truck_data.get('salida'), tiempo_espera_minutos, estado_descarga,
+            inicio_espera_str, self._get_alert_level(tiempo_espera_minutos)
+        )
+
+    def _save_truck_tracking_batch(self, rows: List[Tuple]) -> int:
+        """Escribe las filas del ciclo con INSERT ... ON DUPLICATE KEY UPDATE en lotes
+
+        Se apoya en UNIQUE KEY unique_patente_planilla y conserva el
+        inicio_espera_descarga que ya tuviera el registro. Un commit por lote.
+        Usa VALUES(col) y no el alias de fila (AS new): pymysql 1.1.0 solo arma
+        un INSERT multi-fila si ON DUPLICATE va justo después de VALUES (...).
+        Devuelve las filas persistidas: las confirmadas más las omitidas sin cambios.
+        """
+        if not rows:
+            return 0
 
-                    cursor.execute(update_query, (
-                        location_data['latitude'], location_data['longitude'], location_data['speed'],
-                        location_data['direction'],
-                        geocerca_status['DOCKS'], geocerca_status['TRACK AND TRACE'],
-                        geocerca_status['CBN'], geocerca_status['CIUDADES'], porcentaje_entrega, estado_entrega,
-                        tiempo_espera_minutos, estado_descarga, hora_salida_adjusted, hora_llegada_adjusted,
-                        truck_data.get('status'), truck_data.get('salida'), inicio_espera_final,
-                        self._get_alert_level(tiempo_espera_minutos),
-                        truck_data['patente'], truck_data['planilla']
-                    ))
-                else:
-                    # Insertar nuevo registro
-                    insert_query = """
-                    INSERT INTO truck_tracking (
-                        cod, deposito_origen, cod_destino, deposito_destino, planilla, patente,
-                        fecha_salida, hora_salida, fecha_llegada, hora_llegada, cod_producto, producto,
-                        latitude, longitude, velocidad_kmh, direccion,
-                        geocerca_docks, geocerca_track_trace, geocerca_cbn, geocerca_ciudades,
-                        porcentaje_entrega, estado_entrega, status, salida,
-                        tiempo_espera_minutos, estado_descarga, inicio_espera_descarga, alert_level
-                    ) VALUES (
-                        %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                        %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
-                        %s, %s, %s, %s
-                    )
-                    """
+        upsert_query = """
+        INSERT INTO truck_tracking (
+            cod, deposito_origen, cod_destino, deposito_destino, planilla, patente,
+            fecha_salida, hora_salida, fecha_llegada, hora_llegada, cod_producto, producto,
+            latitude, longitude, velocidad_kmh, direccion,
+            geocerca_docks, geocerca_track_trace, geocerca_cbn, geocerca_ciudades,
+            porcentaje_entrega, estado_entrega, status, salida,
+            tiempo_espera_minutos, estado_descarga, inicio_espera_descarga, alert_level
+        ) VALUES (
+            %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
+            %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
+            %s, %s, %s, %s
+        )
+        ON DUPLICATE KEY UPDATE
+            latitude = VALUES(latitude), longitude = VALUES(longitude),
+            velocidad_kmh = VALUES(velocidad_kmh), direccion = VALUES(direccion),
+            geocerca_docks = VALUES(geocerca_docks), geocerca_track_trace = VALUES(geocerca_track_trace),
+            geocerca_cbn = VALUES(geocerca_cbn), geocerca_ciudades = VALUES(geocerca_ciudades),
+            porcentaje_entrega = VALUES(porcentaje_entrega), estado_entrega = VALUES(estado_entrega),
+            tiempo_espera_minutos = VALUES(tiempo_espera_minutos), estado_descarga = VALUES(estado_descarga),
+            hora_salida = VALUES(hora_salida), hora_llegada = VALUES(hora_llegada),
+            status = VALUES(status), salida = VALUES(salida),
+            inicio_espera_descarga = COALESCE(inicio_espera_descarga, VALUES(inicio_espera_descarga)),
+            alert_level = VALUES(alert_level), ultima_actualizacion = NOW()
+        """
+
+        # Filas idénticas a la última escrita se omiten, pero se reescriben al menos cada
+        # tracking_unchanged_refresh_seconds para mantener ultima_actualizacion (reportes, limpieza)
+        refresh_seconds = float(self.config.get('tracking_unchanged_refresh_seconds', 3600))
+        now = time.monotonic()
+        total_rows = len(rows)
+        if refresh_seconds > 0:
+            self.written_tracking_rows = {key: written for key, written in self.written_tracking_rows.items()
+                                          if now - written[1] < refresh_seconds}
+            rows = [row for row in rows
+                    if self.written_tracking_rows.get((row[5], row[4]), (None,))[0] != row]
+            self.written_tracking_stats['skipped'] += total_rows - len(rows)
+            if not rows:
+                logger.info(f"💾 Tracking sin cambios: 0/{total_rows} registros a escribir")
+                return total_rows
+
+        batch_size = int(self.config.get('tracking_batch_size', 500))
+        saved = 0
 
-                    cursor.execute(insert_query, (
-                        truck_data.get('cod'), truck_data.get('deposito_origen'), truck_data.get('cod_destino'),
-                        truck_data.get('deposito_destino'), truck_data.get('planilla'), truck_data['patente'],
-                        truck_data.get('fecha_salida'), hora_salida_adjusted, truck_data.get('fecha_llegada'),
-                        hora_llegada_adjusted, truck_data.get('cod_producto'), truck_data.get('producto'),
-                        location_data['latitude'], location_data['longitude'], location_data['speed'],
-                        location_data['direction'], geocerca_status['DOCKS'], geocerca_status['TRACK AND TRACE'],
-                        geocerca_status['CBN'], geocerca_status['CIUDADES'], porcentaje_entrega, estado_entrega,
-                        truck_data.get('status'), truck_data.get('salida'), tiempo_espera_minutos, estado_descarga,
-                        inicio_espera_str, self._get_alert_level(tiempo_espera_minutos)
-                    ))
+        try:
+            with self.target_pool.connection() as connection:
+                for offset in range(0, len(rows), batch_size):
+                    batch = rows[offset:offset + batch_size]
+                    try:
+                        with connection.cursor() as cursor:
+                            cursor.executemany(upsert_query, batch)
+                        connection.commit()
+                        saved += len(batch)
+                        for row in batch:
+                            self.written_tracking_rows[(row[5], row[4])] = (row, now)
 
-                self.target_connection.commit()
+                    except Exception as e:
+                        logger.error(f"Error guardando lote de tracking ({len(batch)} filas), se reintenta fila por fila: {e}")
+                        connection.rollback()
+
+                        # Un registro con datos inválidos no debe descartar el resto del lote
+                        for row in batch:
+                            try:
+                                with connection.cursor() as cursor:
+                                    cursor.execute(upsert_query, row)
+                                connection.commit()
+                                saved += 1
+                                self.written_tracking_rows[(row[5], row[4])] = (row, now)
+                            except Exception as row_error:
+                                logger.error(f"Error guardando tracking completo de {row[5]}: {row_error}")
+                                connection.rollback()
 
         except Exception as e:
-            logger.error(f"Error guardando tracking completo de {truck_data['patente']}: {e}")
-            self.target_connection.rollback()
+            logger.error(f"Error obteniendo conexión para guardar tracking: {e}")
+
+        self.written_tracking_stats['written'] += saved
+        logger.info(f"💾 Tracking guardado: {saved}/{len(rows)} registros "
+                    f"({total_rows - len(rows)} sin cambios omitidos)")
+        return saved + total_rows - len(rows)
 
     def _get_alert_level(self, tiempo_espera_minutos: int) -> str:
         """Determina nivel de alerta basado en tiempo de espera"""
@@ -877,7 +2359,7 @@ class TruckTrackingWebServiceComplete:
     def _create_tracking_table(self):
         """Crea la tabla de tracking completa con todas las columnas"""
         try:
-            with self.target_connection.cursor() as cursor:
+            with self.target_pool.connection() as connection, connection.cursor() as cursor:
                 create_table_query = """
                 CREATE TABLE IF NOT EXISTS truck_tracking (
                     id BIGINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
@@ -932,7 +2414,7 @@ class TruckTrackingWebServiceComplete:
                 """
 
                 cursor.execute(create_table_query)
-                self.target_connection.commit()
+                connection.commit()
                 logger.info("Tabla truck_tracking completa verificada/creada")
 
         except Exception as e:
@@ -941,7 +2423,7 @@ class TruckTrackingWebServiceComplete:
     def generate_waiting_alerts_complete(self):
         """Genera alertas de tiempo de espera (versión simple sin alert_level)"""
         try:
-            with self.target_connection.cursor() as cursor:
+            with self.target_pool.connection() as connection, connection.cursor() as cursor:
                 # Query simple sin columnas problemáticas
                 alerts_query = """
                 SELECT patente, planilla, deposito_destino, tiempo_espera_minutos, status,
@@ -993,10 +2475,14 @@ class TruckTrackingWebServiceComplete:
                 'summary': {'total_waiting': 0, 'critical_count': 0, 'warning_count': 0, 'attention_count': 0}
             }
 
+    def _get_snapshot_alerts(self) -> Dict:
+        """Alertas del último snapshot (estructura vacía si aún no hay ninguno)"""
+        return self._get_fresh_snapshot().alerts or empty_alerts()
+
     def get_alerts_summary_complete(self):
-        """Obtiene resumen completo de alertas desde BD"""
+        """Obtiene resumen completo de alertas desde el snapshot"""
         try:
-            alerts = self.generate_waiting_alerts_complete()
+            alerts = self._get_snapshot_alerts()
 
             if alerts and 'summary' in alerts:
                 return alerts['summary']
@@ -1009,19 +2495,16 @@ class TruckTrackingWebServiceComplete:
             return {}
 
     def get_active_alerts_complete(self):
-        """Obtiene alertas activas completas desde BD"""
+        """Obtiene alertas activas completas desde el snapshot"""
         try:
-            alerts = self.generate_waiting_alerts_complete()
-
-            if not alerts:
-                return []
+            alerts = self._get_snapshot_alerts()
 
             all_alerts = []
             for level, alerts_list in alerts.items():
                 if level != 'summary' and isinstance(alerts_list, list):
                     for alert in alerts_list:
-                        alert['alert_level'] = level.upper()
-                        all_alerts.append(alert)
+                        # Copia: el snapshot publicado no se modifica
+                        all_alerts.append(dict(alert, alert_level=level.upper()))
 
             all_alerts.sort(key=lambda x: x.get('horas_espera', 0), reverse=True)
             return all_alerts
@@ -1031,7 +2514,7 @@ class TruckTrackingWebServiceComplete:
             return []
 
     def get_critical_alerts_complete(self):
-        """Obtiene solo alertas críticas desde BD"""
+        """Obtiene solo alertas críticas desde el snapshot"""
         try:
             alerts = self.get_active_alerts_complete()
             return [alert for alert in alerts if alert.get('alert_level') == 'CRITICAL']
@@ -1040,10 +2523,12 @@ class TruckTrackingWebServiceComplete:
             return []
 
     def get_dashboard_stats_complete(self):
-        """Obtiene estadísticas completas para dashboard desde BD y datos reales"""
-        try:
-            trucks_data = self.get_all_trucks_status_complete()
+        """Obtiene estadísticas completas para dashboard desde el snapshot"""
+        return self._get_fresh_snapshot().stats or self._compute_dashboard_stats([])
 
+    def _compute_dashboard_stats(self, trucks_data: List[Dict]) -> Dict:
+        """Calcula las estadísticas del dashboard para un estado de flota"""
+        try:
             if not trucks_data:
                 return {
                     'total_camiones': 0, 'en_transito': 0, 'en_descarga': 0, 'alertas_criticas': 0,
@@ -1089,10 +2574,11 @@ class TruckTrackingWebServiceComplete:
             logger.error(f"Error obteniendo estadísticas completas: {e}")
             return {}
 
-    def get_geocercas_distribution(self):
+    def get_geocercas_distribution(self, trucks_data: List[Dict] = None):
         """Obtiene distribución real de camiones por geocerca"""
         try:
-            trucks_data = self.get_all_trucks_status_complete()
+            if trucks_data is None:
+                trucks_data = self.get_all_trucks_status_complete()
 
             distribution = {
                 'docks': len([t for t in trucks_data if t['en_docks'] != 'NO']),
@@ -1137,28 +2623,28 @@ class TruckTrackingWebServiceComplete:
     def generate_excel_report_complete(self):
         """Genera reporte Excel completo con múltiples hojas y colores"""
         try:
-            # Asegurar que tenemos datos actuales
-            if not self.results_data:
-                self.results_data = self.get_all_trucks_status_complete()
+            # Todo el reporte sale de una misma versión del snapshot
+            snapshot = self._get_fresh_snapshot()
 
-            # Generar alertas
-            alerts = self.generate_waiting_alerts_complete()
+            # Alertas del snapshot; solo se consulta la BD si aún no hay ninguno
+            alerts = snapshot.alerts or self.generate_waiting_alerts_complete()
 
             # Usar la función de generación completa
-            return self._generate_excel_report_with_alerts_complete(alerts)
+            return self._generate_excel_report_with_alerts_complete(alerts, snapshot)
 
         except Exception as e:
             logger.error(f"Error generando reporte Excel completo: {e}")
             return None
 
-    def _generate_excel_report_with_alerts_complete(self, alerts: Dict):
+    def _generate_excel_report_with_alerts_complete(self, alerts: Dict, snapshot: FleetSnapshot = None):
         """Genera Excel completo con múltiples hojas y colores automáticos"""
         try:
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             filename = f'tracking_completo_{timestamp}.xlsx'
 
-            # Crear DataFrame con los resultados
-            df = pd.DataFrame(self.results_data)
+            # Crear DataFrame con los resultados (filas de Excel o, si no hay, estado de camiones)
+            snapshot = snapshot or self.snapshot
+            df = pd.DataFrame(list(snapshot.results_data or snapshot.trucks_data))
 
             # Crear archivo Excel con múltiples hojas
             with pd.ExcelWriter(filename, engine='openpyxl') as writer:
@@ -1189,10 +2675,10 @@ class TruckTrackingWebServiceComplete:
                     df_summary.to_excel(writer, sheet_name='📊_Resumen_Alertas', index=False)
 
                 # HOJA 5: Resumen por geocercas
-                self._create_geocercas_summary_sheet(writer)
+                self._create_geocercas_summary_sheet(writer, list(snapshot.trucks_data))
 
                 # HOJA 6: Estadísticas generales
-                self._create_stats_sheet(writer)
+                self._create_stats_sheet(writer, snapshot.stats or None)
 
                 # Aplicar formato con colores automáticos
                 self._apply_excel_formatting_complete(writer.book, df, alerts)
@@ -1333,10 +2819,10 @@ class TruckTrackingWebServiceComplete:
         except Exception as e:
             logger.error(f"Error aplicando formato con colores: {e}")
 
-    def _create_geocercas_summary_sheet(self, writer):
+    def _create_geocercas_summary_sheet(self, writer, trucks_data: List[Dict] = None):
         """Crea hoja con resumen de distribución por geocercas"""
         try:
-            distribution = self.get_geocercas_distribution()
+            distribution = self.get_geocercas_distribution(trucks_data)
 
             geocercas_data = [
                 {'Geocerca': 'DOCKS', 'Camiones': distribution.get('docks', 0),
@@ -1378,10 +2864,10 @@ class TruckTrackingWebServiceComplete:
         except Exception as e:
             logger.error(f"Error creando hoja estadísticas: {e}")
 
-    def _create_stats_sheet(self, writer):
+    def _create_stats_sheet(self, writer, stats: Dict = None):
         """Crea hoja con estadísticas generales del sistema"""
         try:
-            stats = self.get_dashboard_stats_complete()
+            stats = stats or self.get_dashboard_stats_complete()
 
             stats_data = [
                 {'Métrica': 'Total Camiones', 'Valor': stats.get('total_camiones', 0)},
@@ -1404,11 +2890,12 @@ class TruckTrackingWebServiceComplete:
         """Procesa todos los camiones con funcionalidad completa (igual que original)"""
         start_time = time.time()
         logger.info("🚀 Iniciando procesamiento completo con geocercas y alertas...")
+        run = self._new_processing_run()
 
         try:
             with self.processing_lock:
-                # Limpiar resultados anteriores
-                self.results_data = []
+                # Filas del Excel del ciclo: se publican con el snapshot al terminar
+                results_data = []
 
                 # Cargar geocercas si no están cargadas
                 if not self.geocercas:
@@ -1416,114 +2903,147 @@ class TruckTrackingWebServiceComplete:
 
                 # Actualizar datos históricos para camiones existentes
                 if self.historical_data:
-                    self.update_historical_waiting_times()
+                    with self._timed_stage(run, 'historical_update'):
+                        self.update_historical_waiting_times()
 
                 # Obtener y procesar camiones
-                trucks = self.get_trucks_in_transit()
+                with self._timed_stage(run, 'source_query'):
+                    trucks = self.get_trucks_in_transit()
+                run['trucks'] = len(trucks)
                 if not trucks:
+                    # Flota vacía de verdad (un error del origen lanza excepción y conserva el snapshot)
                     logger.info("No hay camiones en tránsito")
+                    run['status'] = 'empty'
+                    self.last_processing_time = datetime.now()
+                    self._publish_snapshot([], empty_alerts())
+                    run['snapshot_version'] = self.snapshot.version
                     return
 
                 # Obtener todas las ubicaciones
-                all_locations = self.get_all_trucks_locations_parallel(trucks)
+                with self._timed_stage(run, 'location_fetch'):
+                    all_locations = self.get_all_trucks_locations_parallel(trucks)
 
                 # Procesar cada camión
-                processed = 0
                 errors = 0
 
-                for truck in trucks:
+                # Verificar geocercas de toda la flota en una sola etapa
+                located, missing = self._get_located_trucks(trucks, all_locations)
+                for truck in missing:
+                    logger.warning(f"⚠️ {truck['patente']}: Sin ubicación válida")
+                    errors += 1
+
+                run['skipped'] = len(missing)
+
+                with self._timed_stage(run, 'geofence'):
+                    geocerca_statuses = self.classify_trucks_geocercas(located)
+
+                # Inicios de espera de todo el ciclo en una sola consulta
+                with self._timed_stage(run, 'waiting_time'):
+                    waiting_starts = self._prefetch_waiting_starts([truck for truck, _ in located])
+
+                tracking_rows = []
+                trucks_data = []
+                for (truck, location), geocerca_status in zip(located, geocerca_statuses):
                     try:
                         patente = truck['patente']
                         planilla = truck['planilla']
                         deposito_destino = truck.get('deposito_destino', '')
 
-                        location = all_locations.get(patente)
+                        # Calcular progreso
+                        porcentaje_entrega, estado_entrega = self.calculate_delivery_progress(
+                            geocerca_status, deposito_destino
+                        )
 
-                        if location and location['latitude'] and location['longitude']:
-                            # Verificar geocercas
-                            geocerca_status = self.check_point_in_geocercas(
-                                location['latitude'], location['longitude'], deposito_destino
-                            )
+                        # Calcular tiempo de espera
+                        with self._timed_stage(run, 'waiting_time'):
+                            tiempo_espera_minutos, inicio_espera_str, estado_descarga, alert_level = \
+                                self.calculate_waiting_time_for_discharge(truck, geocerca_status, estado_entrega,
+                                                                          waiting_starts)
 
-                            # Calcular progreso
-                            porcentaje_entrega, estado_entrega = self.calculate_delivery_progress(
-                                geocerca_status, deposito_destino
-                            )
+                        # Fila para la escritura en bloque
+                        tracking_rows.append(self._build_tracking_row(
+                            truck, location, geocerca_status, porcentaje_entrega, estado_entrega,
+                            tiempo_espera_minutos, estado_descarga, inicio_espera_str
+                        ))
 
-                            # Calcular tiempo de espera
-                            tiempo_espera_minutos, inicio_espera_str, estado_descarga, alert_level = \
-                                self.calculate_waiting_time_for_discharge(truck, geocerca_status, estado_entrega)
-
-                            # Guardar en BD
-                            self._save_truck_tracking_complete(
-                                truck, location, geocerca_status, porcentaje_entrega, estado_entrega,
-                                tiempo_espera_minutos, estado_descarga, inicio_espera_str
-                            )
-
-                            # Preparar datos para Excel
-                            excel_row = {
-                                'patente': patente,
-                                'planilla': planilla,
-                                'status': truck.get('status', ''),
-                                'deposito_origen': truck.get('deposito_origen', ''),
-                                'deposito_destino': deposito_destino,
-                                'producto': truck.get('producto', ''),
-                                'cod_producto': truck.get('cod_producto', ''),
-                                'salida': truck.get('salida', ''),
-                                'fecha_salida': truck.get('fecha_salida', ''),
-                                'hora_salida': self._adjust_time_utc_minus_4(truck.get('hora_salida', '')),
-                                'fecha_llegada': truck.get('fecha_llegada', ''),
-                                'hora_llegada': self._adjust_time_utc_minus_4(truck.get('hora_llegada', '')),
-                                'latitude': location.get('latitude'),
-                                'longitude': location.get('longitude'),
-                                'velocidad_kmh': location.get('speed', 0),
-                                'timestamp': location.get('timestamp', ''),
-                                'en_docks': geocerca_status['DOCKS'],
-                                'en_track_trace': geocerca_status['TRACK AND TRACE'],
-                                'en_cbn': geocerca_status['CBN'],
-                                'en_ciudades': geocerca_status['CIUDADES'],
-                                'porcentaje_entrega': porcentaje_entrega,
-                                'estado_entrega': estado_entrega,
-                                'tiempo_espera_minutos': tiempo_espera_minutos,
-                                'tiempo_espera_horas': round(tiempo_espera_minutos / 60,
-                                                             2) if tiempo_espera_minutos > 0 else 0,
-                                'estado_descarga': estado_descarga,
-                                'alert_level': alert_level,
-                                'inicio_espera': inicio_espera_str,
-                                'fecha_proceso': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                            }
-                            self.results_data.append(excel_row)
-
-                            # Log de progreso
-                            tiempo_espera_str = ""
-                            if tiempo_espera_minutos > 0:
-                                horas = tiempo_espera_minutos // 60
-                                minutos = tiempo_espera_minutos % 60
-                                alert_emoji = {"CRITICAL": "🚨", "WARNING": "⚠️", "ATTENTION": "🔔"}.get(alert_level, "⏰")
-                                tiempo_espera_str = f" {alert_emoji} Esperando: {horas}h {minutos}m"
-
-                            # Log de resultados
-                            in_geocerca = [f"{geo}: {status}" for geo, status in geocerca_status.items() if
-                                           status != 'NO']
-                            geocerca_str = ', '.join(in_geocerca) if in_geocerca else 'En tránsito libre'
-
-                            logger.info(
-                                f"✅ {patente}: {porcentaje_entrega}% ({estado_entrega}) - {geocerca_str}{tiempo_espera_str}")
-                            processed += 1
-                        else:
-                            logger.warning(f"⚠️ {patente}: Sin ubicación válida")
-                            errors += 1
+                        # Estado para el snapshot que leen los endpoints
+                        trucks_data.append(self._build_truck_status(
+                            truck, location, geocerca_status, porcentaje_entrega, estado_entrega,
+                            tiempo_espera_minutos, inicio_espera_str, estado_descarga, alert_level
+                        ))
+
+                        # Preparar datos para Excel
+                        excel_row = {
+                            'patente': patente,
+                            'planilla': planilla,
+                            'status': truck.get('status', ''),
+                            'deposito_origen': truck.get('deposito_origen', ''),
+                            'deposito_destino': deposito_destino,
+                            'producto': truck.get('producto', ''),
+                            'cod_producto': truck.get('cod_producto', ''),
+                            'salida': truck.get('salida', ''),
+                            'fecha_salida': truck.get('fecha_salida', ''),
+                            'hora_salida': self._adjust_time_utc_minus_4(truck.get('hora_salida', '')),
+                            'fecha_llegada': truck.get('fecha_llegada', ''),
+                            'hora_llegada': self._adjust_time_utc_minus_4(truck.get('hora_llegada', '')),
+                            'latitude': location.get('latitude'),
+                            'longitude': location.get('longitude'),
+                            'velocidad_kmh': location.get('speed', 0),
+                            'timestamp': location.get('timestamp', ''),
+                            'en_docks': geocerca_status['DOCKS'],
+                            'en_track_trace': geocerca_status['TRACK AND TRACE'],
+                            'en_cbn': geocerca_status['CBN'],
+                            'en_ciudades': geocerca_status['CIUDADES'],
+                            'porcentaje_entrega': porcentaje_entrega,
+                            'estado_entrega': estado_entrega,
+                            'tiempo_espera_minutos': tiempo_espera_minutos,
+                            'tiempo_espera_horas': round(tiempo_espera_minutos / 60,
+                                                         2) if tiempo_espera_minutos > 0 else 0,
+                            'estado_descarga': estado_descarga,
+                            'alert_level': alert_level,
+                            'inicio_espera': inicio_espera_str,
+                            'fecha_proceso': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                        }
+                        results_data.append(excel_row)
+
+                        # Log de progreso
+                        tiempo_espera_str = ""
+                        if tiempo_espera_minutos > 0:
+                            horas = tiempo_espera_minutos // 60
+                            minutos = tiempo_espera_minutos % 60
+                            alert_emoji = {"CRITICAL": "🚨", "WARNING": "⚠️", "ATTENTION": "🔔"}.get(alert_level, "⏰")
+                            tiempo_espera_str = f" {alert_emoji} Esperando: {horas}h {minutos}m"
+
+                        # Log de resultados
+                        in_geocerca = [f"{geo}: {status}" for geo, status in geocerca_status.items() if
+                                       status != 'NO']
+                        geocerca_str = ', '.join(in_geocerca) if in_geocerca else 'En tránsito libre'
+
+                        logger.info(
+                            f"✅ {patente}: {porcentaje_entrega}% ({estado_entrega}) - {geocerca_str}{tiempo_espera_str}")
 
                     except Exception as e:
                         logger.error(f"❌ Error procesando {truck.get('patente', 'UNKNOWN')}: {e}")
                         errors += 1
 
+                # Guardar en BD todo el ciclo en bloque
+                written_before = dict(self.written_tracking_stats)
+                # Un camión cuenta como procesado solo cuando su fila quedó confirmada en la BD
+                with self._timed_stage(run, 'db_write'):
+                    processed = self._save_truck_tracking_batch(tracking_rows)
+                errors += len(tracking_rows) - processed
+                run['processed'] = processed
+                run['errors'] = errors - len(missing)
+                run['rows_written'] = self.written_tracking_stats['written'] - written_before['written']
+                run['rows_skipped'] = self.written_tracking_stats['skipped'] - written_before['skipped']
+
                 elapsed_time = time.time() - start_time
                 logger.info(
                     f"🏁 Procesamiento completo terminado en {elapsed_time:.2f}s: {processed} exitosos, {errors} errores")
 
                 # Generar alertas finales
-                alerts = self.generate_waiting_alerts_complete()
+                with self._timed_stage(run, 'alerts'):
+                    alerts = self.generate_waiting_alerts_complete()
                 if alerts['summary']['total_waiting'] > 0:
                     logger.info(f"📊 ALERTAS GENERADAS:")
                     logger.info(f"   🚨 Críticas (>48h): {alerts['summary']['critical_count']}")
@@ -1533,94 +3053,258 @@ class TruckTrackingWebServiceComplete:
                 # Actualizar timestamp de procesamiento
                 self.last_processing_time = datetime.now()
 
-                # Limpiar cache para forzar actualización
-                self.cache['last_update'] = None
+                # Publicar el estado de flota para los endpoints de lectura
+                self._publish_snapshot(trucks_data, alerts, results_data)
+                run['snapshot_version'] = self.snapshot.version
 
                 logger.info("✅ Procesamiento completo finalizado exitosamente")
 
         except Exception as e:
             logger.error(f"Error en procesamiento completo: {e}")
+            run['status'] = 'failed'
+            run['error'] = f"{run['failed_stage']}: {e}" if run.get('failed_stage') else str(e)
             raise
+        finally:
+            self._record_processing_run(run, start_time)
+
+    def _new_processing_run(self) -> Dict:
+        """Registro vacío de una corrida de procesamiento"""
+        return {
+            'run_id': uuid.uuid4().hex[:12],
+            'started_at': datetime.now(),
+            'finished_at': None,
+            'duration_ms': None,
+            'status': 'ok',
+            'error': None,
+            'trucks': 0,
+            'processed': 0,
+            'errors': 0,
+            'skipped': 0,
+            'rows_written': 0,
+            'rows_skipped': 0,
+            'snapshot_version': None,
+            'stages': {stage: 0.0 for stage in self.RUN_STAGES}
+        }
+
+    @contextmanager
+    def _timed_stage(self, run: Dict, stage: str):
+        """Suma al registro de la corrida los ms que tarda el bloque en la etapa indicada
+
+        Una etapa puede medirse en varios tramos (waiting_time se mide por camión);
+        el histograma se observa una sola vez por etapa al cerrar la corrida.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            # El error de la corrida indica en qué etapa falló (p. ej. source_query si el origen no responde)
+            run['failed_stage'] = stage
+            raise
+        finally:
+            run['stages'][stage] += (time.perf_counter() - started) * 1000
+
+    def _record_processing_run(self, run: Dict, start_time: float):
+        """Cierra el registro de la corrida, lo guarda en memoria y en la tabla processing_runs"""
+        run['finished_at'] = datetime.now()
+        run['duration_ms'] = round((time.time() - start_time) * 1000, 1)
+        # Una observación por etapa ejecutada y por corrida, con el total de sus tramos
+        for stage, ms in run['stages'].items():
+            if ms:
+                PROCESSING_STAGE_DURATION.observe(ms / 1000, stage=stage)
+        run['stages'] = {stage: round(ms, 1) for stage, ms in run['stages'].items()}
+        self.processing_runs.append(run)
+        PROCESSING_RUN_DURATION.observe(run['duration_ms'] / 1000, status=run['status'])
+
+        stages_str = ', '.join(f"{stage}={ms:.0f}ms" for stage, ms in run['stages'].items() if ms)
+        logger.info(f"⏱️ Corrida {run['run_id']} ({run['status']}): {run['duration_ms']:.0f}ms [{stages_str}]")
+
+        if not self.target_pool:
+            return
+        try:
+            with self.target_pool.connection() as connection, connection.cursor() as cursor:
+                stage_columns = ', '.join(f"{stage}_ms" for stage in self.RUN_STAGES)
+                cursor.execute(f"""
+                INSERT INTO processing_runs (run_id, started_at, finished_at, duration_ms, status, error,
+                                             trucks, processed, errors, skipped, rows_written, rows_skipped,
+                                             snapshot_version, {stage_columns})
+                VALUES ({', '.join(['%s'] * (13 + len(self.RUN_STAGES)))})
+                """, (
+                    run['run_id'], run['started_at'], run['finished_at'], run['duration_ms'], run['status'],
+                    run['error'], run['trucks'], run['processed'], run['errors'], run['skipped'],
+                    run['rows_written'], run['rows_skipped'], run['snapshot_version'],
+                    *(run['stages'][stage] for stage in self.RUN_STAGES)
+                ))
+                connection.commit()
+        except Exception as e:
+            logger.error(f"Error guardando corrida de procesamiento: {e}")
+
+    def get_processing_runs(self, limit: int = 50, from_db: bool = False) -> List[Dict]:
+        """Últimas corridas de procesamiento (más reciente primero), de memoria o de processing_runs"""
+        limit = max(1, int(limit))
+        if not from_db:
+            runs = list(self.processing_runs)[-limit:][::-1]
+            return [dict(run, started_at=run['started_at'].isoformat(),
+                         finished_at=run['finished_at'].isoformat() if run['finished_at'] else None)
+                    for run in runs]
+
+        try:
+            with self.target_pool.connection() as connection, connection.cursor() as cursor:
+                cursor.execute("SELECT * FROM processing_runs ORDER BY id DESC LIMIT %s", (limit,))
+                rows = cursor.fetchall()
+
+            runs = []
+            for row in rows:
+                run = {key: value for key, value in row.items() if key != 'id' and not key.endswith('_ms')}
+                run['started_at'] = row['started_at'].isoformat() if row['started_at'] else None
+                run['finished_at'] = row['finished_at'].isoformat() if row['finished_at'] else None
+                run['duration_ms'] = float(row['duration_ms']) if row['duration_ms'] is not None else None
+                run['stages'] = {stage: float(row[f'{stage}_ms'] or 0) for stage in self.RUN_STAGES}
+                runs.append(run)
+            return runs
+
+        except Exception as e:
+            logger.error(f"Error obteniendo corridas de procesamiento: {e}")
+            return []
+
+    def collect_metrics(self) -> List[Tuple]:
+        """Métricas calculadas desde el estado en memoria (sin consultar la BD) para /metrics"""
+        snapshot = self.snapshot
+
+        alert_levels = {level: 0 for level in ('CRITICAL', 'WARNING', 'ATTENTION', 'NORMAL')}
+        for truck in snapshot.trucks_data:
+            level = truck.get('alert_level') or 'NORMAL'
+            alert_levels[level] = alert_levels.get(level, 0) + 1
+
+        snapshot_age = (datetime.now() - snapshot.created_at).total_seconds() if snapshot.created_at else None
+
+        pool_samples, pool_max = [], []
+        for pool in (self.source_pool, self.target_pool):
+            if pool:
+                stats = pool.get_stats()
+                pool_samples.append(({'pool': stats['name'], 'state': 'in_use'}, stats['in_use']))
+                pool_samples.append(({'pool': stats['name'], 'state': 'idle'}, stats['idle']))
+                pool_max.append(({'pool': stats['name']}, stats['max_size']))
+
+        lru, memo, grid = self.geocerca_lru_stats, self.geocerca_memo_stats, self.geocerca_grid_stats
+        cache_ratios = [
+            ({'cache': 'geocerca_lru'}, lru['hits'] / max(sum(lru.values()), 1)),
+            ({'cache': 'geocerca_memo'}, memo['reused'] / max(memo['reused'] + memo['evaluated'], 1)),
+            ({'cache': 'geocerca_grid'}, grid['resolved'] / max(grid['resolved'] + grid['boundary'], 1)),
+            ({'cache': 'tracking_rows'}, self.written_tracking_stats['skipped'] /
+             max(self.written_tracking_stats['written'] + self.written_tracking_stats['skipped'], 1))
+        ]
+
+        scheduler = self.scheduler.get_stats()
+        api = self.api_client.get_stats()
+        vehicle_api = self.vehicle_api_client.get_stats()
+
+        return [
+            ('fleet_trucks', 'gauge', 'Camiones del último snapshot por nivel de alerta',
+             [({'alert_level': level}, count) for level, count in alert_levels.items()]),
+            ('fleet_snapshot_age_seconds', 'gauge', 'Antigüedad del snapshot publicado', [({}, snapshot_age)]),
+            ('fleet_snapshot_version', 'gauge', 'Versión del snapshot publicado', [({}, snapshot.version)]),
+            ('db_pool_connections', 'gauge', 'Conexiones del pool por estado', pool_samples),
+            ('db_pool_max_connections', 'gauge', 'Tamaño máximo del pool', pool_max),
+            ('cache_hit_ratio', 'gauge', 'Proporción de aciertos de cada cache', cache_ratios),
+            ('snapshot_refresh_total', 'counter', 'Refrescos de snapshot bajo demanda por resultado',
+             [({'result': key}, value) for key, value in self.refresh_stats.items()]),
+            ('processing_scheduler_cycles_total', 'counter', 'Ciclos del planificador por resultado',
+             [({'result': key}, scheduler[key]) for key in ('runs', 'skipped', 'overruns', 'failures',
+                                                            'deduplicated')]),
+            ('boltrack_circuit_open', 'gauge', 'Circuito de la API de Boltrack abierto (1) o cerrado (0)',
+             [({'client': 'fleet'}, 0 if api['circuit_state'] == 'closed' else 1),
+              ({'client': 'vehicle'}, 0 if vehicle_api['circuit_state'] == 'closed' else 1)]),
+        ]
 
     def update_historical_waiting_times(self):
         """Actualiza tiempos de espera usando datos históricos del Excel"""
         if not self.historical_data:
             return
 
-        try:
-            with self.target_connection.cursor() as cursor:
-                updated_count = 0
-
-                for patente, hist_data in self.historical_data.items():
-                    # Buscar registros que necesiten actualización
-                    check_query = """
-                    SELECT id, patente, planilla FROM truck_tracking 
-                    WHERE patente = %s AND (inicio_espera_descarga IS NULL OR inicio_espera_descarga = '')
-                    AND status = 'SALIDA'
-                    """
+        now = datetime.now()
+        historical_rows = []
+        for patente, hist_data in self.historical_data.items():
+            inicio_espera = hist_data.get('primera_entrada_descarga')
+            if inicio_espera is None:
+                continue
 
-                    cursor.execute(check_query, (patente,))
-                    trucks_to_update = cursor.fetchall()
-
-                    for truck in trucks_to_update:
-                        inicio_espera = hist_data['primera_entrada_descarga']
-                        tiempo_espera = datetime.now() - inicio_espera
-                        tiempo_espera_minutos = int(tiempo_espera.total_seconds() / 60)
-
-                        # Determinar alert_level basado en tiempo histórico
-                        alert_level = self._get_alert_level(tiempo_espera_minutos)
-
-                        update_query = """
-                        UPDATE truck_tracking SET
-                            inicio_espera_descarga = %s,
-                            tiempo_espera_minutos = %s,
-                            estado_descarga = 'HISTORICO_EXCEL',
-                            alert_level = %s
-                        WHERE id = %s
-                        """
-
-                        cursor.execute(update_query, (
-                            inicio_espera.strftime('%Y-%m-%d %H:%M:%S'),
-                            tiempo_espera_minutos,
-                            alert_level,
-                            truck['id']
-                        ))
-                        updated_count += 1
+            tiempo_espera_minutos = int((now - inicio_espera).total_seconds() / 60)
+            historical_rows.append((
+                patente,
+                inicio_espera.strftime('%Y-%m-%d %H:%M:%S'),
+                tiempo_espera_minutos,
+                self._get_alert_level(tiempo_espera_minutos)
+            ))
 
-                        logger.info(
-                            f"📅 Histórico actualizado para {patente}: {tiempo_espera_minutos // 60}h {tiempo_espera_minutos % 60}m esperando")
+        if not historical_rows:
+            return
+
+        try:
+            with self.target_pool.connection() as connection, connection.cursor() as cursor:
+                # Cargar el mapa histórico en una tabla temporal y aplicarlo con un solo UPDATE ... JOIN
+                cursor.execute("DROP TEMPORARY TABLE IF EXISTS tmp_historico_espera")
+                cursor.execute("""
+                CREATE TEMPORARY TABLE tmp_historico_espera (
+                    patente VARCHAR(255) NOT NULL PRIMARY KEY,
+                    inicio_espera_descarga DATETIME NOT NULL,
+                    tiempo_espera_minutos INT NOT NULL,
+                    alert_level VARCHAR(20) NOT NULL
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci
+                """)
+
+                cursor.executemany("""
+                INSERT INTO tmp_historico_espera (patente, inicio_espera_descarga, tiempo_espera_minutos, alert_level)
+                VALUES (%s, %s, %s, %s)
+                """, historical_rows)
+
+                update_query = """
+                UPDATE truck_tracking t
+                JOIN tmp_historico_espera h ON h.patente = t.patente
+                SET t.inicio_espera_descarga = h.inicio_espera_descarga,
+                    t.tiempo_espera_minutos = h.tiempo_espera_minutos,
+                    t.estado_descarga = 'HISTORICO_EXCEL',
+                    t.alert_level = h.alert_level
+                WHERE (t.inicio_espera_descarga IS NULL OR t.inicio_espera_descarga = '')
+                AND t.status = 'SALIDA'
+                """
+
+                updated_count = cursor.execute(update_query)
+                cursor.execute("DROP TEMPORARY TABLE IF EXISTS tmp_historico_espera")
 
-                self.target_connection.commit()
-                logger.info(f"✅ Actualizados {updated_count} registros con datos históricos")
+                connection.commit()
+                if updated_count:
+                    self.written_tracking_rows = {}
+                logger.info(f"✅ Actualizados {updated_count} registros con datos históricos "
+                            f"({len(historical_rows)} patentes en Excel)")
 
         except Exception as e:
             logger.error(f"Error actualizando tiempos históricos: {e}")
-            self.target_connection.rollback()
 
     def disconnect_databases(self):
         """Desconecta de ambas bases de datos"""
         try:
-            if self.source_connection:
-                self.source_connection.close()
-                logger.info("✅ Conexión BD origen cerrada")
+            if self.source_pool:
+                self.source_pool.close_all()
+                logger.info("✅ Pool BD origen cerrado")
         except Exception as e:
-            logger.warning(f"⚠️ Error cerrando conexión origen: {e}")
+            logger.warning(f"⚠️ Error cerrando pool origen: {e}")
 
         try:
-            if self.target_connection:
-                self.target_connection.close()
-                logger.info("✅ Conexión BD destino cerrada")
+            if self.target_pool:
+                self.target_pool.close_all()
+                logger.info("✅ Pool BD destino cerrado")
         except Exception as e:
-            logger.warning(f"⚠️ Error cerrando conexión destino: {e}")
+            logger.warning(f"⚠️ Error cerrando pool destino: {e}")
 
     def get_system_health(self):
         """Obtiene estado de salud del sistema"""
         try:
+            snapshot = self.snapshot
             health = {
                 'timestamp': datetime.now().isoformat(),
                 'databases': {
-                    'source': self.source_connection is not None and self.source_connection.open,
-                    'target': self.target_connection is not None and self.target_connection.open
+                    'source': self.source_pool.get_stats() if self.source_pool else None,
+                    'target': self.target_pool.get_stats() if self.target_pool else None
                 },
                 'geocercas': {
                     'loaded': len(self.geocercas) > 0,
@@ -1632,11 +3316,31 @@ class TruckTrackingWebServiceComplete:
                     'trucks_count': len(self.historical_data)
                 },
                 'cache': {
-                    'trucks_cached': len(self.cache['trucks_data']),
-                    'last_update': self.cache['last_update'].isoformat() if self.cache['last_update'] else None
+                    'trucks_cached': len(snapshot.trucks_data),
+                    'last_update': snapshot.created_at.isoformat() if snapshot.created_at else None,
+                    'version': snapshot.version
+                },
+                'snapshot_refresh': {
+                    **self.refresh_stats,
+                    'in_flight': self.refresh_event is not None
+                },
+                'latest_trip': dict(self.latest_trip_state),
+                'locations': {
+                    **{k: v for k, v in self.location_fetch_state.items() if k != 'wanted'},
+                    'tracking_rows_written': self.written_tracking_stats['written'],
+                    'tracking_rows_skipped': self.written_tracking_stats['skipped']
+                },
+                'location_providers': self.location_providers.get_stats() if self.location_providers else None,
+                'api': {
+                    **self.api_client.get_stats(),
+                    'last_good_locations': len(self.last_good_locations),
+                    'last_good_locations_at': self.last_good_locations_at.isoformat()
+                    if self.last_good_locations_at else None
                 },
+                'vehicle_api': self.vehicle_api_client.get_stats(),
                 'last_processing': self.last_processing_time.isoformat() if self.last_processing_time else None,
-                'is_processing': self.processing_lock.locked()
+                'is_processing': self.processing_lock.locked(),
+                'scheduler': self.scheduler.get_stats()
             }
             return health
         except Exception as e:
@@ -1646,12 +3350,7 @@ class TruckTrackingWebServiceComplete:
     def clear_cache(self):
         """Limpia el cache del sistema"""
         try:
-            self.cache = {
-                'trucks_data': [],
-                'alerts': {},
-                'stats': {},
-                'last_update': None
-            }
+            self.snapshot = FleetSnapshot(version=self.snapshot.version + 1)
             logger.info("🧹 Cache limpiado correctamente")
             return True
         except Exception as e:
@@ -1661,7 +3360,8 @@ class TruckTrackingWebServiceComplete:
     def force_reload_geocercas(self):
         """Fuerza recarga de geocercas desde Excel"""
         try:
-            self.geocercas = {}
+            # Sin processing_lock: el conjunto nuevo se arma aparte y se publica de una vez,
+            # el ciclo en curso termina con el que tomó al empezar
             success = self.load_geocercas()
             if success:
                 logger.info("🔄 Geocercas recargadas exitosamente")
@@ -1685,7 +3385,7 @@ class TruckTrackingWebServiceComplete:
     def get_processing_stats(self):
         """Obtiene estadísticas de procesamiento"""
         try:
-            with self.target_connection.cursor() as cursor:
+            with self.target_pool.connection() as connection, connection.cursor() as cursor:
                 # Estadísticas básicas
                 stats_query = """
                 SELECT 
@@ -1738,7 +3438,7 @@ class TruckTrackingWebServiceComplete:
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             backup_filename = f'backup_tracking_{timestamp}.csv'
 
-            with self.target_connection.cursor() as cursor:
+            with self.target_pool.connection() as connection, connection.cursor() as cursor:
                 backup_query = """
                 SELECT * FROM truck_tracking 
                 WHERE status = 'SALIDA'
@@ -1763,7 +3463,7 @@ class TruckTrackingWebServiceComplete:
     def cleanup_old_records(self, days_old=30):
         """Limpia registros antiguos de la BD (mayor a X días)"""
         try:
-            with self.target_connection.cursor() as cursor:
+            with self.target_pool.connection() as connection, connection.cursor() as cursor:
                 cleanup_query = """
                 DELETE FROM truck_tracking 
                 WHERE ultima_actualizacion < DATE_SUB(NOW(), INTERVAL %s DAY)
@@ -1771,36 +3471,31 @@ class TruckTrackingWebServiceComplete:
                 """
                 cursor.execute(cleanup_query, (days_old,))
                 deleted_count = cursor.rowcount
-                self.target_connection.commit()
+                connection.commit()
+
+                # Las filas borradas no deben omitirse como "sin cambios" en el próximo ciclo
+                if deleted_count:
+                    self.written_tracking_rows = {}
 
                 logger.info(f"🧹 Limpieza completada: {deleted_count} registros antiguos eliminados")
                 return deleted_count
 
         except Exception as e:
             logger.error(f"Error en limpieza de registros: {e}")
-            self.target_connection.rollback()
             return 0
 
     def test_api_connection(self):
         """Prueba la conexión con la API de Boltrack"""
         try:
-            headers = {
-                'token': self.config['api']['token'],
-                'Content-Type': 'application/json'
-            }
-
-            # Hacer una petición simple para probar
-            response = requests.get(
-                f"{self.config['api']['base_url']}/ultimaubicaciontodos",
-                headers=headers,
-                timeout=10
-            )
+            # Petición directa de prueba: no pasa por el circuito, así no lo abre ni lo cierra
+            response = self.api_client.probe('/ultimaubicaciontodos', timeout=10)
 
             api_status = {
                 'status_code': response.status_code,
                 'response_time_ms': response.elapsed.total_seconds() * 1000,
                 'success': response.status_code == 200,
-                'timestamp': datetime.now().isoformat()
+                'timestamp': datetime.now().isoformat(),
+                'client': self.api_client.get_stats()
             }
 
             if response.status_code == 200:
@@ -1818,36 +3513,60 @@ class TruckTrackingWebServiceComplete:
             return {
                 'success': False,
                 'error': str(e),
-                'timestamp': datetime.now().isoformat()
+                'timestamp': datetime.now().isoformat(),
+                'client': self.api_client.get_stats()
             }
 
     def get_cache_info(self):
         """Obtiene información detallada del cache"""
+        snapshot = self.snapshot
         return {
             'trucks_data': {
-                'count': len(self.cache['trucks_data']),
-                'last_update': self.cache['last_update'].isoformat() if self.cache['last_update'] else None,
-                'size_bytes': len(str(self.cache['trucks_data']))
+                'count': len(snapshot.trucks_data),
+                'last_update': snapshot.created_at.isoformat() if snapshot.created_at else None,
+                'version': snapshot.version,
+                'size_bytes': len(str(snapshot.trucks_data))
             },
             'geocercas': {
                 'groups_loaded': len(self.geocercas),
                 'total_geocercas': sum(len(geocercas_list) for geocercas_list in self.geocercas.values()),
                 'groups': list(self.geocercas.keys())
             },
+            'geocerca_lru': {
+                'entries': len(self.geocerca_lru),
+                'capacity': int(self.config.get('geocerca_cache_size', 50000)),
+                'precision': int(self.config.get('geocerca_cache_precision', 4)),
+                'hits': self.geocerca_lru_stats['hits'],
+                'misses': self.geocerca_lru_stats['misses'],
+                'edge': self.geocerca_lru_stats['edge'],
+                'hit_ratio': round(self.geocerca_lru_stats['hits'] / max(sum(self.geocerca_lru_stats.values()), 1), 3)
+            },
+            'geocerca_grid': {
+                'engine': self.config.get('geocerca_engine', 'shapely'),
+                'enabled': self.config.get('geocerca_engine', 'shapely') == 'grid' and bool(self.geocerca_grid),
+                'cells': int(self.geocerca_grid['nx'] * self.geocerca_grid['ny']) if self.geocerca_grid else 0,
+                'resolved': self.geocerca_grid_stats['resolved'],
+                'boundary': self.geocerca_grid_stats['boundary']
+            },
+            'geocerca_memo': {
+                'trucks_count': len(self.geocerca_memo),
+                'reused': self.geocerca_memo_stats['reused'],
+                'evaluated': self.geocerca_memo_stats['evaluated']
+            },
             'historical_data': {
                 'trucks_count': len(self.historical_data),
                 'size_bytes': len(str(self.historical_data))
             },
             'results_data': {
-                'count': len(self.results_data),
-                'size_bytes': len(str(self.results_data))
+                'count': len(snapshot.results_data),
+                'size_bytes': len(str(snapshot.results_data))
             }
         }
 
     def _update_table_structure(self):
         """Actualiza automáticamente la estructura de la tabla (compatible MySQL)"""
         try:
-            with self.target_connection.cursor() as cursor:
+            with self.target_pool.connection() as connection, connection.cursor() as cursor:
                 # Primero verificar qué columnas existen
                 cursor.execute("SHOW COLUMNS FROM truck_tracking")
                 existing_columns = [row['Field'] for row in cursor.fetchall()]
@@ -1887,12 +3606,11 @@ class TruckTrackingWebServiceComplete:
                         except Exception as e:
                             logger.error(f"❌ Error agregando {column_name}: {e}")
 
-                self.target_connection.commit()
+                connection.commit()
                 logger.info(f"✅ Estructura actualizada: {added_count} columnas agregadas")
 
         except Exception as e:
             logger.error(f"Error actualizando tabla: {e}")
-            self.target_connection.rollback()
 
     # Agregar a truck_tracking_web_complete.py
     def get_geocercas_for_map(self):
@@ -1941,7 +3659,7 @@ class TruckTrackingWebServiceComplete:
         """Obtiene datos completos para el dashboard de alertas"""
         try:
             trucks = self.get_all_trucks_status_complete()
-            alerts_data = self.generate_waiting_alerts_complete()
+            alerts_data = self._get_snapshot_alerts()
 
             # Estadísticas generales
             total_trucks = len(trucks)
@@ -2222,7 +3940,7 @@ class TruckTrackingWebServiceComplete:
             # En producción, esto consultaría la BD histórica
             # Por ahora, generamos datos de ejemplo
 
-            with self.target_connection.cursor() as cursor:
+            with self.target_pool.connection() as connection, connection.cursor() as cursor:
                 report_query = """
                 SELECT 
                     DATE(ultima_actualizacion) as fecha,